@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import os
 import urlparse
 import urllib
 import time
@@ -13,6 +14,9 @@ import socket
 import ssl
 
 import subprocess
+from twisted.cred import credentials
+from twisted.internet import defer, reactor, task, threads
+from twisted.spread import pb
 from buildbotcustom.changes.hgpoller import _parse_changes
 import logging as log
 
@@ -84,7 +88,23 @@ def getChanges(base_url, last_changeset=None, tips_only=False, ca_certs=None,
         handle = urllib2.urlopen(url)
 
     data = handle.read()
-    return _parse_changes(data)
+    return flattenPushes(_parse_changes(data))
+
+
+def flattenPushes(pushes):
+    """Returns a list of the changesets in pushes, oldest first"""
+    changes = []
+    for push in pushes:
+        for c in push['changesets']:
+            changes.append({
+                'changeset': c['node'],
+                'author': c['author'],
+                'comments': c['desc'],
+                'files': c['files'],
+                'branch': c['branch'],
+                'updated': push['date'],
+            })
+    return changes
 
 
 def sendchange(master, branch, change):
@@ -105,16 +125,98 @@ def sendchange(master, branch, change):
     subprocess.check_call(cmd)
 
 
-def processBranch(branch, state, config):
+def changeDict(branch, change):
+    """Returns the change in the form the master's PBChangeSource expects,
+    with the same values `buildbot sendchange` would send"""
+    return {
+        'who': change['author'].encode('ascii', 'replace'),
+        'files': change['files'],
+        'comments': change['comments'].encode('ascii', 'replace'),
+        'branch': branch,
+        'revision': change['changeset'],
+        'category': None,
+        'when': change['updated'],
+        'properties': {},
+        'repository': '',
+        'project': '',
+        'revlink': '',
+    }
+
+
+class ChangeSender(object):
+    """Sends changes to the master in-process, one connection per batch"""
+
+    retries = 5
+    retryDelay = 5
+
+    def __init__(self, master):
+        self.host, port = master.split(":")
+        self.port = int(port)
+
+    def send(self, branch, changes, acked=None):
+        """Sends changes to the master over one connection. Each change the
+        master accepts is appended to acked, if it's given."""
+        f = pb.PBClientFactory()
+        d = f.login(credentials.UsernamePassword("change", "changepw"))
+        reactor.connectTCP(self.host, self.port, f)
+
+        def addChanges(remote):
+            # Send the changes one after the other, so they keep their order
+            d = defer.succeed(None)
+            for c in changes:
+                d.addCallback(self.addChange, remote, branch, c, acked)
+
+            def disconnect(res):
+                remote.broker.transport.loseConnection()
+                return res
+            d.addBoth(disconnect)
+            return d
+        d.addCallback(addChanges)
+        return d
+
+    def addChange(self, _, remote, branch, change, acked):
+        log.info("Sendchange %s to %s:%i on branch %s", change['changeset'],
+                 self.host, self.port, branch)
+        d = remote.callRemote('addChange', changeDict(branch, change))
+        if acked is not None:
+            d.addCallback(lambda _: acked.append(change))
+        return d
+
+    def sendWithRetries(self, branch, changes, acked=None, attempt=1):
+        """Sends changes, retrying if that fails. Each retry starts from the
+        first change the master hasn't accepted, so none are sent twice. The
+        changes that were accepted are appended to acked, if it's given."""
+        if acked is None:
+            acked = []
+        sent = len(acked)
+        d = self.send(branch, changes, acked)
+
+        def failed(f):
+            if attempt >= self.retries:
+                return f
+            remaining = changes[len(acked) - sent:]
+            log.warn("Sending changes for %s failed (%s), retrying the last "
+                     "%i", branch, f.getErrorMessage(), len(remaining))
+            return task.deferLater(reactor, self.retryDelay,
+                                   self.sendWithRetries, branch, remaining,
+                                   acked, attempt + 1)
+        d.addErrback(failed)
+        return d
+
+
+def pollBranch(branch, state, config):
+    """Fetches new changes for branch if it's time to.
+
+    Returns the changes to send and the changeset to remember once they've
+    been sent, or None if there's nothing to do."""
     log.debug("Processing %s", branch)
-    master = config.get('main', 'master')
     if branch not in state:
         state[branch] = {'last_run': 0, 'last_changeset': None}
     branch_state = state[branch]
     interval = config.getint(branch, 'interval')
     if time.time() < (branch_state['last_run'] + interval):
         log.debug("Skipping %s, too soon since last run", branch)
-        return
+        return None
 
     branch_state['last_run'] = time.time()
 
@@ -129,32 +231,151 @@ def processBranch(branch, state, config):
         changes = getChanges(url, tips_only=tips_only,
                              last_changeset=last_changeset, ca_certs=ca_certs,
                              username=username, password=password)
-        # Do sendchanges!
-        for c in changes:
-            # Ignore off-default branches
-            if c['branch'] != 'default' and config.getboolean(branch, 'default_branch_only'):
-                log.info(
-                    "Skipping %s on branch %s", c['changeset'], c['branch'])
-                continue
-            # Change the comments to include the url to the revision
-            c['comments'] += ' %s/rev/%s' % (url, c['changeset'])
-            sendchange(master, branch, c)
-
     except urllib2.HTTPError, e:
         msg = e.fp.read()
         if e.code == 500 and 'unknown revision' in msg:
             log.info("%s Repo was reset, resetting last_changeset", branch)
             branch_state['last_changeset'] = None
-            return
+            return None
         else:
             raise
 
     if not changes:
         # Empty repo, or no new changes; nothing to do
+        return None
+
+    to_send = []
+    for c in changes:
+        # Ignore off-default branches
+        if c['branch'] != 'default' and config.getboolean(branch, 'default_branch_only'):
+            log.info(
+                "Skipping %s on branch %s", c['changeset'], c['branch'])
+            continue
+        # Change the comments to include the url to the revision
+        c['comments'] += ' %s/rev/%s' % (url, c['changeset'])
+        to_send.append(c)
+
+    return to_send, changes[-1]['changeset']
+
+
+def processBranch(branch, state, config):
+    result = pollBranch(branch, state, config)
+    if result is None:
         return
+    changes, last_changeset = result
+
+    # Do sendchanges!
+    master = config.get('main', 'master')
+    for c in changes:
+        sendchange(master, branch, c)
+
+    state[branch]['last_changeset'] = last_changeset
+
+
+def saveState(state, state_file):
+    # Write to a temporary file first so we never leave a truncated state
+    # file behind
+    tmp = state_file + '.tmp'
+    f = open(tmp, 'w')
+    try:
+        json.dump(state, f)
+    finally:
+        f.close()
+    os.rename(tmp, state_file)
+
+
+class PollDaemon(object):
+    """Polls branches concurrently until killed.
+
+    Each poll runs in the reactor's thread pool, and each branch's new
+    changes are sent over one connection to the master."""
+
+    def __init__(self, branches, state, config, sender=None):
+        self.branches = branches
+        self.state = state
+        self.config = config
+        self.sender = sender or ChangeSender(config.get('main', 'master'))
+        self.state_file = config.get('main', 'state_file')
+        # Branches with a poll or sendchange in progress
+        self.busy = set()
+        for branch in branches:
+            state.setdefault(branch, {'last_run': 0, 'last_changeset': None})
+
+    def gotChanges(self, result, branch):
+        if result is None:
+            return
+        changes, last_changeset = result
+        if not changes:
+            self.state[branch]['last_changeset'] = last_changeset
+            return
+        acked = []
+        d = self.sender.sendWithRetries(branch, changes, acked)
+
+        def sent(_):
+            self.state[branch]['last_changeset'] = last_changeset
+
+        def failed(f):
+            # Don't send the ones the master did get again next time
+            if acked:
+                self.state[branch]['last_changeset'] = \
+                    acked[-1]['changeset']
+            return f
+        d.addCallbacks(sent, failed)
+        return d
+
+    def pollFailed(self, f, branch):
+        log.error("Polling %s failed: %s", branch, f.getTraceback())
+
+    def pollDone(self, _, branch):
+        self.busy.discard(branch)
+
+    def pollAll(self):
+        """Polls every branch that isn't still busy, and saves the state once
+        they're done. Errors are logged, so the LoopingCall keeps going."""
+        d = defer.maybeDeferred(self._pollAll)
+        d.addErrback(self.pollAllFailed)
+        return d
+
+    def pollAllFailed(self, f):
+        log.error("Polling failed: %s", f.getTraceback())
+
+    def _pollAll(self):
+        dl = []
+        for branch in self.branches:
+            if branch in self.busy:
+                continue
+            self.busy.add(branch)
+            d = threads.deferToThread(pollBranch, branch, self.state,
+                                      self.config)
+            d.addCallback(self.gotChanges, branch)
+            d.addErrback(self.pollFailed, branch)
+            d.addBoth(self.pollDone, branch)
+            dl.append(d)
+        d = defer.DeferredList(dl)
+        d.addCallback(lambda _: saveState(self.state, self.state_file))
+        return d
+
+    def run(self):
+        reactor.suggestThreadPoolSize(self.config.getint('main',
+                                                         'concurrency'))
+        loop = task.LoopingCall(self.pollAll)
+        loop.start(self.config.getint('main', 'poll_interval'))
+        reactor.run()
+
+
+# Defaults for every section of the config file
+configDefaults = {
+    'tips_only': 'no',
+    'username': None,
+    'password': None,
+    'ca_certs': None,
+    'interval': 300,
+    'state_file': 'state.json',
+    'default_branch_only': "yes",
+    'concurrency': 8,
+    'poll_interval': 10,
+}
 
-    last_change = changes[-1]
-    branch_state['last_changeset'] = last_change['changeset']
 
 if __name__ == '__main__':
     from ConfigParser import RawConfigParser
@@ -168,20 +389,15 @@ if __name__ == '__main__':
     parser.add_option("-f", "--config-file", dest="config_file")
     parser.add_option("-v", "--verbose", dest="verbosity",
                       action="store_const", const=log.DEBUG)
+    parser.add_option("-d", "--daemon", dest="daemon", action="store_true",
+                      help="keep polling branches concurrently, and send "
+                      "changes to the master directly")
 
     options, args = parser.parse_args()
 
     log.basicConfig(format="%(message)s", level=options.verbosity)
 
-    config = RawConfigParser({
-        'tips_only': 'no',
-        'username': None,
-        'password': None,
-        'ca_certs': None,
-        'interval': 300,
-        'state_file': 'state.json',
-        'default_branch_only': "yes",
-    })
+    config = RawConfigParser(configDefaults)
     config.read(options.config_file)
 
     try:
@@ -190,8 +406,11 @@ if __name__ == '__main__':
         state = {}
 
     branches = [s for s in config.sections() if s != 'main']
-    for branch in branches:
-        processBranch(branch, state, config)
+    if options.daemon:
+        PollDaemon(branches, state, config).run()
+    else:
+        for branch in branches:
+            processBranch(branch, state, config)
 
-    # Save state
-    json.dump(state, open(config.get('main', 'state_file'), 'w'))
+        # Save state
+        saveState(state, config.get('main', 'state_file'))
@@ -0,0 +1,107 @@
+"""Remember how far change sources have got across master restarts.
+
+Pollers keep track of the last change they've seen in memory, so after a
+restart they have to start from scratch: HgPoller fetches the full default
+pushlog window just to find out where the repository is, and pushes made
+while the master was down are never reported. With a checkpoint file
+configured, pollers record their position in it and pick up from there when
+they're created again.
+
+This module isn't reloaded on reconfig, so enable it once from master.cfg:
+
+    from buildbotcustom.changes.checkpoints import checkpoints
+    checkpoints.configure(os.path.join(basedir, 'poller-checkpoints.json'))
+"""
+import os
+
+from twisted.python import log
+from twisted.internet import reactor
+
+from buildbot.util import json
+
+
+class CheckpointStore(object):
+    """A json file mapping poller keys to positions.
+
+    Updates are written out in batches, flushDelay seconds after the first
+    one, and when the reactor shuts down. Only the keys updated since the
+    last write are merged into the file, so several stores (or processes)
+    can share one."""
+
+    flushDelay = 5
+
+    def __init__(self, path=None):
+        self.path = None
+        self.data = None
+        self.dirty = {}
+        self.flushTimer = None
+        self.shutdownTrigger = None
+        if path:
+            self.configure(path)
+
+    def configure(self, path):
+        if path == self.path:
+            return
+        if self.dirty:
+            self.flush()
+        self.path = path
+        self.data = None
+        if self.shutdownTrigger is None:
+            self.shutdownTrigger = reactor.addSystemEventTrigger(
+                'before', 'shutdown', self.flush)
+
+    def load(self):
+        try:
+            return json.load(open(self.path))
+        except IOError:
+            # Not written yet
+            return {}
+
+    def get(self, key, default=None):
+        if not self.path:
+            return default
+        if key in self.dirty:
+            return self.dirty[key]
+        if self.data is None:
+            try:
+                self.data = self.load()
+            except Exception:
+                log.err(None, "couldn't read poller checkpoints from %s" %
+                        self.path)
+                self.data = {}
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        if not self.path or self.get(key) == value:
+            return
+        self.dirty[key] = value
+        if self.flushTimer is None:
+            self.flushTimer = reactor.callLater(self.flushDelay, self.flush)
+
+    def flush(self):
+        if self.flushTimer is not None:
+            if self.flushTimer.active():
+                self.flushTimer.cancel()
+            self.flushTimer = None
+        if not self.dirty or not self.path:
+            return
+        try:
+            data = self.load()
+            data.update(self.dirty)
+            tmp = self.path + '.tmp'
+            f = open(tmp, 'w')
+            try:
+                json.dump(data, f)
+            finally:
+                f.close()
+            os.rename(tmp, self.path)
+        except Exception:
+            # Keep the updates around for the next flush
+            log.err(None, "couldn't write poller checkpoints to %s" %
+                    self.path)
+            return
+        self.data = data
+        self.dirty = {}
+
+
+checkpoints = CheckpointStore()
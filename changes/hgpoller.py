@@ -85,22 +85,192 @@ which of the form
 }
 """
 
+import bisect
+import heapq
+import random
+import re
 import time
+from urlparse import urlparse
 
 from twisted.python import log
 from twisted.internet import defer, reactor
 from twisted.internet.task import LoopingCall
-from twisted.web.client import getPage
+from twisted.web import error
+from twisted.web.client import getPage, HTTPClientFactory, _makeGetterFactory
 
 from buildbot.changes import base, changes
 from buildbot.util import json
 
+from buildbotcustom.changes.checkpoints import checkpoints
+
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def _iter_pushes(data):
+    """Yields (pushid, push) for each push in the pushlog json in data,
+    decoding one push at a time"""
+    decoder = json.JSONDecoder()
+    ws = _whitespace.match
+    idx = ws(data, 0).end()
+    if data[idx:idx + 1] != '{':
+        # Let the regular parser complain about it
+        json.loads(data)
+        raise ValueError("pushlog isn't a json object")
+    idx = ws(data, idx + 1).end()
+    if data[idx:idx + 1] == '}':
+        return
+
+    while True:
+        pushid, idx = decoder.raw_decode(data, idx)
+        idx = ws(data, idx).end()
+        if data[idx:idx + 1] != ':':
+            break
+        idx = ws(data, idx + 1).end()
+        push, idx = decoder.raw_decode(data, idx)
+        yield pushid, push
+
+        idx = ws(data, idx).end()
+        c = data[idx:idx + 1]
+        if c == ',':
+            idx = ws(data, idx + 1).end()
+        elif c == '}' and ws(data, idx + 1).end() == len(data):
+            return
+        else:
+            break
+
+    # Malformed or truncated; let the regular parser generate the error
+    json.loads(data)
+    raise ValueError("malformed pushlog at offset %i" % idx)
+
+
+def _parse_changes(data, maxChanges=None, repo_branch=None,
+                   mergePushChanges=True):
+    """Returns the pushes in the pushlog json in data, sorted by push id.
+
+    If maxChanges is set, only the most recent pushes that BaseHgPoller
+    would look at with those settings are kept, so that memory use is bounded
+    no matter how large the pushlog is. These are the newest pushes with more
+    than maxChanges changes on repo_branch between them (counting each push
+    as one change if mergePushChanges is True), plus any newer pushes.
+    """
+    # min-heap of (push id, weight, push)
+    kept = []
+    weight = 0
+    for pushid, push in _iter_pushes(data):
+        if maxChanges is None:
+            push_weight = 0
+        elif repo_branch is None:
+            push_weight = len(push['changesets'])
+        else:
+            push_weight = len([c for c in push['changesets']
+                               if c['branch'] == repo_branch])
+        if mergePushChanges:
+            push_weight = min(push_weight, 1)
+
+        heapq.heappush(kept, (int(pushid), push_weight, push))
+        weight += push_weight
+        if maxChanges is not None:
+            # Drop the oldest pushes while we have enough changes without
+            # them
+            while weight - kept[0][1] > maxChanges:
+                weight -= heapq.heappop(kept)[1]
+
+    kept.sort()
+    return [push for (_, _, push) in kept]
+
+
+class PushlogFetcher(object):
+    """Fetches pushlogs on behalf of all the pollers on a master.
+
+    The ETag and Last-Modified headers of the last response for each poller
+    are sent back with the next request for the same URL, so that servers
+    can answer with a bodyless 304 when nothing has been pushed. They're only
+    used once the poller has called saveValidators to say it processed that
+    response. The number of concurrent requests to each host is limited to
+    maxPerHost.
+    """
+    maxPerHost = 4
+
+    def __init__(self):
+        # poller key -> (url, etag, last-modified)
+        self.validators = {}
+        # poller key -> validators from the response it's processing, or
+        # None if it didn't have any
+        self.pending = {}
+        # host -> DeferredSemaphore
+        self.semaphores = {}
+        # counters of requests, responses, 304s and bytes received
+        self.stats = {'requests': 0, 'pages': 0, 'not_modified': 0,
+                      'bytes': 0}
+
+    def getPage(self, url, key, timeout=None):
+        """Returns a Deferred that fires with the contents of url, or with
+        None if the server says it hasn't changed since the last time the
+        poller identified by key fetched it."""
+        host = urlparse(url)[1]
+        sem = self.semaphores.get(host)
+        if sem is None:
+            sem = self.semaphores[host] = defer.DeferredSemaphore(
+                self.maxPerHost)
+        return sem.run(self._getPage, url, key, timeout)
+
+    def _getPage(self, url, key, timeout):
+        headers = {}
+        lastURL, etag, lastModified = self.validators.get(key,
+                                                          (None, None, None))
+        if lastURL == url:
+            if etag:
+                headers['If-None-Match'] = etag
+            if lastModified:
+                headers['If-Modified-Since'] = lastModified
+
+        self.stats['requests'] += 1
+        factory = _makeGetterFactory(url, HTTPClientFactory, timeout=timeout,
+                                     headers=headers)
+
+        def gotPage(page):
+            response_headers = factory.response_headers or {}
+            etag = response_headers.get('etag', [None])[0]
+            lastModified = response_headers.get('last-modified', [None])[0]
+            if etag or lastModified:
+                self.pending[key] = (url, etag, lastModified)
+            else:
+                self.pending[key] = None
+            self.stats['pages'] += 1
+            self.stats['bytes'] += len(page)
+            return page
+
+        def notModified(f):
+            f.trap(error.Error)
+            if f.value.status != '304':
+                return f
+            self.stats['not_modified'] += 1
+            return None
+
+        d = factory.deferred
+        d.addCallbacks(gotPage, notModified)
+        return d
+
+    def saveValidators(self, key):
+        """Use the validators of the last page fetched for key in its next
+        request, now that the page has been processed."""
+        if key not in self.pending:
+            return
+        validators = self.pending.pop(key)
+        if validators:
+            self.validators[key] = validators
+        else:
+            self.validators.pop(key, None)
+
+    def discardValidators(self, key):
+        """Forget the validators of the last page fetched for key, which
+        couldn't be processed."""
+        self.pending.pop(key, None)
+
 
-def _parse_changes(data):
-    pushes = json.loads(data).values()
-    # Sort by push date
-    pushes.sort(key=lambda p: p['date'])
-    return pushes
+# Shared by all the pollers on this master
+fetcher = PushlogFetcher()
 
 
 class Pluggable(object):
@@ -213,12 +383,19 @@ class BaseHgPoller(BasePoller):
         self.mergePushChanges = mergePushChanges
 
         self.emptyRepo = False
+        # Pick up where we left off before a restart, if we know
+        self.lastChangeset = checkpoints.get(self.checkpointKey())
+
+    def checkpointKey(self):
+        return " ".join(("hg", self.pushlogUrlOverride or self.baseURL,
+                         self.branch, str(self.repo_branch)))
 
     def getData(self):
         url = self._make_url()
         if self.verbose:
             log.msg("Polling Hg server at %s" % url)
-        return getPage(url, timeout=self.timeout)
+        return fetcher.getPage(url, self.checkpointKey(),
+                               timeout=self.timeout)
 
     def _make_url(self):
         url = None
@@ -241,7 +418,12 @@ class BaseHgPoller(BasePoller):
 
         return str(url)
 
+    def dataFinished(self, res):
+        fetcher.saveValidators(self.checkpointKey())
+        return self.super_class.dataFinished(self, res)
+
     def dataFailed(self, res):
+        fetcher.discardValidators(self.checkpointKey())
         # XXX: disabled for bug 774862
         # if hasattr(res.value, 'status') and res.value.status == '500' and \
                 #'unknown revision' in res.value.response:
@@ -255,7 +437,13 @@ class BaseHgPoller(BasePoller):
         return self.super_class.dataFailed(self, res)
 
     def processData(self, query):
-        pushes = _parse_changes(query)
+        if query is None:
+            # The pushlog hasn't changed since our last poll
+            if self.verbose:
+                log.msg("%s not modified" % self.baseURL)
+            return
+        pushes = _parse_changes(query, self.maxChanges, self.repo_branch,
+                                self.mergePushChanges)
         if len(pushes) == 0:
             if self.lastChangeset is None:
                 # We don't have a lastChangeset, and there are no changes.  Assume
@@ -392,6 +580,7 @@ class BaseHgPoller(BasePoller):
         # branch or not. This is so we don't have to constantly ignore it in
         # future polls.
         self.lastChangeset = pushes[-1]["changesets"][-1]["node"]
+        checkpoints.set(self.checkpointKey(), self.lastChangeset)
         if self.verbose:
             log.msg("last changeset %s on %s" %
                     (self.lastChangeset, self.baseURL))
@@ -464,18 +653,278 @@ class HgPoller(base.ChangeSource, BaseHgPoller):
                 self.storeRev, change.revision, 'HgPoller')
 
 
+class MultiHgPollerTarget(BaseHgPoller):
+    """This helper class for MultiHgPoller polls a single repository and
+    reports back to its parent when it's done."""
+
+    def __init__(self, parent, hgURL, branch, repo_branch="default",
+                 storeRev=None, **kwargs):
+        BaseHgPoller.__init__(self, hgURL, branch, repo_branch=repo_branch,
+                              **kwargs)
+        self.parent = parent
+        self.storeRev = storeRev
+        self.interval = parent.pollInterval
+        self.nextPoll = 0
+        self.polledFrom = None
+        self.polling = False
+        # Set when we're told about a push while a poll is in progress
+        self.notified = False
+
+    def poll(self):
+        if self.polling and self.attempts <= self.attemptLimit:
+            # The last poll will call pollDone when it finishes, so don't let
+            # BasePoller call it now
+            self.attempts += 1
+            log.msg("Not polling %s because last poll is still working" %
+                    self)
+            return
+        self.polledFrom = self.lastChangeset
+        self.polling = True
+        return BaseHgPoller.poll(self)
+
+    def changeHook(self, change):
+        if self.storeRev:
+            change.properties.setProperty(
+                self.storeRev, change.revision, 'MultiHgPoller')
+
+    def pollDone(self, res):
+        # We only know there were new pushes if we knew where we were before
+        changed = self.polledFrom is not None and \
+            self.lastChangeset != self.polledFrom
+        self.polling = False
+        self.parent.pollerDone(self, changed)
+
+    def __str__(self):
+        return "<MultiHgPollerTarget for %s>" % self.baseURL
+
+
+class MultiHgPoller(base.ChangeSource):
+    """Poll a set of hg repositories from a single timer.
+
+    Polls are spread evenly across pollInterval when the service starts, and
+    each one is rescheduled with some random jitter after it finishes, so
+    repositories don't get polled at the same instant. A repository that has
+    new pushes is next polled after minInterval; every poll that finds
+    nothing new backs its interval off by a factor of `backoff`, up to
+    maxInterval. Busy repositories end up polled often, quiet ones rarely.
+    """
+
+    compare_attrs = ['targets', 'pollInterval', 'minInterval', 'maxInterval']
+    parent = None
+    loop = None
+    volatile = ['loop']
+
+    # How often to check which repositories are due to be polled
+    tickInterval = 1
+    # Fraction of the interval to randomly add or subtract
+    jitter = 0.1
+    backoff = 1.5
+
+    def __init__(self, targets, pollInterval=30, minInterval=None,
+                 maxInterval=None):
+        """
+        @type  targets:       list of dicts
+        @param targets:       The repositories to poll. Each dict holds the
+                              keyword arguments for one repository, e.g.
+                              hgURL, branch, repo_branch, storeRev,
+                              pushlogUrlOverride, tipsOnly and maxChanges,
+                              with the same meaning as for HgPoller
+        @type  pollInterval:  int
+        @param pollInterval:  The time (in seconds) between the first polls
+                              of each repository
+        @type  minInterval:   int
+        @param minInterval:   The shortest time (in seconds) between polls of
+                              a repository. Defaults to pollInterval
+        @type  maxInterval:   int
+        @param maxInterval:   The longest time (in seconds) between polls of
+                              a repository. Defaults to pollInterval
+        """
+        self.targets = targets
+        self.pollInterval = pollInterval
+        self.minInterval = minInterval or pollInterval
+        self.maxInterval = maxInterval or pollInterval
+        self.pollers = [MultiHgPollerTarget(self, **t) for t in targets]
+
+    def startService(self):
+        # Spread the first polls evenly across pollInterval
+        now = time.time()
+        spacing = 0
+        if self.pollers:
+            spacing = float(self.pollInterval) / len(self.pollers)
+        for i, poller in enumerate(self.pollers):
+            poller.interval = self.pollInterval
+            poller.nextPoll = now + spacing * i
+        self.loop = LoopingCall(self.tick)
+        base.ChangeSource.startService(self)
+        reactor.callLater(0, self.loop.start, self.tickInterval)
+
+    def stopService(self):
+        if self.running:
+            self.loop.stop()
+        return base.ChangeSource.stopService(self)
+
+    def tick(self):
+        now = time.time()
+        for poller in self.pollers:
+            if poller.nextPoll <= now:
+                # Don't poll it again until pollerDone reschedules it
+                poller.nextPoll = now + self.maxInterval
+                poller.poll()
+
+    def pollerDone(self, poller, changed):
+        if changed:
+            poller.interval = self.minInterval
+        else:
+            poller.interval = min(self.maxInterval,
+                                  poller.interval * self.backoff)
+        poller.nextPoll = time.time() + poller.interval * \
+            random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def addChange(self, change):
+        self.parent.addChange(change)
+
+    def describe(self):
+        return "Getting changes from: %s" % \
+            ", ".join(p.baseURL for p in self.pollers)
+
+    def __str__(self):
+        return "<MultiHgPoller for %i repositories>" % len(self.pollers)
+
+
+class HgPushNotificationPoller(MultiHgPoller):
+    """Get changes from a set of hg repositories as soon as we're notified
+    of pushes to them.
+
+    Notifications are read from queuedir, which should be a
+    mozilla_buildtools.queuedir.QueueDir instance that something like a pulse
+    consumer writes to. Each entry is a json object like
+    {"repo_url": "https://hg.mozilla.org/try"}; any other keys are ignored.
+    A notification makes us poll the pushlog of that repository on the next
+    tick, from our lastChangeset as usual, so changes are reported exactly
+    the same way HgPoller would report them. Notifications for one
+    repository that arrive while it's being polled are coalesced into a
+    single poll once the current one is done.
+
+    Every repository is also polled every reconcileInterval seconds, to pick
+    up pushes whose notifications were lost.
+    """
+
+    # queuedir isn't compared: a new QueueDir is made on every reconfig,
+    # and we'd lose every repository's lastChangeset if we were replaced
+    compare_attrs = MultiHgPoller.compare_attrs
+
+    def __init__(self, targets, queuedir, pollInterval=30,
+                 reconcileInterval=600):
+        """
+        @type  targets:           list of dicts
+        @param targets:           The repositories to poll, as for
+                                  MultiHgPoller
+        @type  queuedir:          QueueDir
+        @param queuedir:          Where push notifications are read from
+        @type  pollInterval:      int
+        @param pollInterval:      The time (in seconds) to spread the first
+                                  polls of each repository across
+        @type  reconcileInterval: int
+        @param reconcileInterval: The longest time (in seconds) between polls
+                                  of a repository we've not been notified
+                                  about
+        """
+        MultiHgPoller.__init__(self, targets, pollInterval=pollInterval,
+                               minInterval=reconcileInterval,
+                               maxInterval=reconcileInterval)
+        self.queuedir = queuedir
+        self.reconcileInterval = reconcileInterval
+        self.pollersByURL = {}
+        for poller in self.pollers:
+            self.pollersByURL[poller.baseURL.rstrip('/')] = poller
+
+    def tick(self):
+        self.readNotifications()
+        MultiHgPoller.tick(self)
+
+    def readNotifications(self):
+        while True:
+            item = self.queuedir.pop()
+            if not item:
+                return
+            item_id, fp = item
+            try:
+                try:
+                    url = json.load(fp)['repo_url']
+                finally:
+                    fp.close()
+            except Exception:
+                log.err(None, "%s: couldn't read notification %s" %
+                        (self, item_id))
+                self.queuedir.murder(item_id)
+                continue
+            self.queuedir.remove(item_id)
+            self.notify(url)
+
+    def notify(self, url):
+        poller = self.pollersByURL.get(str(url).rstrip('/'))
+        if poller is None:
+            return
+        log.msg("%s: notified of push to %s" % (self, url))
+        if poller.polling:
+            poller.notified = True
+        else:
+            poller.nextPoll = 0
+
+    def pollerDone(self, poller, changed):
+        if poller.notified:
+            # We've been told about a push since this poll started
+            poller.notified = False
+            poller.nextPoll = 0
+        else:
+            poller.interval = self.reconcileInterval
+            poller.nextPoll = time.time() + poller.interval * \
+                random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def describe(self):
+        return "Getting changes from %s on notification" % \
+            ", ".join(p.baseURL for p in self.pollers)
+
+    def __str__(self):
+        return "<HgPushNotificationPoller for %i repositories>" % \
+            len(self.pollers)
+
+
 class HgLocalePoller(BaseHgPoller):
     """This helper class for HgAllLocalesPoller polls a single locale and
     submits changes if necessary."""
 
     timeout = 30
     verbose = False
+    # Upper bounds (in seconds) of the load time histogram buckets; the last
+    # bucket counts everything slower
+    latencyBuckets = (1, 2, 5, 10, 30)
 
     def __init__(self, locale, parent, branch, hgURL):
         BaseHgPoller.__init__(self, hgURL, branch, tree=locale)
         self.locale = locale
         self.parent = parent
         self.branch = branch
+        # Number of consecutive failed polls
+        self.failures = 0
+        # Number of upcoming passes over all locales to leave this one out of
+        self.skip = 0
+        self.latencies = [0] * (len(self.latencyBuckets) + 1)
+
+    def dataFinished(self, res):
+        self.failures = 0
+        if self.loadTime is not None:
+            self.latencies[bisect.bisect_left(self.latencyBuckets,
+                                              self.loadTime)] += 1
+        return BaseHgPoller.dataFinished(self, res)
+
+    def dataFailed(self, res):
+        self.failures += 1
+        # Back off from repositories that keep failing, by leaving them out
+        # of the next 0, 1, 3, 7, ... passes
+        self.skip = min(2 ** (self.failures - 1) - 1,
+                        self.parent.maxSkippedPasses)
+        return BaseHgPoller.dataFailed(self, res)
 
     def changeHook(self, change):
         change.properties.setProperty('locale', self.locale, 'HgLocalePoller')
@@ -498,16 +947,21 @@ class HgAllLocalesPoller(base.ChangeSource, BasePoller):
     as branch for the changes, i.e. 'releases/l10n-mozilla-1.9.1'.
     """
 
-    compare_attrs = ['repositoryIndex', 'pollInterval']
+    compare_attrs = ['repositoryIndex', 'pollInterval', 'parallelRequests',
+                     'maxParallelRequests']
     parent = None
     loop = None
     volatile = ['loop']
 
     timeout = 10
     parallelRequests = 2
+    # Requests to one host are also limited by fetcher.maxPerHost
+    maxParallelRequests = 4
+    maxSkippedPasses = 15
     verboseChilds = False
 
-    def __init__(self, hgURL, repositoryIndex, pollInterval=120, branch=None):
+    def __init__(self, hgURL, repositoryIndex, pollInterval=120, branch=None,
+                 parallelRequests=None, maxParallelRequests=None):
         """
         @type  repositoryIndex:      string
         @param repositoryIndex:      The URL listing all locale repos
@@ -516,6 +970,16 @@ class HgAllLocalesPoller(base.ChangeSource, BasePoller):
                                    changes
         @type  branch:      string
         @param branch:      Used by caller to uniquely identify this object
+        @type  parallelRequests:    int
+        @param parallelRequests:    How many locales to poll at once to start
+                                    with
+        @type  maxParallelRequests: int
+        @param maxParallelRequests: How many locales we may poll at once.
+                                    Parallelism goes up by one after every
+                                    pass over the locales that took longer
+                                    than pollInterval, up to this, and is
+                                    halved after every pass where more than
+                                    a tenth of the locales failed
         """
 
         BasePoller.__init__(self)
@@ -528,7 +992,13 @@ class HgAllLocalesPoller(base.ChangeSource, BasePoller):
         self.locales = []
         self.pendingLocales = []
         self.activeRequests = 0
+        self.polledLocales = []
         self.branch = branch
+        if parallelRequests is not None:
+            self.parallelRequests = parallelRequests
+        if maxParallelRequests is not None:
+            self.maxParallelRequests = maxParallelRequests
+        self.parallelism = self.parallelRequests
 
     def startService(self):
         self.loop = LoopingCall(self.poll)
@@ -574,14 +1044,26 @@ class HgAllLocalesPoller(base.ChangeSource, BasePoller):
         if locales != self.locales:
             log.msg("new locale list: " + " ".join(map(str, locales)))
         self.locales = locales
-        self.pendingLocales = locales[:]
         # prune removed locales from pollers
         for oldLoc in self.localePollers.keys():
             if oldLoc not in locales:
                 self.localePollers.pop(oldLoc)
                 log.msg("not polling %s on %s anymore, dropped from repositories" %
                         oldLoc)
-        for i in xrange(self.parallelRequests):
+        self.pendingLocales = []
+        for loc in locales:
+            poller = self.getLocalePoller(*loc)
+            if poller.skip:
+                poller.skip -= 1
+                continue
+            self.pendingLocales.append(loc)
+        if len(self.pendingLocales) < len(locales):
+            log.msg("%s: backing off from %d failing locales" %
+                    (self, len(locales) - len(self.pendingLocales)))
+        self.polledLocales = self.pendingLocales[:]
+        # We always need one to notice that we're done
+        for i in xrange(max(1, min(self.parallelism,
+                                   len(self.pendingLocales)))):
             self.activeRequests += 1
             reactor.callLater(0, self.pollNextLocale)
 
@@ -589,26 +1071,55 @@ class HgAllLocalesPoller(base.ChangeSource, BasePoller):
         if not self.pendingLocales:
             self.activeRequests -= 1
             if not self.activeRequests:
-                msg = "%s done with all locales" % str(self)
-                loadTimes = map(
-                    lambda p: p.loadTime, self.localePollers.values())
-                goodTimes = filter(lambda t: t is not None, loadTimes)
-                if not goodTimes:
-                    msg += ". All %d locale pollers failed" % len(loadTimes)
-                else:
-                    msg += ", min: %.1f, max: %.1f, mean: %.1f" % \
-                        (min(goodTimes), max(goodTimes),
-                         sum(goodTimes) / len(goodTimes))
-                    if len(loadTimes) > len(goodTimes):
-                        msg += ", %d failed" % (
-                            len(loadTimes) - len(goodTimes))
-                log.msg(msg)
-                log.msg("Total time: %.1f" % (time.time() - self.startLoad))
+                self.allLocalesDone()
             return
         loc, branch = self.pendingLocales.pop(0)
         poller = self.getLocalePoller(loc, branch)
         poller.poll()
 
+    def allLocalesDone(self):
+        pollers = [self.localePollers[loc] for loc in self.polledLocales
+                   if loc in self.localePollers]
+        msg = "%s done with all locales" % str(self)
+        loadTimes = map(lambda p: p.loadTime, pollers)
+        goodTimes = filter(lambda t: t is not None, loadTimes)
+        failed = len(loadTimes) - len(goodTimes)
+        if not goodTimes:
+            msg += ". All %d locale pollers failed" % len(loadTimes)
+        else:
+            msg += ", min: %.1f, max: %.1f, mean: %.1f" % \
+                (min(goodTimes), max(goodTimes),
+                 sum(goodTimes) / len(goodTimes))
+            if failed:
+                msg += ", %d failed" % failed
+        log.msg(msg)
+        totalTime = time.time() - self.startLoad
+        log.msg("Total time: %.1f" % totalTime)
+
+        # Histogram of all the load times we've seen, and the locales that
+        # have been slowest to load so far
+        buckets = HgLocalePoller.latencyBuckets
+        latencies = [0] * (len(buckets) + 1)
+        for p in self.localePollers.values():
+            latencies = map(sum, zip(latencies, p.latencies))
+        labels = ["<%ss" % b for b in buckets] + [">%ss" % buckets[-1]]
+        log.msg("%s load times: %s" % (self, ", ".join(
+            "%s: %d" % (l, n) for (l, n) in zip(labels, latencies))))
+        slow = [p for p in self.localePollers.values() if p.latencies[-1]]
+        if slow:
+            log.msg("%s slow locales: %s" % (self, ", ".join(
+                "%s (%d)" % (p.locale, p.latencies[-1]) for p in slow)))
+
+        if failed * 10 > len(loadTimes):
+            self.parallelism = max(1, self.parallelism // 2)
+        elif totalTime > self.pollInterval:
+            self.parallelism = min(self.maxParallelRequests,
+                                   self.parallelism + 1)
+        else:
+            return
+        log.msg("%s: now polling %d locales at once" %
+                (self, self.parallelism))
+
     def localeDone(self, loc):
         if self.verboseChilds:
             log.msg("done with " + loc)
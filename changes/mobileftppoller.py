@@ -8,6 +8,8 @@ from twisted.internet.task import LoopingCall
 
 from buildbot.changes import base, changes
 
+from buildbotcustom.changes.checkpoints import checkpoints
+
 
 class InvalidResultError(Exception):
     def __init__(self, value="InvalidResultError"):
@@ -92,7 +94,7 @@ class MobileFtpPoller(base.ChangeSource):
         self.pollInterval = pollInterval
         self.lastChanges = {}
         for url in self.ftpURLs:
-            self.lastChanges[url] = time.time()
+            self.lastChanges[url] = checkpoints.get("ftp " + url, time.time())
         self.searchString = searchString
         self.idleTimeout = idleTimeout
         self.idleTimer = None
@@ -201,3 +203,6 @@ class MobileFtpPoller(base.ChangeSource):
                                when=buildDate,)
             self.parent.addChange(c)
             log.msg("found a browser to test (%s)" % (fullpath))
+
+        if url in self.ftpURLs:
+            checkpoints.set("ftp " + url, self.lastChanges[url])
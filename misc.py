@@ -11,14 +11,19 @@ import random
 import re
 import sys
 import os
+import threading
 from copy import deepcopy
-import inspect
+import weakref
 from functools import wraps
 
 from twisted.python import log
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+from twisted.web.client import getPage
 
 from buildbot.scheduler import Nightly, Scheduler, Triggerable
 from buildbot.schedulers.filter import ChangeFilter
+from buildbot.status.base import StatusReceiver
 from buildbot.steps.shell import WithProperties
 from buildbot.status.builder import SUCCESS, WARNINGS, FAILURE, EXCEPTION, RETRY
 from buildbot.util import now
@@ -112,6 +117,73 @@ def get_locales_from_json(jsonFile, l10nRepoPath, relbranch):
 
     return (l10nRepositories, platformLocales)
 
+
+class ChangeClassifier(object):
+    """Remembers what predicates such as fileIsImportant functions said about
+    changes.
+
+    Every scheduler on a master gets offered every change, and many of them
+    use equivalent predicates, so results are stored by the predicate's
+    function and arguments along with the change number. The least recently
+    used results are dropped once there are more than maxSize of them.
+    Changes without a number haven't been stored yet and aren't cached.
+
+    Schedulers call fileIsImportant from database threads, so the results
+    are only touched with lock held. Predicates are run without it.
+    """
+
+    def __init__(self, maxSize=10000):
+        self.maxSize = maxSize
+        self.results = collections.OrderedDict()
+        self.stats = collections.defaultdict(int)
+        self.lock = threading.Lock()
+
+    def lookup(self, key, change, func, *args):
+        """Returns func(change, *args), where key identifies func and args"""
+        number = getattr(change, 'number', None)
+        if number is None:
+            with self.lock:
+                self.stats['uncached'] += 1
+            return func(change, *args)
+
+        k = (key, number)
+        with self.lock:
+            if k in self.results:
+                self.stats['hits'] += 1
+                result = self.results.pop(k)
+                self.results[k] = result
+                return result
+            self.stats['misses'] += 1
+
+        result = func(change, *args)
+        with self.lock:
+            # Another thread may have got here first
+            self.results.pop(k, None)
+            if len(self.results) >= self.maxSize:
+                self.results.popitem(last=False)
+                self.stats['evictions'] += 1
+            self.results[k] = result
+        return result
+
+    def predicate(self, func, *args):
+        """Returns a function of a change that returns func(change, *args),
+        sharing results with every other predicate made from the same func
+        and args"""
+        key = (func, args)
+
+        def classify(change):
+            return self.lookup(key, change, func, *args)
+        return classify
+
+    def hitRate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        if not lookups:
+            return 0.0
+        return float(self.stats['hits']) / lookups
+
+
+changeClassifier = ChangeClassifier()
+
 # This function is used as fileIsImportant parameter for Buildbots that do both
 # dep/nightlies and release builds. Because they build the same "branch" this
 # allows us to have the release builder ignore HgPoller triggered changse
@@ -155,17 +227,29 @@ _product_excludes = {
 }
 
 
+# Each product's exclude list combined into a single regular expression
+_product_exclude_res = dict(
+    (product, re.compile("|".join("(?:%s)" % e.pattern for e in excludes)))
+    for product, excludes in _product_excludes.iteritems())
+
+
 def isImportantForProduct(change, product):
     """Handles product specific handling of important files"""
-    # For each file, check each product's exclude list
+    # Every scheduler for the product asks about the same change, so only
+    # look at its files once
+    return changeClassifier.lookup((isImportantForProduct, product), change,
+                                   _isImportantForProduct, product)
+
+
+def _isImportantForProduct(change, product):
+    # For each file, check it against the product's exclude list
     # If a file is not excluded, then the change is important
     # If all files are excluded, then the change is not important
     # As long as hgpoller's 'overflow' marker isn't excluded, it will cause all
     # products to build
-    excludes = _product_excludes.get(product, [])
+    exclude = _product_exclude_res.get(product)
     for f in change.files:
-        excluded = any(e.search(f) for e in excludes)
-        if not excluded:
+        if exclude is None or not exclude.search(f):
             log.msg("%s important for %s because of %s" % (
                 change.revision, product, f))
             return True
@@ -176,17 +260,19 @@ def isImportantForProduct(change, product):
     return False
 
 
+def _isImportant(c, hgurl, product):
+    if not isHgPollerTriggered(c, hgurl):
+        return False
+    if not shouldBuild(c):
+        return False
+    # No product is specified, so all changes are important
+    if product is None:
+        return True
+    return isImportantForProduct(c, product)
+
+
 def makeImportantFunc(hgurl, product):
-    def isImportant(c):
-        if not isHgPollerTriggered(c, hgurl):
-            return False
-        if not shouldBuild(c):
-            return False
-        # No product is specified, so all changes are important
-        if product is None:
-            return True
-        return isImportantForProduct(c, product)
-    return isImportant
+    return changeClassifier.predicate(_isImportant, hgurl, product)
 
 
 def isImportantL10nFile(change, l10nModules):
@@ -234,31 +320,110 @@ def generateTestBuilderNames(name_prefix, suites_name, suites):
     return test_builders
 
 
-def _getLastTimeOnBuilder(builder, slavename):
-    # New builds are at the end of the buildCache, so
-    # examine it backwards
-    buildNumbers = reversed(sorted(builder.builder_status.buildCache.keys()))
-    for buildNumber in buildNumbers:
-        try:
-            build = builder.builder_status.buildCache[buildNumber]
-            # Skip non-successful builds
-            if build.getResults() != 0:
+class LastSuccessIndex(StatusReceiver):
+    """Keeps track of when each slave last finished a successful build on a
+    builder.
+
+    The index is seeded from the builder's buildCache, and then kept up to
+    date from buildFinished events, so looking up a slave's last successful
+    build is a dict lookup rather than a walk over the cache.
+    """
+    def __init__(self, name, builder_status):
+        self.name = name
+        # The builder status holds on to us while we're subscribed, so don't
+        # keep it alive ourselves
+        self.builder_status = weakref.ref(builder_status)
+        # slavename -> time the last successful build finished
+        self.times = {}
+        self.seed(builder_status)
+
+    def seed(self, builder_status):
+        for buildNumber in builder_status.buildCache.keys():
+            try:
+                build = builder_status.buildCache[buildNumber]
+            except KeyError:
                 continue
-            if build.slavename == slavename:
-                return build.finished
-        except KeyError:
-            continue
-    return None
+            if build.getResults() == SUCCESS:
+                self.update(build)
+
+    def subscribe(self):
+        builder_status = self.builder_status()
+        if builder_status is None or \
+                _lastSuccessIndexes.get(self.name) is not self:
+            # We've been replaced already
+            return
+        builder_status.subscribe(self)
+        # Pick up any builds that finished between seeding and subscribing
+        self.seed(builder_status)
+
+    def unsubscribe(self):
+        builder_status = self.builder_status()
+        if builder_status is not None and self in builder_status.watchers:
+            builder_status.unsubscribe(self)
+
+    def update(self, build):
+        finished = build.finished
+        if finished is None:
+            return
+        if finished > self.times.get(build.slavename):
+            self.times[build.slavename] = finished
+
+    def buildFinished(self, builderName, build, results):
+        if results == SUCCESS:
+            self.update(build)
+
+
+# builder name -> LastSuccessIndex. misc.py is reloaded on reconfig, so keep
+# the indexes from before, which are still subscribed to their builders.
+try:
+    _lastSuccessIndexes
+except NameError:
+    _lastSuccessIndexes = {}
+
+
+def _getLastSuccessTimes(builder):
+    """Returns a dict of slavename -> time the slave last finished a
+    successful build on builder"""
+    builder_status = builder.builder_status
+    old = _lastSuccessIndexes.get(builder.name)
+    if old is not None and old.builder_status() is builder_status:
+        return old.times
+    index = LastSuccessIndex(builder.name, builder_status)
+    _lastSuccessIndexes[builder.name] = index
+    # We're called from nextSlave functions, which run in database threads,
+    # while the reactor may be walking the watchers
+    reactor.callFromThread(index.subscribe)
+    if old is not None:
+        # The builder was replaced on a reconfig
+        reactor.callFromThread(old.unsubscribe)
+    return index.times
+
+
+def _getLastTimeOnBuilder(builder, slavename):
+    return _getLastSuccessTimes(builder).get(slavename)
 
 
 def _recentSort(builder):
+    times = _getLastSuccessTimes(builder)
+
     def sortfunc(s1, s2):
-        t1 = _getLastTimeOnBuilder(builder, s1.slave.slavename)
-        t2 = _getLastTimeOnBuilder(builder, s2.slave.slavename)
+        t1 = times.get(s1.slave.slavename)
+        t2 = times.get(s2.slave.slavename)
         return cmp(t1, t2)
     return sortfunc
 
 
+def _mostRecentSlave(builder, slaves):
+    """Returns the slave that most recently finished a successful build on
+    builder, or None if slaves is empty"""
+    if not slaves:
+        return None
+    times = _getLastSuccessTimes(builder)
+    # Iterate backwards so that ties go to the last slave, as they would when
+    # sorting with _recentSort
+    return max(reversed(slaves), key=lambda s: times.get(s.slave.slavename))
+
+
 def safeNextSlave(func):
     """Wrapper around nextSlave functions that catch exceptions , log them, and
     choose a random slave instead"""
@@ -286,6 +451,18 @@ class JacuzziAllocator(object):
     >>> J = JacuzziAllocator()
     >>> builder['nextSlave'] = J(my_next_slave_func)
 
+    By default results are fetched synchronously when the cache is empty or
+    expired. Calling start_refresh() switches the instance to background
+    refresh mode: the caches are kept warm from a LoopingCall, and
+    get_slaves/get_unallocated_slaves only ever read the in-memory snapshot.
+    Expired entries keep being served until the next refresh replaces them.
+
+    If ALLOCATIONS_URL is set, the complete builder -> slaves mapping is
+    loaded from it in a single request instead of looking up each builder and
+    allocated/all separately. The response is expected to look like
+    {"builders": {"<buildername>": ["<slavename>", ...], ...}}. Any URL
+    urllib2 understands may be used, e.g. a file:// URL for testing.
+
     Attributes:
         BASE_URL (str): Base URL to use for the service
         CACHE_MAXAGE (int): Time in seconds to cache results from service,
@@ -298,6 +475,12 @@ class JacuzziAllocator(object):
             to 10
         HTTP_TIMEOUT (int): How long to wait for a response from the service,
             in seconds, defaults to 10
+        REFRESH_INTERVAL (int): How often to refresh the caches in background
+            refresh mode, in seconds, defaults to CACHE_MAXAGE
+        REFRESH_CONCURRENCY (int): Maximum number of concurrent requests to
+            the service during a background refresh, defaults to 4
+        ALLOCATIONS_URL (str): URL to load all builder allocations from in
+            bulk, defaults to None (look up builders individually)
     """
     BASE_URL = "http://jacuzzi-allocator.pub.build.mozilla.org/v1"
     CACHE_MAXAGE = 300  # 5 minutes
@@ -305,6 +488,9 @@ class JacuzziAllocator(object):
     MAX_TRIES = 3  # Try up to 3 times
     SLEEP_TIME = 10  # Wait 10s between tries
     HTTP_TIMEOUT = 10  # Timeout http fetches in 10s
+    REFRESH_INTERVAL = CACHE_MAXAGE
+    REFRESH_CONCURRENCY = 4
+    ALLOCATIONS_URL = None
 
     def __init__(self):
         # Cache of builder name -> (timestamp, set of slavenames)
@@ -316,8 +502,25 @@ class JacuzziAllocator(object):
         # Cache of builder name -> timestamp
         self.missing_cache = {}
 
+        # Bulk allocations; see load_allocations()
+        # (timestamp, builder name -> set of slavenames,
+        #  slavename -> set of builder names)
+        self.allocations = None
+        # Don't retry fetching bulk allocations until this time
+        self.allocations_retry_time = 0
+
         self.jacuzzi_enabled = True
 
+        # Background refresh state; see start_refresh()
+        self.refresh_loop = None
+        self.refreshing = False
+        self.refresh_pending = False
+        self.last_refresh = None
+        # Builder names we've been asked about, and should keep fresh
+        self.known_builders = set()
+        # Counters of cache hits, stale hits, misses, etc.
+        self.stats = collections.defaultdict(int)
+
         self.log("created")
 
     def log(self, msg, exc_info=False):
@@ -344,6 +547,25 @@ class JacuzziAllocator(object):
         if not self.jacuzzi_enabled:
             return available_slaves
 
+        if self.ALLOCATIONS_URL:
+            allocations = self.get_allocations()
+            if allocations is None:
+                return available_slaves
+            builders, slaves = allocations
+            return [s for s in available_slaves if s.slave.slavename not in slaves]
+
+        if self.refresh_loop is not None:
+            # Background refresh mode; never do any I/O here
+            if self.allocated_cache is None:
+                self.stats['allocated_miss'] += 1
+                return available_slaves
+            cache_expiry_time, slaves = self.allocated_cache
+            if cache_expiry_time > time.time():
+                self.stats['allocated_hit'] += 1
+            else:
+                self.stats['allocated_stale'] += 1
+            return [s for s in available_slaves if s.slave.slavename not in slaves]
+
         self.log("checking cache allocated slaves")
         if self.allocated_cache:
             cache_expiry_time, slaves = self.allocated_cache
@@ -380,6 +602,21 @@ class JacuzziAllocator(object):
         if not self.jacuzzi_enabled:
             return available_slaves
 
+        if self.ALLOCATIONS_URL:
+            allocations = self.get_allocations()
+            if allocations is None:
+                return None
+            builders, slaves = allocations
+            if buildername in builders:
+                empty = ()
+                return [s for s in available_slaves
+                        if buildername in slaves.get(s.slave.slavename, empty)]
+            # No allocation for this builder; use unallocated slaves
+            return [s for s in available_slaves if s.slave.slavename not in slaves]
+
+        if self.refresh_loop is not None:
+            return self.get_cached_slaves(buildername, available_slaves)
+
         # Check the cache for this builder
         self.log("checking cache for builder %s" % str(buildername))
         c = self.cache.get(buildername)
@@ -449,6 +686,276 @@ class JacuzziAllocator(object):
         self.cache[buildername] = (time.time() + self.CACHE_FAIL_MAXAGE, None)
         return None
 
+    def get_cached_slaves(self, buildername, available_slaves):
+        """Returns which slaves are suitable for building this builder, using
+        only the snapshot maintained by the background refresh.
+
+        Expired entries are still used (stale-while-revalidate). Builders we
+        haven't seen before are added to the set of builders to refresh, and
+        are given unallocated slaves in the meantime.
+
+        Args:
+            buildername (str): which builder to get slaves for
+            available_slaves (list of buildbot Slave objects): slaves that are
+                currently available on this master
+
+        Returns:
+            None if no slaves are suitable for building this builder, otherwise
+            returns a list of slaves to use
+        """
+        c = self.cache.get(buildername)
+        if c:
+            cache_expiry_time, slaves = c
+            if cache_expiry_time > time.time():
+                self.stats['hit'] += 1
+            else:
+                self.stats['stale'] += 1
+            if slaves:
+                return [s for s in available_slaves if s.slave.slavename in slaves]
+            return None
+
+        if buildername in self.missing_cache:
+            # The service doesn't have an allocation for this builder
+            self.stats['missing'] += 1
+            return self.get_unallocated_slaves(available_slaves)
+
+        self.stats['miss'] += 1
+        if buildername not in self.known_builders:
+            self.schedule_refresh(buildername)
+        if self.allocated_cache is None:
+            return None
+        return self.get_unallocated_slaves(available_slaves)
+
+    def load_allocations(self, data):
+        """Replace the bulk allocations with those in data
+
+        Args:
+            data (dict): decoded response from ALLOCATIONS_URL
+
+        Returns:
+            tuple of (builder name -> set of slavenames, slavename -> set of
+            builder names)
+        """
+        builders = {}
+        slaves = {}
+        for buildername, machines in data['builders'].iteritems():
+            if not machines:
+                continue
+            builders[buildername] = set(machines)
+            for slavename in machines:
+                slaves.setdefault(slavename, set()).add(buildername)
+        # Swap in the new index in one go, so readers never see a partially
+        # built one
+        self.allocations = (time.time() + self.CACHE_MAXAGE, builders, slaves)
+        self.log("loaded allocations for %i builders, %i slaves" %
+                 (len(builders), len(slaves)))
+        return builders, slaves
+
+    def get_allocations(self):
+        """Returns the bulk allocations as (builder name -> set of
+        slavenames, slavename -> set of builder names), fetching them from
+        ALLOCATIONS_URL if they're missing or expired.
+
+        In background refresh mode, no I/O is done and expired allocations
+        are returned as is.
+
+        Returns None if no allocations are available.
+        """
+        if self.allocations:
+            cache_expiry_time, builders, slaves = self.allocations
+            if cache_expiry_time > time.time():
+                self.stats['hit'] += 1
+                return builders, slaves
+            if self.refresh_loop is not None:
+                self.stats['stale'] += 1
+                return builders, slaves
+        elif self.refresh_loop is not None:
+            self.stats['miss'] += 1
+            return None
+
+        if self.allocations_retry_time > time.time():
+            # We failed recently; don't hammer the service
+            if self.allocations:
+                return self.allocations[1:]
+            return None
+
+        self.stats['miss'] += 1
+        self.log("fetching %s" % self.ALLOCATIONS_URL)
+        try:
+            data = json.load(urllib2.urlopen(self.ALLOCATIONS_URL,
+                                             timeout=self.HTTP_TIMEOUT))
+            return self.load_allocations(data)
+        except Exception:
+            self.log("unhandled exception fetching allocations", exc_info=True)
+            self.allocations_retry_time = time.time() + self.CACHE_FAIL_MAXAGE
+            if self.allocations:
+                return self.allocations[1:]
+            return None
+
+    def cache_age(self):
+        """Returns the number of seconds since the last completed background
+        refresh, or None if no refresh has completed yet"""
+        if self.last_refresh is None:
+            return None
+        return time.time() - self.last_refresh
+
+    def start_refresh(self, interval=None, buildernames=None):
+        """Switch to background refresh mode.
+
+        Args:
+            interval (int, optional): seconds between refreshes, defaults to
+                REFRESH_INTERVAL
+            buildernames (list of str, optional): builders to fetch
+                allocations for on the first refresh
+        """
+        if interval is None:
+            interval = self.REFRESH_INTERVAL
+        if buildernames:
+            self.known_builders.update(buildernames)
+        if self.refresh_loop is not None and self.refresh_loop.running:
+            return
+        self.log("starting background refresh every %is" % interval)
+        self.refresh_loop = LoopingCall(self.refresh)
+        self.refresh_loop.start(interval, now=True)
+
+    def stop_refresh(self):
+        """Go back to fetching allocations synchronously"""
+        if self.refresh_loop is None:
+            return
+        self.log("stopping background refresh")
+        if self.refresh_loop.running:
+            self.refresh_loop.stop()
+        self.refresh_loop = None
+
+    def schedule_refresh(self, buildername=None):
+        """Refresh the caches soon, without waiting for the next interval,
+        adding buildername to the builders to refresh if it's given.
+
+        nextSlave functions run in database threads, so this can be called
+        from any thread. If a refresh is already running, another one is run
+        once it finishes.
+        """
+        reactor.callFromThread(self._schedule_refresh, buildername)
+
+    def _schedule_refresh(self, buildername):
+        if buildername is not None:
+            self.known_builders.add(buildername)
+        if self.refresh_pending:
+            return
+        self.refresh_pending = True
+        if not self.refreshing:
+            reactor.callLater(0, self._scheduled_refresh)
+
+    def _scheduled_refresh(self):
+        self.refresh_pending = False
+        self.refresh()
+
+    def fetch(self, url):
+        """Returns a Deferred that fires with the decoded JSON at url"""
+        if url.startswith("file:"):
+            # Local stand-in for the service
+            return defer.maybeDeferred(lambda: json.load(urllib2.urlopen(url)))
+        d = getPage(url, timeout=self.HTTP_TIMEOUT)
+        d.addCallback(json.loads)
+        return d
+
+    def refresh(self):
+        """Refresh the allocated slaves and per-builder caches.
+
+        A new snapshot is built up and swapped in once all requests have
+        finished. Builders whose requests fail keep their previous (possibly
+        stale) entries.
+        """
+        if self.refreshing:
+            self.log("not refreshing since the last refresh is still running")
+            return defer.succeed(None)
+        self.refreshing = True
+        start = time.time()
+
+        def cleanup(res):
+            self.refreshing = False
+            if self.refresh_pending:
+                # Builders were added while we were refreshing
+                reactor.callLater(0, self._scheduled_refresh)
+            return res
+
+        if self.ALLOCATIONS_URL:
+            d = self.refresh_allocations(start)
+            d.addBoth(cleanup)
+            return d
+
+        cache = dict(self.cache)
+        missing_cache = dict(self.missing_cache)
+        sem = defer.DeferredSemaphore(self.REFRESH_CONCURRENCY)
+
+        def got_allocated(data):
+            self.allocated_cache = (time.time() + self.CACHE_MAXAGE,
+                                    set(data['machines']))
+
+        def got_builder(data, buildername):
+            cache[buildername] = (time.time() + self.CACHE_MAXAGE,
+                                  set(data['machines']))
+            missing_cache.pop(buildername, None)
+
+        def builder_failed(f, buildername):
+            if getattr(f.value, 'status', None) == '404':
+                cache.pop(buildername, None)
+                missing_cache[buildername] = time.time() + self.CACHE_MAXAGE
+            else:
+                self.stats['refresh_errors'] += 1
+                self.log("failed to refresh %s: %s" % (buildername,
+                                                       f.getErrorMessage()))
+
+        def allocated_failed(f):
+            self.stats['refresh_errors'] += 1
+            self.log("failed to refresh allocated slaves: %s" %
+                     f.getErrorMessage())
+
+        dl = []
+        d = sem.run(self.fetch, "%s/allocated/all" % self.BASE_URL)
+        d.addCallbacks(got_allocated, allocated_failed)
+        dl.append(d)
+        for buildername in sorted(self.known_builders):
+            url = "%s/builders/%s" % (self.BASE_URL,
+                                      urllib2.quote(buildername, ""))
+            d = sem.run(self.fetch, url)
+            d.addCallback(got_builder, buildername)
+            d.addErrback(builder_failed, buildername)
+            dl.append(d)
+
+        def done(_):
+            self.cache = cache
+            self.missing_cache = missing_cache
+            self.last_refresh = time.time()
+            self.stats['refreshes'] += 1
+            self.log("refreshed %i builders in %.2fs; stats: %s" %
+                     (len(self.known_builders), self.last_refresh - start,
+                      dict(self.stats)))
+
+        d = defer.DeferredList(dl)
+        d.addCallback(done)
+        d.addErrback(lambda f: self.log("error refreshing: %s" %
+                                        f.getErrorMessage()))
+        d.addBoth(cleanup)
+        return d
+
+    def refresh_allocations(self, start):
+        """Refresh the bulk allocations with a single request"""
+        def done(_):
+            self.last_refresh = time.time()
+            self.stats['refreshes'] += 1
+            self.log("refreshed allocations in %.2fs; stats: %s" %
+                     (self.last_refresh - start, dict(self.stats)))
+
+        def failed(f):
+            self.stats['refresh_errors'] += 1
+            self.log("failed to refresh allocations: %s" % f.getErrorMessage())
+
+        d = self.fetch(self.ALLOCATIONS_URL)
+        d.addCallback(self.load_allocations)
+        d.addCallbacks(done, failed)
+        return d
+
     def __call__(self, func):
         """
         Decorator for nextSlave functions that will contact the allocator
@@ -466,24 +973,73 @@ class JacuzziAllocator(object):
 J = JacuzziAllocator()
 
 
+PendingRequest = collections.namedtuple('PendingRequest', ['brid', 'submittedAt'])
+
+
+class PendingRequests(object):
+    """Snapshots of the pending build requests for each builder.
+
+    A builder's snapshot is fetched with a single query the first time it's
+    asked for during a build assignment cycle (i.e. a call to Builder.run),
+    and reused for every other slave choice made in the same cycle.
+    """
+    def __init__(self):
+        # builder name -> (builder run_count, list of PendingRequest sorted by
+        # submittedAt)
+        self.snapshots = {}
+
+    def fetch(self, builder, t):
+        """Returns the pending requests for builder, oldest first, using the
+        db cursor t"""
+        db = builder.db
+        old = now() - builder.RECLAIM_INTERVAL
+        # This is the same set of requests Builder._getBuildable returns, but
+        # without fetching each request individually
+        q = db.quoteq("""SELECT br.id, bs.submitted_at
+                         FROM buildrequests AS br, buildsets AS bs
+                         WHERE
+                            br.buildername = ? AND
+                            br.complete = 0 AND
+                            br.buildsetid = bs.id AND
+                            (br.claimed_at < ? OR
+                             (br.claimed_by_name = ? AND
+                              br.claimed_by_incarnation != ?))
+                         ORDER BY bs.submitted_at ASC""")
+        t.execute(q, (builder.name, old, builder.master_name,
+                      builder.master_incarnation))
+        return [PendingRequest(brid, submittedAt)
+                for (brid, submittedAt) in t.fetchall()]
+
+    def get(self, builder, t=None):
+        """Returns the pending requests for builder, oldest first.
+
+        nextSlave functions are called from a db thread in the middle of a
+        transaction. If t isn't given, a cursor is opened on the connection
+        the db pool has assigned to the current thread. (runQueryNow and
+        runInteractionNow would use the reactor thread's connection.)
+        """
+        snapshot = self.snapshots.get(builder.name)
+        if snapshot and snapshot[0] == builder.run_count:
+            return snapshot[1]
+
+        if t is None:
+            t = builder.db._pool.connect().cursor()
+            try:
+                requests = self.fetch(builder, t)
+            finally:
+                t.close()
+        else:
+            requests = self.fetch(builder, t)
+        self.snapshots[builder.name] = (builder.run_count, requests)
+        return requests
+
+
+P = PendingRequests()
+
+
 def _get_pending(builder):
-    """Returns the pending build requests for this builder"""
-    frame = inspect.currentframe()
-    # Walk up the stack until we find 't', a db transaction object. It allows
-    # us to make synchronous calls to the db from this thread.
-    # We need to commit this horrible crime because
-    # a) we're running in a thread
-    # b) so we can't use the db's existing sync query methods since they use a
-    # db connection created in another thread
-    # c) nor can we use deferreds (threads and deferreds don't play well
-    # together)
-    # d) there's no other way to get a db connection
-    while 't' not in frame.f_locals:
-        frame = frame.f_back
-    t = frame.f_locals['t']
-    del frame
-
-    return builder._getBuildable(t, None)
+    """Returns the pending build requests for this builder, oldest first"""
+    return P.get(builder)
 
 
 def is_spot(name):
@@ -531,9 +1087,7 @@ def _nextAWSSlave(aws_wait=None, recentSort=False):
 
     if recentSort:
         def sorter(slaves, builder):
-            if not slaves:
-                return None
-            return sorted(slaves, _recentSort(builder))[-1]
+            return _mostRecentSlave(builder, slaves)
     else:
         def sorter(slaves, builder):
             if not slaves:
@@ -565,8 +1119,7 @@ def _nextAWSSlave(aws_wait=None, recentSort=False):
         if aws_wait or spot:
             requests = _get_pending(builder)
             if requests:
-                oldestRequestTime = sorted(requests, key=lambda r:
-                                           r.submittedAt)[0].submittedAt
+                oldestRequestTime = requests[0].submittedAt
             else:
                 oldestRequestTime = 0
 
@@ -592,10 +1145,7 @@ _nextAWSSlave_nowait = safeNextSlave(_nextAWSSlave())
 @safeNextSlave
 def _nextSlave(builder, available_slaves):
     # Choose the slave that was most recently on this builder
-    if available_slaves:
-        return sorted(available_slaves, _recentSort(builder))[-1]
-    else:
-        return None
+    return _mostRecentSlave(builder, available_slaves)
 
 
 def _nextIdleSlave(nReserved):
@@ -606,16 +1156,95 @@ def _nextIdleSlave(nReserved):
     def _nextslave(builder, available_slaves):
         if len(available_slaves) <= nReserved:
             return None
-        return sorted(available_slaves, _recentSort(builder))[-1]
+        return _mostRecentSlave(builder, available_slaves)
     return _nextslave
 
 # Globals for mergeRequests
 nomergeBuilders = set()
 # Default to max of 3 merged requests.
 builderMergeLimits = collections.defaultdict(lambda: 3)
-# For tracking state in mergeRequests below
-_mergeCount = 0
-_mergeId = None
+
+
+class RequestMerger(object):
+    """Decides whether pairs of build requests can be merged.
+
+    Whether a request may be merged at all (it wasn't retriggered via
+    self-serve and isn't a nightly build) is worked out once per request and
+    remembered, so the pairwise checks buildbot makes are mostly dict
+    lookups. The number of requests merged into the build being constructed
+    is tracked separately for each builder.
+    """
+    # Maximum number of per-request decisions to remember
+    MAX_KEYS = 10000
+
+    def __init__(self):
+        # builder name -> [id of request being merged into, number of
+        # requests merged so far]
+        self.state = {}
+        # request id -> True if the request may be merged with others
+        self.keys = {}
+
+    def isMergeable(self, req):
+        try:
+            return self.keys[req.id]
+        except KeyError:
+            pass
+
+        if len(self.keys) >= self.MAX_KEYS:
+            self.keys.clear()
+
+        if 'Self-serve' in req.reason:
+            # A build was explicitly requested on this revision, so don't
+            # coalesce it
+            log.msg("mergeRequests: %s is self-serve" % req.id)
+            mergeable = False
+        elif req.properties.getProperty('nightly_build', False):
+            # Disable merging of nightly jobs
+            log.msg("mergeRequests: %s is nightly_build" % req.id)
+            mergeable = False
+        else:
+            mergeable = True
+        self.keys[req.id] = mergeable
+        return mergeable
+
+    def __call__(self, builder, req1, req2):
+        # Merging is disallowed on these builders
+        if builder.name in nomergeBuilders:
+            return False
+
+        if not self.isMergeable(req1) or not self.isMergeable(req2):
+            return False
+
+        # If the requests are fundamentally unmergeable, e.g. on different
+        # branches, give up. Don't log this; it would be spammy
+        if not req1.canBeMergedWith(req2):
+            return False
+
+        # We're merging a different request now; reset the state
+        # This works because buildbot calls this function with the same req1
+        # for all pending requests for the builder, only req2 varies between
+        # calls. Once req1 changes we know we're in the middle of creating a
+        # different build.
+        state = self.state.get(builder.name)
+        if state is None or state[0] != req1.id:
+            # Start counting at 1 here, since if we're being called, we've
+            # already got 2 requests we're considering merging.
+            state = self.state[builder.name] = [req1.id, 1]
+            log.msg("mergeRequests: %s: different r1 id; resetting state" %
+                    builder.name)
+
+        if state[1] >= builderMergeLimits[builder.name]:
+            # This request has already been merged with too many requests
+            log.msg("mergeRequests: %s: exceeded limit (%i)" %
+                    (builder.name, builderMergeLimits[builder.name]))
+            return False
+
+        log.msg("mergeRequests: %s merging %i %i" % (builder.name, req1.id, req2.id))
+        state[1] += 1
+        return True
+
+
+_merger = RequestMerger()
 
 
 def mergeRequests(builder, req1, req2):
@@ -633,52 +1262,7 @@ def mergeRequests(builder, req1, req2):
             This changes as the buildbot master considers all pending requests
             for the build.
     """
-    global _mergeCount, _mergeId
-
-    # If the requests are fundamentally unmergeable, get that done first
-    if not req1.canBeMergedWith(req2):
-        # The requests are inherently unmergeable; e.g. on different branches
-        # Don't log this; it would be spammy
-        return False
-
-    log.msg("mergeRequests: considering %s %s %s" % (builder.name, req1.id, req2.id))
-    # Merging is disallowed on these builders
-    if builder.name in nomergeBuilders:
-        log.msg("mergeRequests: in nomergeBuilders; returning False")
-        return False
-
-    if 'Self-serve' in req1.reason or 'Self-serve' in req2.reason:
-        # A build was explicitly requested on this revision, so don't coalesce
-        # it
-        log.msg("mergeRequests: self-serve; returning False")
-        return False
-
-    # Disable merging of nightly jobs
-    if req1.properties.getProperty('nightly_build', False) or req2.properties.getProperty('nightly_build', False):
-        log.msg("mergeRequests: nightly_build; returning False")
-        return False
-
-    # We're merging a different request now; reset the state
-    # This works because buildbot calls this function with the same req1 for
-    # all pending requests for the builder, only req2 varies between calls.
-    # Once req1 changes we know we're in the middle of creating a different
-    # build.
-    if req1.id != _mergeId:
-        # Start counting at 1 here, since if we're being called, we've already
-        # got 2 requests we're considering merging. If we pa
-        _mergeCount = 1
-        _mergeId = req1.id
-        log.msg("mergeRequests: different r1 id; resetting state")
-
-    if _mergeCount >= builderMergeLimits[builder.name]:
-        # This request has already been merged with too many requests
-        log.msg("mergeRequests: %s: exceeded limit (%i)" %
-                (builder.name, builderMergeLimits[builder.name]))
-        return False
-
-    log.msg("mergeRequests: %s merging %i %i" % (builder.name, req1.id, req2.id))
-    _mergeCount += 1
-    return True
+    return _merger(builder, req1, req2)
 
 
 def mergeBuildObjects(d1, d2):
@@ -1331,8 +1915,9 @@ def generateBranchObjects(config, name, secrets=None):
                                                    repositoryIndex=config[
                                                    'l10n_repo_path'],
                                                    pollInterval=l10nPollInterval,
-                                                   branch=name)
-        hg_all_locales_poller.parallelRequests = 1
+                                                   branch=name,
+                                                   parallelRequests=1,
+                                                   maxParallelRequests=4)
         branchObjects['change_source'].append(hg_all_locales_poller)
 
     # schedulers
@@ -1364,7 +1949,8 @@ def generateBranchObjects(config, name, secrets=None):
     if config.get("enable_onchange_scheduler", True):
         for product, product_builders in buildersByProduct.items():
             if config.get('enable_try'):
-                fileIsImportant = lambda c: isHgPollerTriggered(c, config['hgurl'])
+                fileIsImportant = changeClassifier.predicate(
+                    isHgPollerTriggered, config['hgurl'])
             else:
                 # The per-product build behaviour is tweakable per branch, and
                 # by default is opt-out. (Bug 1056792).
@@ -1392,8 +1978,8 @@ def generateBranchObjects(config, name, secrets=None):
             branch=config['l10n_repo_path'],
             treeStableTimer=None,
             builderNames=l10n_builders,
-            fileIsImportant=lambda c: isImportantL10nFile(
-                c, config['l10n_modules']),
+            fileIsImportant=changeClassifier.predicate(
+                isImportantL10nFile, tuple(config['l10n_modules'])),
             properties={
                 'app': 'browser',
                 'en_revision': 'default',
@@ -3026,6 +3612,8 @@ def generateSpiderMonkeyObjects(project, config, SLAVES):
                 return True
 
         return False
+    # All of the schedulers below use this, twice
+    isImportant = changeClassifier.predicate(isImportant)
 
     # Set up schedulers
     extra_args = {}
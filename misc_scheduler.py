@@ -4,7 +4,8 @@
 #   Lukas Blakk <lsblakk@mozilla.com>
 import re
 import time
-from twisted.python import log
+import weakref
+from twisted.python import log, failure
 from twisted.internet import defer
 from twisted.web.client import getPage
 
@@ -13,39 +14,114 @@ from buildbot.sourcestamp import SourceStamp
 import buildbotcustom.try_parser
 reload(buildbotcustom.try_parser)
 
-from buildbotcustom.try_parser import TryParser
+from buildbotcustom.try_parser import CompiledTryParser
 from buildbotcustom.common import genBuildID, genBuildUID, incrementBuildID
 
 from buildbot.process.properties import Properties
 from buildbot.util import json
 
 
-def tryChooser(s, all_changes):
-    log.msg("Looking at changes: %s" % all_changes)
+# scheduler -> CompiledTryParser for its configuration
+_tryParsers = weakref.WeakKeyDictionary()
 
-    buildersPerChange = {}
 
-    dl = []
+def getTryParser(s):
+    try:
+        return _tryParsers[s]
+    except KeyError:
+        parser = _tryParsers[s] = CompiledTryParser(
+            s.builderNames, s.prettyNames, s.unittestPrettyNames,
+            s.unittestSuites, s.talosSuites, s.buildbotBranch,
+            s.buildersWithSetsMap)
+        return parser
+
 
-    def getJSON(data):
+class TrySyntaxLookup(object):
+    """Finds the try syntax in the push that a try revision was part of.
+
+    Every changeset in a push is answered from one pushlog request, and
+    the answers are remembered, so changes from the same push (or from
+    a scheduler looking at the same changes again) don't cause more
+    requests. At most maxConcurrent requests are made at once.
+    """
+    pushlogURL = "https://hg.mozilla.org/try/json-pushes?full=1&changeset=%s"
+    maxConcurrent = 4
+    # Maximum number of revisions to remember the try syntax for
+    maxSize = 10000
+
+    def __init__(self):
+        # revision -> try syntax comments for its push, or None
+        self.comments = {}
+        # revision -> Deferreds waiting for a lookup in progress
+        self.waiting = {}
+        self.semaphore = defer.DeferredSemaphore(self.maxConcurrent)
+
+    def getComments(self, revision):
+        """Returns a Deferred firing with the try syntax comments of the
+        push containing revision, or None if there aren't any"""
+        if revision in self.comments:
+            return defer.succeed(self.comments[revision])
+        d = defer.Deferred()
+        if revision in self.waiting:
+            self.waiting[revision].append(d)
+        else:
+            self.waiting[revision] = [d]
+            self.semaphore.run(self.fetch, revision).addBoth(
+                self.fetched, revision)
+        return d
+
+    def fetch(self, revision):
+        # An earlier request may have covered this revision's push while we
+        # were waiting for our turn
+        if revision in self.comments:
+            return self.comments[revision]
+        d = getPage(str(self.pushlogURL % revision))
+        d.addCallback(self.parsePushlog)
+        return d
+
+    def parsePushlog(self, data):
         push = json.loads(data)
         log.msg("Looking at the push json data for try comments")
+        if len(self.comments) >= self.maxSize:
+            self.comments.clear()
+        comments = None
         for p in push:
             pd = push[p]
             changes = pd['changesets']
-            for change in reversed(changes):
-                match = re.search("try:", change['desc'])
-                if match:
-                    return change['desc'].encode("utf8", "replace")
+            if comments is None:
+                for change in reversed(changes):
+                    match = re.search("try:", change['desc'])
+                    if match:
+                        comments = change['desc'].encode("utf8", "replace")
+                        break
+            for change in changes:
+                self.comments[change['node']] = comments
+        return comments
+
+    def fetched(self, result, revision):
+        for d in self.waiting.pop(revision):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+_trySyntax = TrySyntaxLookup()
+
+
+def tryChooser(s, all_changes):
+    log.msg("Looking at changes: %s" % all_changes)
+
+    buildersPerChange = {}
+
+    dl = []
 
     def parseData(comments, c):
         if not comments:
             # still need to parse a comment string to get the default set
             log.msg("No comments, passing empty string which will result in default set")
             comments = ""
-        customBuilders = TryParser(
-            comments, s.builderNames, s.prettyNames, s.unittestPrettyNames,
-            s.unittestSuites, s.talosSuites, s.buildbotBranch, s.buildersWithSetsMap)
+        customBuilders = getTryParser(s).parse(comments)
         buildersPerChange[c] = customBuilders
 
     def parseDataError(failure, c):
@@ -64,10 +140,9 @@ def tryChooser(s, all_changes):
             if match:
                 log.msg("Found try message in the change comments, ignoring push comments")
                 d = defer.succeed(c.comments)
-            # otherwise getPage from hg.m.o
+            # otherwise look for it in the push, on hg.m.o
             else:
-                d = getPage(str("https://hg.mozilla.org/try/json-pushes?full=1&changeset=%s" % c.revision))
-                d.addCallback(getJSON)
+                d = _trySyntax.getComments(c.revision)
         except:
             log.msg("Error in all_changes loop: sending default try set")
             d = defer.succeed("")
@@ -142,69 +217,116 @@ def changeEventGeneratorInTransaction(dbconn, t, branches=[],
         yield dbconn._txn_getChangeNumberedNow(t, changeid)
 
 
+# How many candidate changes lastChange looks at per query
+lastChangePageSize = 50
+
+
 def lastChange(db, t, branch):
     """Returns the revision for the last changeset on the given branch"""
     #### NOTE: called in a thread!
-    for c in changeEventGeneratorInTransaction(db, t, branches=[branch]):
-        # Ignore DONTBUILD changes
-        if c.comments and "DONTBUILD" in c.comments:
-            continue
-        # Ignore changes which didn't come from the poller
-        if not c.revlink:
-            continue
-        return c
-    return None
+    # Ignore changes which didn't come from the poller; they have no revlink
+    q = """SELECT changeid, comments FROM changes
+           WHERE branch = ? AND revlink IS NOT NULL AND revlink != ''"""
+    # Go back through the candidates a page at a time, starting from the most
+    # recent, until we find one that isn't DONTBUILD
+    last_changeid = None
+    while True:
+        if last_changeid is None:
+            page_q, args = q, (branch,)
+        else:
+            page_q, args = q + " AND changeid < ?", (branch, last_changeid)
+        page_q += " ORDER BY changeid DESC LIMIT %i" % lastChangePageSize
+        t.execute(db.quoteq(page_q), args)
+        rows = t.fetchall()
+        for changeid, comments in rows:
+            # Ignore DONTBUILD changes
+            if comments and "DONTBUILD" in comments:
+                continue
+            return db._txn_getChangeNumberedNow(t, changeid)
+        if len(rows) < lastChangePageSize:
+            return None
+        last_changeid = rows[-1][0]
 
 
-def lastGoodRev(db, t, branch, builderNames, starttime, endtime):
-    """Returns the revision for the latest green build among builders.  If no
-    revision is all green, None is returned."""
+# Index supporting lastGoodRev's query; buildbot's own buildername index
+# doesn't cover the complete_at range
+lastGoodRevIndex = ("buildrequests_buildername_complete_at", "buildrequests",
+                    ["buildername", "complete_at"])
+_lastGoodRevIndexChecked = False
 
-    # Get a list of branch, revision, buildername tuples from builds on
-    # `branch` that completed successfully or with warnings within [starttime,
-    # endtime] (a closed interval)
-    q = db.quoteq("""SELECT branch, revision, buildername FROM
-                sourcestamps,
-                buildsets,
-                buildrequests
 
-            WHERE
-                buildsets.sourcestampid = sourcestamps.id AND
-                buildrequests.buildsetid = buildsets.id AND
-                buildrequests.complete = 1 AND
-                buildrequests.results IN (0,1) AND
-                sourcestamps.revision IS NOT NULL AND
-                buildrequests.buildername in %s AND
-                sourcestamps.branch = ? AND
-                buildrequests.complete_at >= ? AND
-                buildrequests.complete_at <= ?
+def addLastGoodRevIndex(db, t):
+    """Creates lastGoodRevIndex if it's missing. This is only done for sqlite
+    databases; adding an index to a large MySQL table can lock it for a long
+    time, so for those we log the statement to run instead."""
+    global _lastGoodRevIndexChecked
+    if _lastGoodRevIndexChecked:
+        return
+    _lastGoodRevIndexChecked = True
 
-            ORDER BY
-                buildsets.id DESC
-        """ % db.parmlist(len(builderNames)))
-    t.execute(q, tuple(builderNames) + (branch, starttime, endtime))
-    builds = t.fetchall()
+    name, table, columns = lastGoodRevIndex
+    if 'sqlite' not in db._spec.dbapiName:
+        log.msg("lastGoodRev: if it doesn't exist yet, create this index: "
+                "CREATE INDEX `%s` ON `%s` (`%s` (255), `%s`)" %
+                ((name, table) + tuple(columns)))
+        return
+    t.execute("CREATE INDEX IF NOT EXISTS `%s` ON `%s` (%s)" %
+              (name, table, ", ".join("`%s`" % c for c in columns)))
 
-    builderNames = set(builderNames)
 
-    # Map of (branch, revision) to set of builders that passed
-    good_sourcestamps = {}
+def lastGoodRev(db, t, branch, builderNames, starttime, endtime):
+    """Returns the revision for the latest green build among builders.  If no
+    revision is all green, None is returned."""
 
-    # Go through the results and group them by branch,revision.
-    # When we find a revision where all our required builders are listed, we've
-    # found a good revision!
-    count = 0
-    for (branch, revision, name) in builds:
-        count += 1
-        key = branch, revision
-        good_sourcestamps.setdefault(key, set()).add(name)
+    builderNames = set(builderNames)
+    if not builderNames:
+        return None
+
+    # Of the builds on `branch` that completed successfully or with warnings
+    # within [starttime, endtime] (a closed interval), find the revisions that
+    # every builder has built. For each of those, look at the most recent
+    # buildset for each builder; the winner is the revision whose oldest such
+    # buildset is the newest. That's the first revision that would be
+    # complete if we went through the builds from the latest buildset down.
+    q = db.quoteq("""SELECT revision, MIN(latest) AS completed FROM
+                (SELECT
+                    sourcestamps.revision AS revision,
+                    buildrequests.buildername AS buildername,
+                    MAX(buildsets.id) AS latest
+                FROM
+                    sourcestamps,
+                    buildsets,
+                    buildrequests
+
+                WHERE
+                    buildsets.sourcestampid = sourcestamps.id AND
+                    buildrequests.buildsetid = buildsets.id AND
+                    buildrequests.complete = 1 AND
+                    buildrequests.results IN (0,1) AND
+                    sourcestamps.revision IS NOT NULL AND
+                    buildrequests.buildername in %s AND
+                    sourcestamps.branch = ? AND
+                    buildrequests.complete_at >= ? AND
+                    buildrequests.complete_at <= ?
+
+                GROUP BY
+                    sourcestamps.revision, buildrequests.buildername
+                ) AS good_builds
+
+            GROUP BY revision
+            HAVING COUNT(buildername) = ?
+            ORDER BY completed DESC
+            LIMIT 1
+        """ % db.parmlist(len(builderNames)))
+    t.execute(q, tuple(builderNames) +
+              (branch, starttime, endtime, len(builderNames)))
+    row = t.fetchone()
+    if row is None:
+        return None
 
-        if good_sourcestamps[key] == builderNames:
-            # Looks like a winner!
-            log.msg("lastGood: ss %s good for everyone!" % (key,))
-            log.msg("lastGood: looked at %i builds" % count)
-            return revision
-    return None
+    revision = row[0]
+    log.msg("lastGood: ss %s good for everyone!" % ((branch, revision),))
+    return revision
 
 
 def getLatestRev(db, t, branch, revs):
@@ -270,6 +392,8 @@ def lastGoodFunc(branch, builderNames, triggerBuildIfNoChanges=True, l10nBranch=
         #### NOTE: called in a thread!
         db = scheduler.parent.db
 
+        addLastGoodRevIndex(db, t)
+
         # Look back 24 hours for a good revision to build
         start = time.time()
         rev = lastGoodRev(
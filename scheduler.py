@@ -15,13 +15,15 @@ from buildbot.schedulers.triggerable import Triggerable
 from buildbot.sourcestamp import SourceStamp
 from buildbot.process.properties import Properties
 from buildbot.status.builder import SUCCESS, WARNINGS
+from buildbot.status.base import StatusReceiver
 
-from buildbot.util import now
+from buildbot.util import now, json
 
 import util.tuxedo
 reload(util.tuxedo)
 from util.tuxedo import get_release_uptake
 
+import copy
 import time
 
 
@@ -83,31 +85,100 @@ class PersistentScheduler(BaseScheduler):
             return (self.lastCheck + self.pollInterval + 1)
 
         db = self.parent.db
+        d = db.runInteraction(self._run)
+        return d
+
+    def _run(self, t):
+        pending = self.get_pending_counts(t)
         to_create = []
         for builderName in self.builderNames:
-            n = len(db.get_pending_brids_for_builder(builderName))
-            num_to_create = self.numPending - n
+            num_to_create = self.numPending - pending.get(builderName, 0)
             if num_to_create <= 0:
                 continue
             to_create.append((builderName, num_to_create))
+        return self.create_builds(to_create, t)
 
-        d = db.runInteraction(lambda t: self.create_builds(to_create, t))
-        return d
+    def get_pending_counts(self, t):
+        """Returns a dict of builder name to the number of unclaimed,
+        incomplete build requests for it, for all of our builders"""
+        db = self.parent.db
+        pending = {}
+        builderNames = list(self.builderNames)
+        while builderNames:
+            # sqlite has a maximum of 999 parameters
+            batch, builderNames = builderNames[:100], builderNames[100:]
+            t.execute(db.quoteq("SELECT buildername, COUNT(*)"
+                                " FROM buildrequests"
+                                " WHERE complete=0 AND claimed_at=0 AND"
+                                "  buildername IN ") + db.parmlist(len(batch)) +
+                      " GROUP BY buildername",
+                      tuple(batch))
+            for builderName, count in t.fetchall():
+                pending[builderName] = count
+        return pending
 
     def create_builds(self, to_create, t):
+        # This does what BaseScheduler.create_buildset does for each build,
+        # but adds the properties and build requests for all of the
+        # buildsets at once
         db = self.parent.db
+        submitted_at = db._getCurrentTime()
+        requests = []
         for builderName, count in to_create:
             ss = self.ssFunc(builderName)
             ssid = db.get_sourcestampid(ss, t)
             for i in range(0, count):
-                self.create_buildset(
-                    ssid, "scheduler", t, builderNames=[builderName])
+                t.execute(db.quoteq("INSERT INTO buildsets"
+                                    " (external_idstring, reason,"
+                                    "  sourcestampid, submitted_at)"
+                                    " VALUES (?,?,?,?)"),
+                          (None, "scheduler", ssid, submitted_at))
+                requests.append((t.lastrowid, builderName))
+
+        if requests:
+            bsids = [bsid for (bsid, builderName) in requests]
+            props = [(name, json.dumps(value)) for (name, value)
+                     in self.properties.properties.items()]
+            insert_many(db, t, "buildset_properties",
+                        ("buildsetid", "property_name", "property_value"),
+                        [(bsid, name, value) for bsid in bsids
+                         for (name, value) in props])
+            insert_many(db, t, "buildrequests",
+                        ("buildsetid", "buildername", "submitted_at"),
+                        [(bsid, builderName, submitted_at)
+                         for (bsid, builderName) in requests])
+
+            brids = []
+            while bsids:
+                batch, bsids = bsids[:100], bsids[100:]
+                t.execute(db.quoteq("SELECT id FROM buildrequests"
+                                    " WHERE buildsetid IN ") +
+                          db.parmlist(len(batch)), tuple(batch))
+                brids.extend(brid for (brid,) in t.fetchall())
+
+            for bsid, builderName in requests:
+                db.notify("add-buildset", bsid)
+                # notify downstream schedulers so they can watch for it to
+                # complete
+                self.parent.publish_buildset(self.name, bsid, t)
+            db.notify("add-buildrequest", *brids)
 
         # Try again in a bit
         self.lastCheck = now()
         return now() + self.pollInterval
 
 
+def insert_many(db, t, table, columns, rows, batchSize=100):
+    """Inserts rows into table with as few statements as possible"""
+    row = "(%s)" % ",".join(["?"] * len(columns))
+    while rows:
+        # sqlite has a maximum of 999 parameters
+        batch, rows = rows[:batchSize], rows[batchSize:]
+        q = "INSERT INTO %s (%s) VALUES %s" % (
+            table, ", ".join(columns), ",".join([row] * len(batch)))
+        t.execute(db.quoteq(q), tuple(v for r in batch for v in r))
+
+
 class BuilderChooserScheduler(Scheduler):
     compare_attrs = Scheduler.compare_attrs + (
         'chooserFunc', 'prettyNames',
@@ -347,13 +418,23 @@ class AggregatingScheduler(BaseScheduler, Triggerable):
     Use trigger() method to reset its state.
 
     `okResults` should be a tuple of acceptable result codes, and defaults to
-    (SUCCESS,WARNINGS)."""
+    (SUCCESS,WARNINGS).
+
+    By default the scheduler looks for newly completed upstream builds in the
+    database every time it runs. With `eventDriven` set, it watches for
+    upstream builds finishing on this master instead, keeping its state in
+    memory and only writing it to the database when the set of remaining
+    builders changes. Completed builds are only looked up in the database
+    when the scheduler starts, so this is only suitable if all of
+    `upstreamBuilders` run on this master."""
 
     compare_attrs = ('name', 'branch', 'builderNames', 'properties',
-                     'upstreamBuilders', 'okResults', 'enable_service')
+                     'upstreamBuilders', 'okResults', 'enable_service',
+                     'eventDriven')
 
     def __init__(self, name, branch, builderNames, upstreamBuilders,
-                 okResults=(SUCCESS, WARNINGS), properties={}):
+                 okResults=(SUCCESS, WARNINGS), properties={},
+                 eventDriven=False):
         BaseScheduler.__init__(self, name, builderNames, properties)
         self.branch = branch
         self.lock = defer.DeferredLock()
@@ -367,6 +448,13 @@ class AggregatingScheduler(BaseScheduler, Triggerable):
         # Set this to False to disable the service component of this scheduler
         self.enable_service = True
 
+        self.eventDriven = eventDriven
+        # In event driven mode, our state as of the last run, and the
+        # (builder, complete_at) of upstream builds that have finished since
+        self.state = None
+        self.finishedBuilds = []
+        self.watcher = None
+
     def get_initial_state(self, max_changeid):
         log.msg('%s: get_initial_state()' % self.log_prefix)
         # Keep initial state of builders in upstreamBuilders
@@ -383,8 +471,29 @@ class AggregatingScheduler(BaseScheduler, Triggerable):
         if not self.enable_service:
             return
         self.parent.db.runInteractionNow(self._startService)
+        if self.eventDriven:
+            self.watcher = UpstreamWatcher(self)
+            self.parent.master.getStatus().subscribe(self.watcher)
         BaseScheduler.startService(self)
 
+    def stopService(self):
+        if self.watcher:
+            self.watcher.unsubscribe(self.parent.master.getStatus())
+            self.watcher = None
+        return BaseScheduler.stopService(self)
+
+    def upstreamBuildFinished(self, builderName, build, results):
+        if not self.running:
+            return
+        if results not in self.okResults:
+            return
+        complete_at = build.getTimes()[1]
+        log.msg('%s: %s finished at %s' %
+                (self.log_prefix, builderName, complete_at))
+        # The request will be retired right after this, which runs the
+        # schedulers
+        self.finishedBuilds.append((builderName, complete_at))
+
     def _startService(self, t):
         state = self.get_state(t)
         old_state = state.copy()
@@ -411,6 +520,15 @@ class AggregatingScheduler(BaseScheduler, Triggerable):
         if old_state != state:
             log.msg('%s: old state: %s' % (self.log_prefix, old_state))
             log.msg('%s: new state: %s' % (self.log_prefix, state))
+        if self.eventDriven:
+            # Catch up with anything that finished while we weren't watching
+            newBuilds = self.findNewBuilds(self.parent.db, t,
+                                           state['lastCheck'],
+                                           state['lastReset'])
+            state, _ = self.processBuilds(
+                t, state, [(b, complete_at) for b, brid, complete_at
+                           in newBuilds])
+            self.state = state
         self.set_state(t, state)
 
     def trigger(self, ss, set_props=None):
@@ -425,6 +543,9 @@ class AggregatingScheduler(BaseScheduler, Triggerable):
         state['lastReset'] = state['lastCheck']
         log.msg('%s: reset state: %s' % (self.log_prefix, state))
         self.set_state(t, state)
+        if self.eventDriven:
+            self.state = state
+            self.finishedBuilds = []
 
     def run(self):
         if not self.enable_service:
@@ -433,8 +554,25 @@ class AggregatingScheduler(BaseScheduler, Triggerable):
         if self.lock.locked:
             return
 
-        d = self.lock.acquire()
-        d.addCallback(lambda _: self.parent.db.runInteraction(self._run))
+        if self.eventDriven:
+            if not self.finishedBuilds:
+                # Nothing has happened since our last run
+                return
+            # Take the builds now, and put them back if we fail to process
+            # them
+            builds, self.finishedBuilds = self.finishedBuilds, []
+
+            def requeue(f):
+                self.finishedBuilds = builds + self.finishedBuilds
+                return f
+
+            d = self.lock.acquire()
+            d.addCallback(lambda _: self.parent.db.runInteraction(
+                self._runEvents, builds))
+            d.addErrback(requeue)
+        else:
+            d = self.lock.acquire()
+            d.addCallback(lambda _: self.parent.db.runInteraction(self._run))
 
         def release(_):
             self.lock.release()
@@ -480,16 +618,34 @@ class AggregatingScheduler(BaseScheduler, Triggerable):
         db = self.parent.db
         state = self.get_state(t)
         # Check for new builds completed since lastCheck
-        lastCheck = state['lastCheck']
-        lastReset = state['lastReset']
-        remainingBuilders = state['remainingBuilders']
+        newBuilds = self.findNewBuilds(db, t, state['lastCheck'],
+                                       state['lastReset'])
+        state, _ = self.processBuilds(
+            t, state, [(b, complete_at) for b, brid, complete_at in newBuilds])
+        self.set_state(t, state)
 
-        newBuilds = self.findNewBuilds(db, t, lastCheck, lastReset)
+    def _runEvents(self, t, builds):
+        state = copy.deepcopy(self.state)
+        state, changed = self.processBuilds(t, state, builds)
+        # lastCheck is only needed to catch up on startup, so it doesn't
+        # matter if we lose updates to it
+        if changed:
+            self.set_state(t, state)
+        self.state = state
+
+    def processBuilds(self, t, state, builds):
+        """Updates state with the given (builder, complete_at) builds, and
+        starts our builds if none of the upstream builders remain. Returns the
+        new state, and whether remainingBuilders changed."""
+        db = self.parent.db
+        remainingBuilders = state['remainingBuilders']
+        changed = False
 
-        for builder, brid, complete_at in newBuilds:
+        for builder, complete_at in builds:
             state['lastCheck'] = max(state['lastCheck'], complete_at)
             if builder in remainingBuilders:
                 remainingBuilders.remove(builder)
+                changed = True
 
         lastCheck = state['lastCheck']
 
@@ -509,8 +665,37 @@ class AggregatingScheduler(BaseScheduler, Triggerable):
             # Reset the list of builders we're waiting for
             state = self.get_initial_state(None)
             state['lastCheck'] = lastCheck
+            changed = True
 
-        self.set_state(t, state)
+        return state, changed
+
+
+class UpstreamWatcher(StatusReceiver):
+    """Tells an event driven AggregatingScheduler about builds finishing on
+    its upstream builders"""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        # name -> BuilderStatus for the builders we're subscribed to
+        self.builders = {}
+
+    def builderAdded(self, builderName, builder):
+        if builderName in self.scheduler.upstreamBuilders:
+            self.builders[builderName] = builder
+            return self
+
+    def builderRemoved(self, builderName):
+        self.builders.pop(builderName, None)
+
+    def buildFinished(self, builderName, build, results):
+        self.scheduler.upstreamBuildFinished(builderName, build, results)
+
+    def unsubscribe(self, status):
+        """Stop watching `status` and the builders it gave us"""
+        status.unsubscribe(self)
+        for builder in self.builders.values():
+            builder.unsubscribe(self)
+        self.builders = {}
 
 
 def makePropertiesScheduler(base_class, propfuncs, *args, **kw):
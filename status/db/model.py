@@ -1,12 +1,17 @@
 import datetime
+import hashlib
+import threading
+from collections import OrderedDict
 import sqlalchemy
+import sqlalchemy.engine.reflection
 from sqlalchemy import Column, Integer, String, Unicode, UnicodeText, \
     Boolean, Text, DateTime, ForeignKey, Table, UniqueConstraint, \
     and_
+from sqlalchemy.sql import null
 from sqlalchemy.orm import relation
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.orderinglist import ordering_list
-from jsoncol import JSONColumn
+from jsoncol import JSONColumn, json
 
 import logging
 log = logging.getLogger(__name__)
@@ -23,10 +28,113 @@ def connect(url, drop_all=False, **kwargs):
         log.warn("DBMSG: Warning, dropping all tables")
         Base.metadata.drop_all()
     Base.metadata.create_all()
+    upgrade(Base.metadata.bind)
     global Session
     Session = sqlalchemy.orm.sessionmaker(bind=Base.metadata.bind)
     return Session
 
+
+def upgrade(engine):
+    """Add any columns that create_all() won't add to existing tables, and
+    their indexes.  Columns and indexes are checked for separately, so that
+    an upgrade that was interrupted is finished off next time. Other masters
+    may be upgrading the same tables at the same time."""
+    for table, column in [(Property.__table__, Property.__table__.c.hash),
+                          (File.__table__, File.__table__.c.hash),
+                          (Change.__table__, Change.__table__.c.fingerprint),
+                          (SourceStamp.__table__,
+                           SourceStamp.__table__.c.fingerprint)]:
+        if not hasColumn(engine, table, column):
+            log.warn("DBMSG: Adding %s.%s", table.name, column.name)
+            runUpgrade(engine.execute,
+                       "ALTER TABLE %s ADD COLUMN %s %s" % (
+                           table.name, column.name,
+                           column.type.compile(dialect=engine.dialect)),
+                       done=lambda: hasColumn(engine, table, column))
+        for index in table.indexes:
+            if column.name not in index.columns:
+                continue
+            if not hasIndex(engine, table, index):
+                log.warn("DBMSG: Adding index %s", index.name)
+                runUpgrade(index.create, bind=engine,
+                           done=lambda: hasIndex(engine, table, index))
+
+
+def hasColumn(engine, table, column):
+    inspector = sqlalchemy.engine.reflection.Inspector.from_engine(engine)
+    return column.name in [c['name'] for c in
+                           inspector.get_columns(table.name)]
+
+
+def hasIndex(engine, table, index):
+    inspector = sqlalchemy.engine.reflection.Inspector.from_engine(engine)
+    return index.name in [i['name'] for i in
+                          inspector.get_indexes(table.name)]
+
+
+def runUpgrade(f, *args, **kwargs):
+    """Call f(*args, **kwargs), unless it fails because another master has
+    done the same thing already, which done() checks for"""
+    done = kwargs.pop('done')
+    try:
+        f(*args, **kwargs)
+    except sqlalchemy.exc.DBAPIError:
+        if not done():
+            raise
+        log.warn("DBMSG: Another master has upgraded this already")
+
+
+def insertIgnore(session, table, rows):
+    """Insert rows into table, skipping any which would duplicate a unique
+    key. Other masters may be adding the same rows at the same time."""
+    dialect = session.bind.dialect.name
+    if dialect == 'mysql':
+        prefixes = ['IGNORE']
+    elif dialect == 'sqlite':
+        prefixes = ['OR IGNORE']
+    else:
+        prefixes = []
+    session.execute(table.insert(prefixes=prefixes), rows)
+
+
+def lockingRead(query):
+    """Make query read the latest committed rows rather than the
+    transaction's snapshot.  On MySQL, the first read in a transaction fixes
+    what later plain reads can see, so rows that another master committed
+    since then, and that insertIgnore therefore skipped, are only found this
+    way."""
+    return query.with_lockmode('read')
+
+
+class LRUCache(object):
+    """A mapping that only holds on to its maxSize most recently used keys.
+    It's shared by the reactor and the statusdb worker threads."""
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+            value = self.data.pop(key)
+            self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.maxSize:
+                self.data.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+
 file_changes = Table('file_changes', Base.metadata,
                      Column('file_id', Integer, ForeignKey('files.id'),
                             nullable=False, index=True),
@@ -61,40 +169,79 @@ class File(Base):
     __tablename__ = "files"
     id = Column(Integer, primary_key=True)
     path = Column(Unicode(400), index=True, nullable=False)
+    # See makeHash; older rows don't have one
+    hash = Column(String(40), nullable=True, index=True, unique=True)
+
+    # How many paths or ids to look for per query.  sqlite won't take more
+    # than 999 parameters in one statement.
+    chunkSize = 500
+
+    def __init__(self, **kwargs):
+        Base.__init__(self, **kwargs)
+        if self.hash is None:
+            self.hash = self.makeHash(self.path)
+
+    @staticmethod
+    def makeHash(path):
+        """Returns a hash of a file's path.  MySQL can't put a unique index on
+        the path itself."""
+        return hashlib.sha1(path.encode('utf8')).hexdigest()
 
     @classmethod
     def get(cls, session, path):
         """Retrieve a File object given its path.  If the path doesn't exist
-        yet in the database, it is created and added to the session, but not
-        committed."""
-        path = unicode(path)
-        f = session.query(cls).filter_by(path=path).first()
-        if not f:
-            f = cls(path=path)
-            session.add(f)
-        return f
+        yet in the database, it is created, but not committed."""
+        return cls.getall(session, [path])[0]
 
     @classmethod
     def getall(cls, session, paths):
-        """Retrieve a list File object given their paths.  If the path doesn't exist
-        yet in the database, it is created and added to the session, but not
-        committed."""
-        chunk_size = 100
-        all_files = []
-        log.info("getting lots of files")
-        for x in range(0, len(paths), chunk_size):
-            this_chunk = [unicode(p) for p in paths[x:x + chunk_size]]
-            files = session.query(cls).filter(cls.path.in_(this_chunk)).all()
-            log.debug("looking for %i in this chunk; got %i", len(this_chunk), len(files))
-            all_files.extend(files)
-            missing = set(this_chunk) - set(f.path for f in files)
-            log.debug("missing %i", len(missing))
+        """Retrieve a list of File objects given their paths.  Any that don't
+        exist yet in the database are inserted, but not committed."""
+        wanted = OrderedDict((unicode(p), None) for p in paths)
+
+        # Look up the ones we've seen recently by id, and the rest by hash
+        ids = []
+        hashes = []
+        for path in wanted:
+            i = fileIds.get(path)
+            if i is None:
+                hashes.append(cls.makeHash(path))
+            else:
+                ids.append(i)
+        found = cls._find(session, cls.id, ids)
+        found.update(cls._find(session, cls.hash, hashes))
+
+        missing = [path for path in wanted if path not in found]
+        if missing:
+            log.debug("inserting %i of %i files", len(missing), len(wanted))
+            # These include any ids we had cached that have since been
+            # rolled back
             for path in missing:
-                f = cls(path=path)
-                session.add(f)
-                all_files.append(f)
+                fileIds.discard(path)
+            hashes = [cls.makeHash(path) for path in missing]
+            insertIgnore(session, cls.__table__,
+                         [dict(path=path, hash=h)
+                          for path, h in zip(missing, hashes)])
+            found.update(cls._find(session, cls.hash, hashes, lock=True))
+
+        return [found[path] for path in wanted]
 
-        return all_files
+    @classmethod
+    def _find(cls, session, column, values, lock=False):
+        found = {}
+        for x in range(0, len(values), cls.chunkSize):
+            chunk = values[x:x + cls.chunkSize]
+            q = session.query(cls).filter(column.in_(chunk))
+            if lock:
+                q = lockingRead(q)
+            for f in q:
+                found[f.path] = f
+                fileIds.set(f.path, f.id)
+        return found
+
+
+# Ids of recently used files, by path
+fileIds = LRUCache(50000)
 
 
 class Property(Base):
@@ -103,6 +250,20 @@ class Property(Base):
     name = Column(Unicode(40), index=True)
     source = Column(Unicode(40), index=True)
     value = Column(JSONColumn, nullable=True)
+    # See makeHash; older rows don't have one
+    hash = Column(String(40), nullable=True, index=True, unique=True)
+
+    def __init__(self, **kwargs):
+        Base.__init__(self, **kwargs)
+        if self.hash is None:
+            self.hash = self.makeHash(self.name, self.source, self.value)
+
+    @staticmethod
+    def makeHash(name, source, value):
+        """Returns a hash of a property's name, source and value"""
+        data = json.dumps([name, source, value], sort_keys=True,
+                          separators=(',', ':'))
+        return hashlib.sha1(data).hexdigest()
 
     @staticmethod
     def equals(dbprops, bbprops):
@@ -116,40 +277,73 @@ class Property(Base):
     @classmethod
     def get(cls, session, name, source, value):
         """Retrieve the Property for the given name, source, and value.  If the
-        property doesn't exist, it will be created and added to the session,
-        but not committed."""
-        name = unicode(name)
-        source = unicode(source)
-        p = session.query(
-            cls).filter_by(name=name, source=source, value=value).first()
-        if not p:
-            p = cls(name=name, source=source, value=value)
-            session.add(p)
-        return p
+        property doesn't exist, it will be created."""
+        return cls.getall(session, [(name, source, value)])[0]
+
+    @classmethod
+    def getall(cls, session, props):
+        """Retrieve the Property objects for a list of (name, source, value).
+        Any that don't exist are inserted into the database, but not
+        committed."""
+        wanted = OrderedDict()
+        for name, source, value in props:
+            name = unicode(name)
+            source = unicode(source)
+            wanted[cls.makeHash(name, source, value)] = (name, source, value)
+
+        # Look up the ones we've seen recently by id, and the rest by hash
+        ids = []
+        hashes = []
+        for h in wanted:
+            i = propertyIds.get(h)
+            if i is None:
+                hashes.append(h)
+            else:
+                ids.append(i)
+        criteria = []
+        if ids:
+            criteria.append(cls.id.in_(ids))
+        if hashes:
+            criteria.append(cls.hash.in_(hashes))
+        found = {}
+        if criteria:
+            found = cls._find(session, sqlalchemy.or_(*criteria))
+
+        missing = [h for h in wanted if h not in found]
+        if missing:
+            # These include any ids we had cached that have since been
+            # rolled back
+            for h in missing:
+                propertyIds.discard(h)
+            insertIgnore(session, cls.__table__,
+                         [dict(name=wanted[h][0], source=wanted[h][1],
+                               value=wanted[h][2], hash=h) for h in missing])
+            found.update(cls._find(session, cls.hash.in_(missing),
+                                   lock=True))
+
+        return [found[h] for h in wanted]
+
+    @classmethod
+    def _find(cls, session, criterion, lock=False):
+        found = {}
+        q = session.query(cls).filter(criterion)
+        if lock:
+            q = lockingRead(q)
+        for p in q:
+            found[p.hash] = p
+            propertyIds.set(p.hash, p.id)
+        return found
 
     @classmethod
     def fromBBProperties(cls, session, props):
         """Return a list of Property objects that reflect a buildbot Properties
         object."""
-        names = [unicode(p[0]) for p in props.asList()]
-        values = [p[1] for p in props.asList()]
-        sources = [unicode(p[2]) for p in props.asList()]
-        all = (session.query(cls).filter(cls.name.in_(names))
-                                 .filter(sqlalchemy.or_(cls.value.in_(values), cls.value is None))
-                                 .filter(cls.source.in_(sources)).all())
-
-        retval = []
-        for prop in all:
-            if prop.name in props and props[prop.name] == prop.value and \
-                    props.getPropertySource(prop.name) == prop.source:
-                retval.append(prop)
-
-        new_props = set(names) - set([p.name for p in retval])
-        for name in new_props:
-            p = cls(name=unicode(name), value=props[name],
-                    source=unicode(props.getPropertySource(name)))
-            retval.append(p)
-        return retval
+        return cls.getall(session, [(name, source, value) for
+                                    (name, value, source) in props.asList()])
+
+
+# Ids of recently used properties, by hash
+propertyIds = LRUCache(10000)
 
 
 class Master(Base):
@@ -275,6 +469,18 @@ class Change(Base):
     files = relation(File, secondary=file_changes)
     comments = Column(UnicodeText, nullable=True)
     when = Column(DateTime, nullable=True)
+    # See makeFingerprint; older rows are filled in by backfillFingerprints
+    fingerprint = Column(String(40), nullable=True, index=True)
+
+    @staticmethod
+    def makeFingerprint(number, branch, revision, who, comments, when, paths):
+        """Returns a hash of a change's fields and files"""
+        if when is not None:
+            # MySQL doesn't keep fractions of a second
+            when = when.strftime('%Y-%m-%d %H:%M:%S')
+        data = json.dumps([number, branch, revision, who, comments, when,
+                           sorted(paths)], separators=(',', ':'))
+        return hashlib.sha1(data).hexdigest()
 
     def equals(self, bbChange):
         """Returns True if this Change refers to the same thing as a buildbot
@@ -303,53 +509,29 @@ class Change(Base):
     def fromBBChange(cls, session, change):
         """Return a Change database object that reflects a buildbot Change
         object object."""
-        # Look for a change object in the database
         if change.when:
             when = datetime.datetime.utcfromtimestamp(change.when)
         else:
             when = None
+        fields = dict(number=change.number,
+                      branch=unicode(change.branch),
+                      revision=unicode(change.revision),
+                      who=unicode(change.who),
+                      comments=unicode(change.comments),
+                      when=when)
+        fingerprint = cls.makeFingerprint(
+            paths=[unicode(f) for f in change.files], **fields)
 
-        if change.revision is None:
-            revision = None
-        else:
-            revision = unicode(change.revision)
-        possible_changes_q = session.query(cls).filter_by(
-            number=change.number,
-            branch=unicode(change.branch),
-            revision=revision,
-            who=unicode(change.who),
-            comments=unicode(change.comments),
-            when=when,
-        )
-        possible_changes = possible_changes_q.all()
-        log.debug("got %i possible_changes", len(possible_changes))
-
-        # Look at files
-        for c in possible_changes:
-            files = [f.path for f in c.files]
-            files.sort()
-            if files != sorted([f.path for f in c.files]):
-                continue
+        # Look for a change object in the database
+        c = session.query(cls).filter_by(fingerprint=fingerprint).first()
+        if c:
             return c
 
         # We didn't find an existing object in the database, so
         # let's create one
         log.debug("creating new change row (%i files)", len(change.files))
-        if change.when:
-            when = datetime.datetime.utcfromtimestamp(change.when)
-        else:
-            when = None
-        c = cls(number=change.number,
-                branch=unicode(change.branch),
-                revision=unicode(change.revision),
-                who=unicode(change.who),
-                comments=unicode(change.comments),
-                when=when,
-                )
-        if len(change.files) > 20:
-            c.files = File.getall(session, change.files)
-        else:
-            c.files = [File.get(session, path) for path in change.files]
+        c = cls(fingerprint=fingerprint, **fields)
+        c.files = File.getall(session, change.files)
         return c
 
 
@@ -379,6 +561,21 @@ class SourceStamp(Base):
     patch_id = Column(Integer, ForeignKey(Patch.id), nullable=True)
     patch = relation(Patch)
     changes = relation(SourceChange, order_by=SourceChange.order)
+    # See makeFingerprint; older rows are filled in by backfillFingerprints
+    fingerprint = Column(String(40), nullable=True, index=True)
+
+    @staticmethod
+    def makeFingerprint(branch, revision, patch, change_ids):
+        """Returns a hash of a sourcestamp's fields, its (patchlevel,
+        patchdata) if it has a patch, and the ids of its changes"""
+        if patch is not None:
+            patchlevel, patchdata = patch
+            if isinstance(patchdata, unicode):
+                patchdata = patchdata.encode('utf8')
+            patch = [patchlevel, hashlib.sha1(patchdata).hexdigest()]
+        data = json.dumps([branch, revision, patch, sorted(change_ids)],
+                          separators=(',', ':'))
+        return hashlib.sha1(data).hexdigest()
 
     def equals(self, bbSource):
         """Returns True if this SourceStamp refers to the same thing as a buildbot
@@ -413,6 +610,19 @@ class SourceStamp(Base):
     def fromBBSourcestamp(cls, session, ss):
         """Return a database SourceStamp object that reflect a buildbot SourceStamp"""
         changes = [Change.fromBBChange(session, c) for c in ss.changes]
+        new_changes = [c for c in changes if c.id is None]
+        if new_changes:
+            # We need their ids for the fingerprint
+            session.add_all(new_changes)
+            session.flush()
+        fingerprint = cls.makeFingerprint(unicode(ss.branch),
+                                          unicode(ss.revision), ss.patch,
+                                          [c.id for c in changes])
+        if not new_changes:
+            s = session.query(cls).filter_by(fingerprint=fingerprint).first()
+            if s:
+                return s
+
         changes = [SourceChange(
             change=change, order=i) for i, change in enumerate(changes)]
         if ss.patch:
@@ -420,20 +630,11 @@ class SourceStamp(Base):
             patch = Patch(patch=patchdata, patchlevel=patchlevel)
         else:
             patch = None
-        s = session.query(cls).filter_by(branch=unicode(ss.branch),
-                                         revision=unicode(ss.revision),
-                                         patch=patch).first()
-        # Compare list of changes
-        if s:
-            if sorted([c.change.id for c in s.changes]) == sorted([c.change.id for c in changes]):
-                return s
-            s = None
-        if not s:
-            s = cls(branch=unicode(ss.branch),
-                    revision=unicode(ss.revision),
-                    patch=patch,
-                    changes=changes)
-        return s
+        return cls(branch=unicode(ss.branch),
+                   revision=unicode(ss.revision),
+                   patch=patch,
+                   changes=changes,
+                   fingerprint=fingerprint)
 
 
 class Request(Base):
@@ -635,3 +836,44 @@ schedulerdb_requests = Table('schedulerdb_requests', Base.metadata,
                              Column('scheduler_build_id',
                                     Integer, nullable=False, index=True),
                              )
+
+
+def backfillFingerprints(session, batchSize=500):
+    """Fill in the fingerprints of up to batchSize changes and sourcestamps
+    that were written before they had one, and commit.  Returns how many rows
+    were updated; once that is 0 there are none left.  Progress is kept in
+    the database, so this can be stopped and picked up again at any time."""
+    changes = session.query(Change).filter(Change.fingerprint == null()).\
+        order_by(Change.id).limit(batchSize).all()
+    if changes:
+        paths = dict((c.id, []) for c in changes)
+        q = session.query(file_changes.c.change_id, File.path).filter(
+            file_changes.c.file_id == File.id).filter(
+            file_changes.c.change_id.in_(paths.keys()))
+        for change_id, path in q:
+            paths[change_id].append(path)
+        for c in changes:
+            c.fingerprint = Change.makeFingerprint(
+                c.number, c.branch, c.revision, c.who, c.comments, c.when,
+                paths[c.id])
+
+    sourcestamps = session.query(SourceStamp).\
+        filter(SourceStamp.fingerprint == null()).\
+        options(sqlalchemy.orm.eagerload('patch')).\
+        order_by(SourceStamp.id).limit(batchSize).all()
+    if sourcestamps:
+        change_ids = dict((s.id, []) for s in sourcestamps)
+        q = session.query(SourceChange.source_id, SourceChange.change_id).\
+            filter(SourceChange.source_id.in_(change_ids.keys()))
+        for source_id, change_id in q:
+            change_ids[source_id].append(change_id)
+        for s in sourcestamps:
+            if s.patch:
+                patch = (s.patch.patchlevel, s.patch.patch)
+            else:
+                patch = None
+            s.fingerprint = SourceStamp.makeFingerprint(
+                s.branch, s.revision, patch, change_ids[s.id])
+
+    session.commit()
+    return len(changes) + len(sourcestamps)
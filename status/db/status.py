@@ -1,12 +1,16 @@
 import sys
+import copy
+import time
 from datetime import datetime
 
 import sqlalchemy
 
-from twisted.python import log
-from twisted.internet import reactor
+from twisted.python import log, threadable
+from twisted.python.threadpool import ThreadPool
+from twisted.internet import reactor, defer, threads
 
 from buildbot.status import base
+from buildbot.process.properties import Properties
 from buildbot.status.builder import FAILURE, HEADER
 import buildbot.scripts.checkconfig as checkconfig
 
@@ -14,6 +18,443 @@ import model
 reload(model)
 
 
+def copyProperties(props):
+    """Return a copy of a buildbot Properties object, which the build will
+    keep changing"""
+    copied = Properties()
+    copied.updateFromProperties(props)
+    return copied
+
+
+class StepSnapshot:
+    """The parts of a buildbot step status that are written to the database,
+    as they were when this was created"""
+
+    def __init__(self, step):
+        self.name = step.name
+        self.text = copy.copy(step.text)
+        self.results = step.results
+        self.started = step.started
+        self.finished = step.finished
+
+
+class BuildSnapshot:
+    """The parts of a buildbot build status that are written to the
+    database, as they were when this was created.  Worker threads are given
+    one of these instead of the build, which the reactor keeps changing."""
+
+    def __init__(self, build):
+        self.number = build.number
+        self.reason = build.reason
+        self.results = build.results
+        self.started = build.started
+        self.finished = build.finished
+        self.slavename = build.getSlavename()
+        self.sourceStamp = build.getSourceStamp()
+        if hasattr(build, 'getRequests'):
+            self.requests = list(build.getRequests())
+        else:
+            self.requests = []
+        self.properties = copyProperties(build.getProperties())
+        self.steps = [StepSnapshot(s) for s in build.steps]
+
+    def getSlavename(self):
+        return self.slavename
+
+    def getSourceStamp(self):
+        return self.sourceStamp
+
+    def getRequests(self):
+        return self.requests
+
+    def getProperties(self):
+        return self.properties
+
+
+class StatusWriter:
+    """Writes step and build property updates to the database in batches.
+
+    Updates are queued per build, with later updates to the same step or to
+    the build's properties replacing earlier ones, and written out in one
+    transaction from a worker thread flushDelay seconds after the first one.
+    Once maxPending steps and property sets are queued, they're written out
+    straight away instead. Batches are written one at a time, and while one
+    is being written further updates keep being coalesced into the next, so a
+    slow database means fewer, larger batches rather than a stalled reactor.
+    There's no other back-pressure: what bounds the queue is that it holds at
+    most one entry per step and one set of properties per build, so it never
+    outgrows the builds that are running.  Anything still queued is written
+    out when the master shuts down.
+
+    If a batch can't be written, its builds are written one at a time, so
+    one bad build doesn't lose the others' updates.  Updates that fail
+    because of the database connection are queued again, underneath anything
+    newer, and retried after retryDelay seconds; `lostConnection` is called
+    so the status plugin can reconnect."""
+
+    flushDelay = 1
+    maxPending = 1000
+    retryDelay = 60
+
+    def __init__(self, Session, lostConnection=None):
+        self.Session = Session
+        self.lostConnection = lostConnection
+        # build_id -> {'steps': {step name: {column: value}},
+        #              'properties': Properties or None}
+        self.pending = {}
+        # Number of steps and property sets in pending
+        self.numPending = 0
+        self.lock = defer.DeferredLock()
+        # Deferreds to fire once the flush that's waiting for the lock is
+        # done, or None if there's no such flush
+        self.flushWaiters = None
+        self.flushTimer = None
+        self.stopped = False
+        self.shutdownTrigger = reactor.addSystemEventTrigger(
+            'before', 'shutdown', self.stop)
+
+    def stepStarted(self, build_id, step):
+        self.updateStep(build_id, step.name,
+                        starttime=datetime.utcfromtimestamp(step.started),
+                        description=step.text)
+        self.queued()
+
+    def stepFinished(self, build_id, properties, step, results):
+        fields = dict(status=results[0], description=step.text)
+        if step.finished:
+            fields['endtime'] = datetime.utcfromtimestamp(step.finished)
+        self.updateStep(build_id, step.name, **fields)
+        b = self.getBuild(build_id)
+        if b['properties'] is None:
+            self.numPending += 1
+        b['properties'] = properties
+        self.queued()
+
+    def getBuild(self, build_id):
+        if build_id not in self.pending:
+            self.pending[build_id] = {'steps': {}, 'properties': None}
+        return self.pending[build_id]
+
+    def updateStep(self, build_id, name, **fields):
+        steps = self.getBuild(build_id)['steps']
+        if name not in steps:
+            steps[name] = {}
+            self.numPending += 1
+        steps[name].update(fields)
+
+    def queued(self):
+        if self.flushWaiters is not None:
+            # The next flush will pick this up
+            return
+        if self.numPending >= self.maxPending:
+            log.msg("DBMSG: %i status updates queued; writing them now" %
+                    self.numPending)
+            self.flush()
+        elif self.stopped:
+            self.flush()
+        elif self.flushTimer is None:
+            self.flushTimer = reactor.callLater(self.flushDelay, self.flush)
+
+    def takePending(self):
+        batch, self.pending, self.numPending = self.pending, {}, 0
+        return batch
+
+    def flush(self):
+        """Write out everything queued so far. Returns a Deferred that fires
+        when it's been written."""
+        if self.flushTimer is not None:
+            if self.flushTimer.active():
+                self.flushTimer.cancel()
+            self.flushTimer = None
+        d = defer.Deferred()
+        if self.flushWaiters is None:
+            self.flushWaiters = [d]
+            self.lock.run(self._flush)
+        else:
+            # The flush that's waiting will take everything queued when it
+            # starts
+            self.flushWaiters.append(d)
+        return d
+
+    def _flush(self):
+        waiters, self.flushWaiters = self.flushWaiters, None
+        batch = self.takePending()
+        if batch:
+            d = threads.deferToThread(self.write, batch)
+            d.addCallback(self.requeue)
+        else:
+            d = defer.succeed(None)
+
+        def done(_):
+            for w in waiters:
+                w.callback(None)
+        d.addBoth(done)
+        return d
+
+    def write(self, batch):
+        """Write out batch, returning the updates for any builds that should
+        be retried"""
+        try:
+            self.writeBuilds(batch)
+            return {}
+        except sqlalchemy.exc.OperationalError:
+            log.msg("DBERROR: Lost connection writing status updates for "
+                    "builds %s" % sorted(batch.keys()))
+            log.err()
+            return batch
+        except:
+            log.msg("DBERROR: Couldn't write status updates for builds %s; "
+                    "writing them one at a time" % sorted(batch.keys()))
+            log.err()
+
+        failed = {}
+        for build_id, updates in batch.items():
+            try:
+                self.writeBuilds({build_id: updates})
+            except sqlalchemy.exc.OperationalError:
+                log.msg("DBERROR: Lost connection writing status updates for "
+                        "build %s" % build_id)
+                log.err()
+                failed[build_id] = updates
+            except:
+                log.msg("DBERROR: Couldn't write status updates for build %s"
+                        % build_id)
+                log.err()
+        return failed
+
+    def writeBuilds(self, batch):
+        session = self.Session()
+        try:
+            for build_id, updates in batch.items():
+                for name, fields in updates['steps'].items():
+                    s = model.Step.get(session, name=name, build_id=build_id)
+                    for column, value in fields.items():
+                        setattr(s, column, value)
+                if updates['properties'] is not None:
+                    b = session.query(model.Build).get(build_id)
+                    if b:
+                        b.properties = model.Property.fromBBProperties(
+                            session, updates['properties'])
+            session.commit()
+        finally:
+            session.close()
+
+    def requeue(self, failed):
+        """Queue the updates in failed again, under any that have been
+        queued since"""
+        if not failed:
+            return
+        for build_id, updates in failed.items():
+            b = self.getBuild(build_id)
+            for name, fields in updates['steps'].items():
+                if name not in b['steps']:
+                    b['steps'][name] = {}
+                    self.numPending += 1
+                newer = b['steps'][name]
+                b['steps'][name] = dict(fields, **newer)
+            if b['properties'] is None and \
+                    updates['properties'] is not None:
+                b['properties'] = updates['properties']
+                self.numPending += 1
+        if self.stopped:
+            # The next update will flush these
+            return
+        log.msg("DBMSG: Retrying status updates for builds %s in %is" %
+                (sorted(failed.keys()), self.retryDelay))
+        if self.flushTimer is not None and self.flushTimer.active():
+            self.flushTimer.cancel()
+        self.flushTimer = reactor.callLater(self.retryDelay, self.flush)
+        if self.lostConnection:
+            self.lostConnection()
+
+    def stop(self):
+        """Write out anything that's still queued, and write any further
+        updates as they come in"""
+        self.stopped = True
+        if self.shutdownTrigger is not None:
+            reactor.removeSystemEventTrigger(self.shutdownTrigger)
+            self.shutdownTrigger = None
+        return self.flush()
+
+
+class StatusExecutor:
+    """Runs statusdb work, either on the reactor thread or, if `threads` is
+    set, in a pool of that many worker threads.
+
+    Each piece of work is run with a list of keys, and only once everything
+    submitted earlier with any of the same keys is done. So updates for one
+    build are applied in order, while different builds are updated in
+    parallel."""
+
+    def __init__(self, threads=0):
+        # Seconds spent running work on the reactor thread
+        self.blocked = 0.0
+        # key -> Deferred that fires when the last work with that key is done
+        self.tails = {}
+        self.pool = None
+        self.shutdownTrigger = None
+        if threads:
+            self.pool = ThreadPool(1, threads, 'statusdb')
+            self.pool.start()
+            self.shutdownTrigger = reactor.addSystemEventTrigger(
+                'before', 'shutdown', self.stop)
+
+    def run(self, keys, f, *args):
+        if self.pool is None:
+            start = time.time()
+            try:
+                return defer.maybeDeferred(f, *args)
+            finally:
+                self.blocked += time.time() - start
+
+        waiting = [self.tails[k] for k in keys if k in self.tails]
+        done = defer.Deferred()
+        for k in keys:
+            self.tails[k] = done
+        if waiting:
+            d = defer.DeferredList(waiting)
+        else:
+            d = defer.succeed(None)
+        d.addCallback(lambda _: threads.deferToThreadPool(
+            reactor, self.pool, f, *args))
+
+        def finished(result):
+            for k in keys:
+                if self.tails.get(k) is done:
+                    del self.tails[k]
+            done.callback(None)
+            return result
+        d.addBoth(finished)
+        return d
+
+    def stop(self):
+        """Wait for queued work to finish, and stop the worker threads. Any
+        further work is run on the reactor thread."""
+        if self.pool is None:
+            return defer.succeed(None)
+        if self.tails:
+            d = defer.DeferredList(list(set(self.tails.values())))
+            d.addCallback(lambda _: self.stop())
+            return d
+        if self.shutdownTrigger is not None:
+            reactor.removeSystemEventTrigger(self.shutdownTrigger)
+            self.shutdownTrigger = None
+        self.pool.stop()
+        self.pool = None
+        return defer.succeed(None)
+
+
+class ReactorLatency:
+    """Measures how late the reactor is in running a timer, which is how long
+    it was kept busy by other work, and periodically logs that along with how
+    much time `executor` spent running statusdb work on the reactor thread."""
+
+    interval = 1
+    reportInterval = 300
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.timer = None
+
+    def start(self):
+        self.lastReport = time.time()
+        self.lastBlocked = self.executor.blocked
+        self.samples = []
+        self.schedule()
+
+    def schedule(self):
+        self.expected = time.time() + self.interval
+        self.timer = reactor.callLater(self.interval, self.tick)
+
+    def tick(self):
+        now = time.time()
+        self.samples.append(max(0, now - self.expected))
+        if now - self.lastReport >= self.reportInterval:
+            self.report(now)
+        self.schedule()
+
+    def report(self, now):
+        if self.samples:
+            blocked = self.executor.blocked - self.lastBlocked
+            log.msg("DBMSG: reactor latency over %is: mean %.3fs, max %.3fs; "
+                    "%.3fs spent on statusdb work in the reactor thread" %
+                    (now - self.lastReport,
+                     sum(self.samples) / len(self.samples),
+                     max(self.samples), blocked))
+        self.lastReport = now
+        self.lastBlocked = self.executor.blocked
+        self.samples = []
+
+    def stop(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+
+class FingerprintBackfill:
+    """Fills in the fingerprints of changes and sourcestamps written before
+    they had one, a batch at a time, until there are none left.  Batches are
+    run in `executor`'s worker threads, or with deferToThread if it doesn't
+    have any, so they never hold up the reactor.  Each batch is committed, so
+    a restart carries on where this left off."""
+
+    batchSize = 500
+    # Seconds between batches, and before retrying after an error
+    interval = 1
+    retryInterval = 300
+
+    def __init__(self, Session, executor):
+        self.Session = Session
+        self.executor = executor
+        self.timer = None
+        self.total = 0
+        self.stopped = False
+
+    def start(self):
+        self.schedule(self.interval)
+
+    def schedule(self, delay):
+        self.timer = reactor.callLater(delay, self.run)
+
+    def run(self):
+        self.timer = None
+        if self.executor.pool:
+            d = self.executor.run([('backfill',)], self.batch)
+        else:
+            d = threads.deferToThread(self.batch)
+        d.addCallbacks(self.batchDone, self.batchFailed)
+        return d
+
+    def batch(self):
+        session = self.Session()
+        try:
+            return model.backfillFingerprints(session, self.batchSize)
+        finally:
+            session.close()
+
+    def batchDone(self, count):
+        self.total += count
+        if self.stopped:
+            return
+        if count:
+            self.schedule(self.interval)
+        elif self.total:
+            log.msg("DBMSG: filled in %i fingerprints" % self.total)
+
+    def batchFailed(self, failure):
+        log.msg("DBERROR: Couldn't fill in fingerprints, retrying in %is" %
+                self.retryInterval)
+        log.err(failure)
+        if not self.stopped:
+            self.schedule(self.retryInterval)
+
+    def stop(self):
+        self.stopped = True
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+
 class DBBuildStatus(base.StatusReceiver):
     """This class monitors the status for an individual build.  It receives
     stepStarted, stepFinished, logStarted, logFinished and logChunk
@@ -21,9 +462,19 @@ class DBBuildStatus(base.StatusReceiver):
     along with the database step object (the logChunk notification receives
     only the database id for the step, to prevent excessive database lookups).
 
-    It updates the database on stepStarted and stepFinished events."""
-    def __init__(self, build_id, subscribers=None):
+    It updates the database on stepStarted and stepFinished events. If it has
+    no subscribers to hand the database step objects to, the updates are
+    queued on `writer` instead of being written immediately, or run in
+    `executor`'s worker threads in order with everything else for `key` if it
+    has any."""
+    def __init__(self, build_id, subscribers=None, writer=None, executor=None,
+                 key=None):
+        # In threaded mode, this is set by DBStatus once the build is in the
+        # database
         self.build_id = build_id
+        self.writer = writer
+        self.executor = executor
+        self.key = key
 
         self.subscribers = subscribers or []
 
@@ -38,10 +489,24 @@ class DBBuildStatus(base.StatusReceiver):
 
     def stepStarted(self, build, step):
         """Create this step in the database, and give it a start time"""
+        if self.executor and self.executor.pool:
+            # There are no subscribers to hand the build to in threaded mode
+            self.executor.run([self.key], self._stepStarted, None,
+                              StepSnapshot(step))
+            return self
+        if self.writer and not self.subscribers:
+            self.writer.stepStarted(self.build_id, step)
+            return self
+        return self._stepStarted(build, step)
+
+    def _stepStarted(self, build, step):
+        if self.build_id is None:
+            # We couldn't add the build
+            return
         session = self.Session()
         try:
             b = session.query(model.Build).options(
-                model.eagerload('steps')).get(self.build_id)
+                sqlalchemy.orm.eagerload('steps')).get(self.build_id)
             s = model.Step.get(session, name=step.name, build_id=self.build_id)
             s.starttime = datetime.utcfromtimestamp(step.started)
             s.description = step.text
@@ -68,6 +533,21 @@ class DBBuildStatus(base.StatusReceiver):
     def stepFinished(self, build, step, results):
         """Mark this step as finished in the database, giving it an endtime,
         saving the status, description, and updating the build properties."""
+        # The build keeps changing its properties, so take a copy of them as
+        # they are now
+        properties = copyProperties(build.getProperties())
+        if self.executor and self.executor.pool:
+            self.executor.run([self.key], self._stepFinished, None,
+                              StepSnapshot(step), results, properties)
+            return
+        if self.writer and not self.subscribers:
+            self.writer.stepFinished(self.build_id, properties, step, results)
+            return
+        self._stepFinished(build, step, results, properties)
+
+    def _stepFinished(self, build, step, results, properties):
+        if self.build_id is None:
+            return
         session = self.Session()
         try:
             # We may not have been called with stepStarted, so the step may not
@@ -92,7 +572,7 @@ class DBBuildStatus(base.StatusReceiver):
             b = session.query(model.Build).get(self.build_id)
             if b:
                 b.properties = model.Property.fromBBProperties(
-                    session, build.getProperties())
+                    session, properties)
 
             session.commit()
             # Notify our subscribers that the step is done
@@ -182,12 +662,16 @@ class DBStatus(base.StatusReceiverMultiService):
     """Database Status plugin for Buildbot.
 
     This plugin records all information about builders, builds, and steps, in an SQL database."""
-    def __init__(self, dburl, name=None, subscribers=None):
+    def __init__(self, dburl, name=None, subscribers=None, threads=0):
         """
         dburl:          an SQLAlchemy database URL that specifies how to connect to the SQL database
         subscribers:    a list of objects to receive status notifications augmented with database information.
         name:           a human friendly name for this master
+        threads:        if set, update the database from this many worker threads instead of the reactor thread.
+                        Subscribers need the database objects in the reactor thread, so can't be used with this.
         """
+        if threads and subscribers:
+            raise ValueError("DBStatus can't use threads with subscribers")
         base.StatusReceiverMultiService.__init__(self)
 
         # Mapping of buildbot Request objects to database Request objects.
@@ -200,8 +684,16 @@ class DBStatus(base.StatusReceiverMultiService):
         self.name = name
         self.status = None
         self.orig_parent = None
+        self.threads = threads
+        self.writer = None
+        self.executor = None
+        self.latency = None
+        self.backfill = None
 
     def lostConnection(self):
+        if not threadable.isInIOThread():
+            reactor.callFromThread(self.lostConnection)
+            return
         log.msg("DBERROR: Lost connection to database, trying to reconnect in 60 seconds")
         self.disownServiceParent()
         reactor.callLater(60, self.setServiceParent, self.orig_parent)
@@ -222,6 +714,11 @@ class DBStatus(base.StatusReceiverMultiService):
         # happening.
         try:
             self.Session = model.connect(self.dburl, pool_recycle=60)
+            self.executor = StatusExecutor(self.threads)
+            if not self.threads:
+                self.writer = StatusWriter(self.Session, self.lostConnection)
+            self.latency = ReactorLatency(self.executor)
+            self.latency.start()
 
             # Let our subscribers know about the database connection
             # This gives them the opportunity to set up their own tables, etc.
@@ -234,15 +731,35 @@ class DBStatus(base.StatusReceiverMultiService):
                         log.err()
 
             self.setup()
+            self.startBackfill()
         except:
             if sys.exc_info()[0] is not sqlalchemy.exc.OperationalError:
                 log.msg("DBERROR: Couldn't connect to database")
                 log.err()
             self.lostConnection()
 
+    def startBackfill(self):
+        """Fill in missing fingerprints in the background"""
+        self.backfill = FingerprintBackfill(self.Session, self.executor)
+        self.backfill.start()
+
     def disownServiceParent(self):
         log.msg("Stopping DB Status handler")
         base.StatusReceiverMultiService.disownServiceParent(self)
+        if self.backfill:
+            self.backfill.stop()
+            self.backfill = None
+        if self.writer:
+            # Builds that are still running may carry on using it until
+            # they're done
+            self.writer.stop()
+            self.writer = None
+        if self.executor:
+            self.executor.stop()
+            self.executor = None
+        if self.latency:
+            self.latency.stop()
+            self.latency = None
         try:
             if self.status:
                 self.status.unsubscribe(self)
@@ -359,11 +876,26 @@ class DBStatus(base.StatusReceiverMultiService):
             session.close()
 
     def builderAdded(self, name, builder):
+        self.builders.append(builder)
+        builds = dict((b.number, b) for b in builder.currentBuilds)
+        if self.executor.pool:
+            running = [BuildSnapshot(b) for b in builds.values()]
+        else:
+            running = builds.values()
+        d = self.executor.run([('builder', name)], self._builderAdded, name,
+                              builder.category, list(builder.slavenames),
+                              running)
+        d.addCallback(self.attachBuilds, name, builds)
+        return self
+
+    def _builderAdded(self, name, category, slavenames, builds):
+        """Updates the builder in the database, and returns (build number,
+        database build id) for each of `builds`, the builder's builds in
+        progress, which are in the database"""
         session = self.Session()
         try:
             b = model.Builder.get(session, name, self.master_id)
-            b.category = builder.category
-            self.builders.append(builder)
+            b.category = category
 
             db_slaves = set()
             db_slaves_by_name = {}
@@ -371,7 +903,7 @@ class DBStatus(base.StatusReceiverMultiService):
                 db_slaves.add(builder_slave.slave.name)
                 db_slaves_by_name[builder_slave.slave.name] = builder_slave
 
-            bb_slaves = set(s for s in builder.slavenames)
+            bb_slaves = set(slavenames)
 
             # Which slaves were added to this builder
             new_slaves = bb_slaves - db_slaves
@@ -391,30 +923,52 @@ class DBStatus(base.StatusReceiverMultiService):
 
             session.commit()
 
-            # Subscribe to all builds that are currently in progress
-            for build in builder.currentBuilds:
-                log.msg("DBMSG: Attaching to %s %s" % (name, build))
+            # Find all builds that are currently in progress
+            running = []
+            for build in builds:
                 db_build = session.query(model.Build).filter_by(buildnumber=build.number, builder_id=b.id, endtime=None).first()
                 if not db_build:
                     continue
                 db_build.updateFromBBBuild(session, build)
-                status = DBBuildStatus(db_build.id, self.subscribers)
-                build.subscribe(status)
-                d = build.waitUntilFinished()
-                d.addCallback(lambda s: s.unsubscribe(status))
-            return self
+                running.append((build.number, db_build.id))
+            return running
         except:
             log.msg("DBERROR: Couldn't add builder %s" % name)
             log.err()
         finally:
             session.close()
 
+    def attachBuilds(self, running, name, builds):
+        """Subscribe to builds that are in progress"""
+        for number, build_id in running or []:
+            build = builds[number]
+            log.msg("DBMSG: Attaching to %s %s" % (name, build))
+            status = DBBuildStatus(build_id, self.subscribers, self.writer,
+                                   self.executor, ('build', name, build.number))
+            build.subscribe(status)
+            d = build.waitUntilFinished()
+            d.addCallback(lambda s, status=status: s.unsubscribe(status))
+
     def buildStarted(self, builderName, build):
+        key = ('build', builderName, build.number)
+        status = DBBuildStatus(None, self.subscribers, self.writer,
+                               self.executor, key)
+        if self.executor.pool:
+            snapshot = BuildSnapshot(build)
+        else:
+            snapshot = build
+        # Wait for the build's requests to be added
+        self.executor.run([key, ('requests', builderName)],
+                          self._buildStarted, builderName, snapshot, status)
+        if self.executor.pool or status.build_id is not None:
+            return status
+
+    def _buildStarted(self, builderName, build, status):
         session = self.Session()
         try:
-            b = model.Build.fromBBBuild(session, build, builderName,
-                                        self.master_id,
-                                        self.request_mapping)
+            b = model.Build.fromBBBuild(
+                session, build, builderName, self.master_id,
+                self.takeRequests(self.getRequests(build)))
 
             for s in build.steps:
                 b.steps.append(model.Step(name=s.name, description=s.text))
@@ -427,7 +981,7 @@ class DBStatus(base.StatusReceiverMultiService):
                     except:
                         log.msg("DBERROR: Couldn't notify subscriber %s of build starting" % sub)
                         log.err()
-            return DBBuildStatus(b.id, self.subscribers)
+            status.build_id = b.id
         except:
             if sys.exc_info()[0] is sqlalchemy.exc.OperationalError:
                 self.lostConnection()
@@ -439,6 +993,20 @@ class DBStatus(base.StatusReceiverMultiService):
             session.close()
 
     def buildFinished(self, builderName, build, results):
+        if self.writer:
+            # Write out the build's queued step updates first, so that they
+            # can't overwrite its final properties
+            d = self.writer.flush()
+        else:
+            d = defer.succeed(None)
+        executor = self.executor
+        if executor.pool:
+            build = BuildSnapshot(build)
+        d.addCallback(lambda _: executor.run(
+            [('build', builderName, build.number)],
+            self._buildFinished, builderName, build, results))
+
+    def _buildFinished(self, builderName, build, results):
         session = self.Session()
         try:
             builder = model.Builder.get(session, builderName, self.master_id)
@@ -449,8 +1017,9 @@ class DBStatus(base.StatusReceiverMultiService):
             # the DB status plugin isn't active when the build started.  If we
             # can't find the build in the database, we should create it.
             if not b:
-                b = model.Build.fromBBBuild(session, build, builderName,
-                                            self.master_id, self.request_mapping)
+                b = model.Build.fromBBBuild(
+                    session, build, builderName, self.master_id,
+                    self.takeRequests(self.getRequests(build)))
 
             finished = datetime.utcfromtimestamp(build.finished)
             b.endtime = finished
@@ -479,6 +1048,10 @@ class DBStatus(base.StatusReceiverMultiService):
             session.close()
 
     def requestSubmitted(self, request):
+        self.executor.run([('requests', request.builderName)],
+                          self._requestSubmitted, request)
+
+    def _requestSubmitted(self, request):
         session = self.Session()
         try:
             # Add any new request into the database, as well as into our
@@ -488,8 +1061,7 @@ class DBStatus(base.StatusReceiverMultiService):
             r = model.Request.fromBBRequest(session, builder, request)
             session.add(r)
             session.commit()
-            self.request_mapping[request] = r
-            log.msg("DBMSG: Mapping %i requests" % len(self.request_mapping))
+            self.mapRequest(request, r)
         except:
             if sys.exc_info()[0] is sqlalchemy.exc.OperationalError:
                 self.lostConnection()
@@ -501,15 +1073,19 @@ class DBStatus(base.StatusReceiverMultiService):
             session.close()
 
     def requestCancelled(self, builder, request):
-        if request in self.request_mapping:
+        self.executor.run([('requests', request.builderName)],
+                          self._requestCancelled, request)
+
+    def _requestCancelled(self, request):
+        mapped = self.takeRequests([request])
+        if request in mapped:
             try:
                 # This request was cancelled by a user via the web interface
                 # We need to mark it as cancelled in the database as well
                 session = self.Session()
-                req = session.merge(self.request_mapping[request])
+                req = session.merge(mapped[request])
                 req.cancelled = True
                 session.commit()
-                del self.request_mapping[request]
             except:
                 if sys.exc_info()[0] is sqlalchemy.exc.OperationalError:
                     self.lostConnection()
@@ -522,7 +1098,37 @@ class DBStatus(base.StatusReceiverMultiService):
         else:
             log.msg("DBERROR: Couldn't cancel unmapped request")
 
+    def getRequests(self, build):
+        if hasattr(build, 'getRequests'):
+            return build.getRequests()
+        return []
+
+    def mapRequest(self, request, r):
+        """Record `r` as the database request for buildbot's `request`.  This
+        runs on the reactor thread, like everything else that uses
+        request_mapping."""
+        if not threadable.isInIOThread():
+            reactor.callFromThread(self.mapRequest, request, r)
+            return
+        self.request_mapping[request] = r
+        log.msg("DBMSG: Mapping %i requests" % len(self.request_mapping))
+
+    def takeRequests(self, requests):
+        """Remove the database requests for `requests` from request_mapping,
+        returning a dict of the ones that were there.  Worker threads wait
+        for this to be done on the reactor thread, after any mapRequest calls
+        they've made."""
+        if not threadable.isInIOThread():
+            return threads.blockingCallFromThread(reactor, self.takeRequests,
+                                                  requests)
+        return dict((req, self.request_mapping.pop(req)) for req in requests
+                    if req in self.request_mapping)
+
     def slaveConnected(self, slaveName):
+        self.executor.run([('slave', slaveName)], self._slaveConnected,
+                          slaveName)
+
+    def _slaveConnected(self, slaveName):
         session = self.Session()
         try:
             model.MasterSlave.setConnected(session, self.master_id, slaveName)
@@ -538,6 +1144,10 @@ class DBStatus(base.StatusReceiverMultiService):
             session.close()
 
     def slaveDisconnected(self, slaveName):
+        self.executor.run([('slave', slaveName)], self._slaveDisconnected,
+                          slaveName)
+
+    def _slaveDisconnected(self, slaveName):
         session = self.Session()
         try:
             model.MasterSlave.setDisconnected(
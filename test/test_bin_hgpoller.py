@@ -0,0 +1,255 @@
+from __future__ import with_statement
+
+import imp
+import os
+import urllib2
+from ConfigParser import RawConfigParser
+from StringIO import StringIO
+
+import mock
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from buildbot.util import json
+
+# bin/ isn't a package
+hgpoller = imp.load_source(
+    'bin_hgpoller',
+    os.path.join(os.path.dirname(__file__), '..', 'bin', 'hgpoller.py'))
+
+
+def makeChange(node, branch='default', files=None):
+    return {
+        'node': node,
+        'author': 'me <me@example.com>',
+        'desc': 'change %s' % node,
+        'files': files or ['%s.txt' % node],
+        'branch': branch,
+    }
+
+
+def makeConfig(**branch):
+    config = RawConfigParser(hgpoller.configDefaults)
+    config.add_section('main')
+    config.set('main', 'master', 'localhost:9989')
+    config.add_section('b1')
+    config.set('b1', 'url', 'http://hg/b1')
+    for k, v in branch.items():
+        config.set('b1', k, v)
+    return config
+
+
+class TestFlattenPushes(unittest.TestCase):
+    def testFlatten(self):
+        pushes = [
+            {'date': 10, 'changesets': [makeChange('a'), makeChange('b')]},
+            {'date': 20, 'changesets': [makeChange('c', files=['x', 'y'])]},
+        ]
+        changes = hgpoller.flattenPushes(pushes)
+        self.assertEquals([(c['changeset'], c['updated']) for c in changes],
+                          [('a', 10), ('b', 10), ('c', 20)])
+        self.assertEquals(changes[2], {
+            'changeset': 'c',
+            'author': 'me <me@example.com>',
+            'comments': 'change c',
+            'files': ['x', 'y'],
+            'branch': 'default',
+            'updated': 20,
+        })
+
+
+class TestPollBranch(unittest.TestCase):
+    def setUp(self):
+        self.config = makeConfig()
+        self.state = {}
+        self.getChanges = mock.Mock()
+        self.patch(hgpoller, 'getChanges', self.getChanges)
+        self.patch(hgpoller, 'log', mock.Mock())
+
+    def testNewChanges(self):
+        self.getChanges.return_value = hgpoller.flattenPushes([
+            {'date': 10, 'changesets': [makeChange('a'),
+                                        makeChange('b', branch='other')]},
+        ])
+        changes, last_changeset = hgpoller.pollBranch('b1', self.state,
+                                                      self.config)
+        # Off-default changes are skipped, but we don't look at them again
+        self.assertEquals([c['changeset'] for c in changes], ['a'])
+        self.assertEquals(changes[0]['comments'],
+                          'change a http://hg/b1/rev/a')
+        self.assertEquals(last_changeset, 'b')
+        self.assertEquals(self.getChanges.call_args[1]['last_changeset'],
+                          None)
+
+        # Too soon to poll again
+        self.assertEquals(
+            hgpoller.pollBranch('b1', self.state, self.config), None)
+        self.assertEquals(self.getChanges.call_count, 1)
+
+    def testNoChanges(self):
+        self.state['b1'] = {'last_run': 0, 'last_changeset': 'a'}
+        self.getChanges.return_value = []
+        self.assertEquals(
+            hgpoller.pollBranch('b1', self.state, self.config), None)
+        self.assertEquals(self.getChanges.call_args[1]['last_changeset'],
+                          'a')
+
+    def testReset(self):
+        self.state['b1'] = {'last_run': 0, 'last_changeset': 'a'}
+        self.getChanges.side_effect = urllib2.HTTPError(
+            'http://hg/b1', 500, 'Internal Server Error', {},
+            StringIO("unknown revision 'a'"))
+        self.assertEquals(
+            hgpoller.pollBranch('b1', self.state, self.config), None)
+        self.assertEquals(self.state['b1']['last_changeset'], None)
+
+
+class FakeRemote(object):
+    def __init__(self, failures):
+        # Changesets to fail to add, once each
+        self.failures = list(failures)
+        self.added = []
+        self.broker = mock.Mock()
+
+    def callRemote(self, method, change):
+        assert method == 'addChange'
+        if change['revision'] in self.failures:
+            self.failures.remove(change['revision'])
+            return defer.fail(ValueError("connection lost"))
+        self.added.append(change['revision'])
+        return defer.succeed(None)
+
+
+class TestChangeSender(unittest.TestCase):
+    def setUp(self):
+        self.remote = FakeRemote([])
+        factory = mock.Mock()
+        factory.return_value.login.side_effect = \
+            lambda creds: defer.succeed(self.remote)
+        self.patch(hgpoller.pb, 'PBClientFactory', factory)
+        self.patch(hgpoller, 'reactor', mock.Mock())
+        self.patch(hgpoller.task, 'deferLater',
+                   lambda reactor, delay, f, *args:
+                   defer.maybeDeferred(f, *args))
+        self.patch(hgpoller, 'log', mock.Mock())
+        self.sender = hgpoller.ChangeSender('localhost:9989')
+        self.changes = [hgpoller.flattenPushes(
+            [{'date': 10, 'changesets': [makeChange(n)]}])[0]
+            for n in 'abc']
+
+    def testSend(self):
+        d = self.sender.sendWithRetries('b1', self.changes)
+
+        def check(_):
+            self.assertEquals(self.remote.added, ['a', 'b', 'c'])
+            self.assertEquals(
+                hgpoller.reactor.connectTCP.call_args[0][:2],
+                ('localhost', 9989))
+            self.assertTrue(
+                self.remote.broker.transport.loseConnection.called)
+        d.addCallback(check)
+        return d
+
+    def testResume(self):
+        self.remote.failures = ['b', 'b', 'c']
+        acked = []
+        d = self.sender.sendWithRetries('b1', self.changes, acked)
+
+        def check(_):
+            # Nothing the master accepted was sent again
+            self.assertEquals(self.remote.added, ['a', 'b', 'c'])
+            self.assertEquals([c['changeset'] for c in acked],
+                              ['a', 'b', 'c'])
+            self.assertEquals(hgpoller.reactor.connectTCP.call_count, 4)
+        d.addCallback(check)
+        return d
+
+    def testGiveUp(self):
+        self.sender.retries = 2
+        self.remote.failures = ['b', 'b']
+        acked = []
+        d = self.sender.sendWithRetries('b1', self.changes, acked)
+
+        def check(f):
+            f.trap(ValueError)
+            self.assertEquals([c['changeset'] for c in acked], ['a'])
+        d.addCallbacks(self.fail, check)
+        return d
+
+
+class TestPollDaemon(unittest.TestCase):
+    def setUp(self):
+        self.config = makeConfig()
+        self.config.set('main', 'state_file', self.mktemp())
+        self.state = {}
+        self.sender = mock.Mock()
+        self.daemon = hgpoller.PollDaemon(['b1'], self.state, self.config,
+                                          self.sender)
+        self.patch(hgpoller.threads, 'deferToThread', defer.maybeDeferred)
+        self.log = mock.Mock()
+        self.patch(hgpoller, 'log', self.log)
+
+    def testPollAll(self):
+        changes = [{'changeset': 'a'}, {'changeset': 'b'}]
+        self.sender.sendWithRetries.return_value = defer.succeed(None)
+        with mock.patch.object(hgpoller, 'pollBranch') as pollBranch:
+            pollBranch.return_value = (changes, 'c')
+            d = self.daemon.pollAll()
+
+        def check(_):
+            self.assertEquals(self.sender.sendWithRetries.call_args[0][:2],
+                              ('b1', changes))
+            self.assertEquals(self.state['b1']['last_changeset'], 'c')
+            self.assertEquals(self.daemon.busy, set())
+            self.assertEquals(
+                json.load(open(self.config.get('main', 'state_file'))),
+                self.state)
+        d.addCallback(check)
+        return d
+
+    def testSendFailed(self):
+        def send(branch, changes, acked):
+            acked.append(changes[0])
+            return defer.fail(ValueError("master went away"))
+        self.sender.sendWithRetries.side_effect = send
+        with mock.patch.object(hgpoller, 'pollBranch') as pollBranch:
+            pollBranch.return_value = ([{'changeset': 'a'},
+                                        {'changeset': 'b'}], 'c')
+            d = self.daemon.pollAll()
+
+        def check(_):
+            # We carry on from the last change the master got
+            self.assertEquals(self.state['b1']['last_changeset'], 'a')
+            self.assertTrue(self.log.error.called)
+        d.addCallback(check)
+        return d
+
+    def testErrorsDontStopPolling(self):
+        self.daemon.state_file = os.path.join(self.mktemp(), 'missing',
+                                              'state.json')
+        with mock.patch.object(hgpoller, 'pollBranch') as pollBranch:
+            pollBranch.return_value = None
+            d = self.daemon.pollAll()
+
+        def check(result):
+            # The error was logged rather than stopping the LoopingCall
+            self.assertEquals(result, None)
+            self.assertTrue(self.log.error.called)
+        d.addCallback(check)
+        return d
+
+
+class TestSaveState(unittest.TestCase):
+    def testSave(self):
+        state_file = self.mktemp()
+        state = {'b1': {'last_run': 1, 'last_changeset': 'a'}}
+        hgpoller.saveState(state, state_file)
+        self.assertEquals(json.load(open(state_file)), state)
+        self.assertFalse(os.path.exists(state_file + '.tmp'))
+
+        # A failed write leaves the old state alone
+        with mock.patch.object(hgpoller.json, 'dump') as dump:
+            dump.side_effect = ValueError("can't serialize")
+            self.assertRaises(ValueError, hgpoller.saveState,
+                              {'b1': object()}, state_file)
+        self.assertEquals(json.load(open(state_file)), state)
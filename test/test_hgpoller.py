@@ -1,8 +1,17 @@
+from __future__ import with_statement
+
 from twisted.trial import unittest
+from twisted.internet import defer, reactor
+from twisted.python import failure
+from twisted.web import error
 import threading
 import socket
+import time
+from StringIO import StringIO
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
+import mock
+
 from buildbot.util import json
 if not hasattr(json.decoder, 'JSONDecodeError'):
     JSONDecodeError = ValueError
@@ -10,6 +19,7 @@ else:
     JSONDecodeError = json.JSONDecodeError
 
 from buildbotcustom.changes import hgpoller
+from buildbotcustom.changes.checkpoints import CheckpointStore
 
 
 class VerySimpleHTTPRequestHandler(BaseHTTPRequestHandler):
@@ -58,6 +68,27 @@ class TestHTTPServer(object):
         self.server_thread.join()
 
 
+class ConditionalHTTPRequestHandler(BaseHTTPRequestHandler):
+    # Serves `contents` with an ETag, and answers 304 if the client already
+    # has it. Requests and bytes sent are counted in `stats`
+    def do_GET(self):
+        self.stats['requests'] += 1
+        etag = '"%s"' % hash(self.contents)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(self.contents)
+        self.stats['bytes'] += len(self.contents)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
 class UrlCreation(unittest.TestCase):
     def testSimpleUrl(self):
         correctUrl = 'https://hg.mozilla.org/mozilla-central/json-pushes?full=1'
@@ -142,6 +173,93 @@ class RepositoryIndexParsing(unittest.TestCase):
         self.failUnlessEqual(poller.pendingLocales, correctLocales)
 
 
+class LocalesScheduling(unittest.TestCase):
+    def setUp(self):
+        self.poller = hgpoller.HgAllLocalesPoller(
+            hgURL='http://localhost', repositoryIndex='l10n-central',
+            pollInterval=120, parallelRequests=2, maxParallelRequests=3)
+        self.poller.startLoad = time.time()
+        self.polled = []
+        self.failing = set()
+
+        def poll(lp):
+            self.polled.append(lp.locale)
+            if lp.locale in self.failing:
+                lp.loadTime = None
+                lp.attempts = 1
+                lp.dataFailed(mock.Mock())
+            else:
+                lp.loadTime = 3
+                lp.attempts = 1
+                lp.dataFinished(None)
+            lp.pollDone(None)
+        self.patcher = mock.patch.object(hgpoller.HgLocalePoller, 'poll',
+                                         poll)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def runPass(self):
+        self.polled = []
+        with mock.patch.object(hgpoller, 'reactor') as r:
+            self.poller.processData(fakeLocalesFile)
+            self.assertEquals(self.poller.activeRequests,
+                              min(self.poller.parallelism,
+                                  max(1, len(self.poller.pendingLocales))))
+            # Run the scheduled calls in order, including the ones they
+            # schedule in turn
+            for i in range(100):
+                if not r.callLater.call_args_list:
+                    break
+                calls = r.callLater.call_args_list
+                r.callLater.reset_mock()
+                for args, kwargs in calls:
+                    args[1](*args[2:])
+        if self.poller.pendingLocales or self.poller.activeRequests:
+            self.fail("pass didn't finish")
+        return self.polled
+
+    def testBackoff(self):
+        self.failing.add('de')
+        passes = [self.runPass() for i in range(8)]
+        polled = ['de' in p for p in passes]
+        # Skipped for 0, 1, 3 passes after each failure
+        self.assertEquals(polled,
+                          [True, True, False, True, False, False, False, True])
+        self.assertEquals(len(passes[2]), 5)
+
+        lp = self.poller.localePollers[('de', 'l10n-central')]
+        self.assertEquals((lp.failures, lp.skip), (4, 7))
+        self.failing.clear()
+        lp.skip = 0
+        self.runPass()
+        self.assertEquals((lp.failures, lp.skip), (0, 0))
+
+    def testLatencies(self):
+        self.runPass()
+        self.runPass()
+        lp = self.poller.localePollers[('af', 'l10n-central')]
+        self.assertEquals(lp.latencies, [0, 0, 2, 0, 0, 0])
+
+    def testParallelism(self):
+        self.runPass()
+        self.assertEquals(self.poller.parallelism, 2)
+
+        # Too slow: poll more at once, up to the maximum
+        for i in range(3):
+            self.poller.startLoad = time.time() - 200
+            self.runPass()
+        self.assertEquals(self.poller.parallelism, 3)
+
+        # Too many failures: back off
+        self.failing.update(['af', 'be'])
+        self.runPass()
+        self.assertEquals(self.poller.parallelism, 1)
+        self.runPass()
+        self.assertEquals(self.poller.parallelism, 1)
+
+
 class TestPolling(unittest.TestCase):
     def setUp(self):
         x = self.server = TestHTTPServer('testcontents')
@@ -197,6 +315,126 @@ class TestPolling(unittest.TestCase):
                                   repositoryIndex='foobar')
 
 
+class TestConditionalFetching(unittest.TestCase):
+    def setUp(self):
+        class OurHandler(ConditionalHTTPRequestHandler):
+            contents = validPushlog
+            stats = {'requests': 0, 'bytes': 0}
+        self.handler = OurHandler
+        self.server = server = HTTPServer(('', 0), OurHandler)
+        self.server_thread = threading.Thread(target=server.serve_forever)
+        self.server_thread.setDaemon(True)
+        self.server_thread.start()
+        self.url = 'http://localhost:%i/json-pushes?full=1' % \
+            server.server_address[1]
+        self.fetcher = hgpoller.PushlogFetcher()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+
+    def testNotModified(self):
+        d = self.fetcher.getPage(self.url, 'repo')
+
+        def first(page):
+            self.assertEquals(page, validPushlog)
+            self.fetcher.saveValidators('repo')
+            return self.fetcher.getPage(self.url, 'repo')
+
+        def second(page):
+            # Nothing changed, so no body the second time around
+            self.assertEquals(page, None)
+            self.assertEquals(self.handler.stats['requests'], 2)
+            self.assertEquals(self.handler.stats['bytes'], len(validPushlog))
+            self.assertEquals(self.fetcher.stats['not_modified'], 1)
+            self.assertEquals(self.fetcher.stats['bytes'], len(validPushlog))
+            # Different pollers don't share validators
+            return self.fetcher.getPage(self.url, 'other-repo')
+
+        def third(page):
+            self.assertEquals(page, validPushlog)
+        d.addCallback(first)
+        d.addCallback(second)
+        d.addCallback(third)
+        return d
+
+    def testNotProcessed(self):
+        d = self.fetcher.getPage(self.url, 'repo')
+
+        def first(page):
+            # We couldn't process that, so we need it again
+            self.fetcher.discardValidators('repo')
+            self.fetcher.saveValidators('repo')
+            return self.fetcher.getPage(self.url, 'repo')
+        d.addCallback(first)
+        d.addCallback(self.assertEquals, validPushlog)
+        return d
+
+    def testPollerValidators(self):
+        self.patch(hgpoller, 'fetcher', self.fetcher)
+        base = self.url[:-len('/json-pushes?full=1')]
+        pages = []
+
+        class Poller(hgpoller.BaseHgPoller):
+            fail = False
+
+            def processData(self, page):
+                pages.append((self.repo_branch, page))
+                if self.fail:
+                    raise ValueError("couldn't process")
+
+        # Same URL, different in-repo branches
+        p1 = Poller(hgURL=base, branch='', pushlogUrlOverride=self.url,
+                    repo_branch='default')
+        p2 = Poller(hgURL=base, branch='', pushlogUrlOverride=self.url,
+                    repo_branch='other')
+        p2.fail = True
+        d = p1.poll()
+        d.addCallback(lambda _: p2.poll())
+        d.addCallback(lambda _: p1.poll())
+        d.addCallback(lambda _: p2.poll())
+
+        def check(_):
+            self.flushLoggedErrors(ValueError)
+            self.assertEquals(pages, [('default', validPushlog),
+                                      ('other', validPushlog),
+                                      ('default', None),
+                                      ('other', validPushlog)])
+        d.addCallback(check)
+        return d
+
+    def testChangedUrl(self):
+        d = self.fetcher.getPage(self.url, 'repo')
+        # New fromchange, so we expect a full response
+        d.addCallback(lambda _: self.fetcher.getPage(self.url + '&fromchange=1',
+                                                     'repo'))
+        d.addCallback(self.assertEquals, validPushlog)
+        return d
+
+    def testConcurrencyLimit(self):
+        self.fetcher.maxPerHost = 1
+        dl = [self.fetcher.getPage(self.url, 'repo%i' % i) for i in range(3)]
+        sem = self.fetcher.semaphores['localhost:%i' %
+                                      self.server.server_address[1]]
+        self.assertEquals(sem.tokens, 0)
+        self.assertEquals(len(sem.waiting), 2)
+        return defer.DeferredList(dl)
+
+    def testPollerNotModified(self):
+        changes = []
+
+        class parent:
+            def addChange(self, change):
+                changes.append(change)
+        poller = hgpoller.BaseHgPoller(hgURL='http://localhost', branch='b')
+        poller.parent = parent()
+        poller.lastChangeset = 'abc'
+        poller.processData(None)
+        self.assertEquals(poller.lastChangeset, 'abc')
+        self.assertEquals(changes, [])
+
+
 validPushlog = """
 {
  "15226": {
@@ -315,6 +553,174 @@ class PushlogParsing(unittest.TestCase):
         self.failUnlessRaises(JSONDecodeError, hgpoller._parse_changes, "")
 
 
+def makePushlog(numPushes, changesPerPush, branches=('default',)):
+    pushes = {}
+    for i in range(numPushes):
+        changesets = []
+        for j in range(changesPerPush):
+            changesets.append({
+                "node": "%012x%028x" % (i, j),
+                "files": ["dir%i/file%i.cpp" % (j, k) for k in range(5)],
+                "tags": [],
+                "author": "Some One <someone@example.com>",
+                "branch": branches[(i + j) % len(branches)],
+                "desc": "Bug %i - change %i of push %i. r=someone" % (i, j, i),
+            })
+        pushes[str(i + 1)] = {
+            "date": 1282358416 + i,
+            "changesets": changesets,
+            "user": "someone@example.com",
+        }
+    return json.dumps(pushes)
+
+
+class LargePushlogParsing(unittest.TestCase):
+    # 50,000 changesets, in 5,000 pushes
+    pushlog = makePushlog(5000, 10, branches=('default', 'other'))
+
+    def testAllPushes(self):
+        pushes = hgpoller._parse_changes(self.pushlog)
+        self.assertEquals(len(pushes), 5000)
+        self.assertEquals([p['date'] for p in pushes],
+                          range(1282358416, 1282358416 + 5000))
+
+    def testMaxChangesMerged(self):
+        pushes = hgpoller._parse_changes(self.pushlog, maxChanges=100)
+        # One more push than we need, so that we know there were too many
+        self.assertEquals(len(pushes), 101)
+        self.assertEquals(pushes[-1]['date'], 1282358416 + 4999)
+
+    def testMaxChangesUnmerged(self):
+        pushes = hgpoller._parse_changes(self.pushlog, maxChanges=100,
+                                         repo_branch='default',
+                                         mergePushChanges=False)
+        # 5 changes on default per push
+        self.assertEquals(len(pushes), 21)
+
+    def testSameChangesAsFullParse(self):
+        class parent:
+            def __init__(self):
+                self.changes = []
+
+            def addChange(self, change):
+                self.changes.append((change.revision, change.files))
+
+        def poll(**kwargs):
+            poller = hgpoller.BaseHgPoller(hgURL='http://localhost',
+                                           branch='b', **kwargs)
+            poller.parent = parent()
+            poller.lastChangeset = 'abc'
+            poller.processData(pushlog)
+            return poller.parent.changes, poller.lastChangeset
+
+        pushlog = makePushlog(500, 10, branches=('default', 'other'))
+        full_parse = hgpoller._parse_changes
+        for kwargs in (dict(), dict(repo_branch='other'),
+                       dict(mergePushChanges=False),
+                       dict(maxChanges=None, repo_branch='default')):
+            expected = None
+            try:
+                hgpoller._parse_changes = lambda data, *args: full_parse(data)
+                expected = poll(**kwargs)
+            finally:
+                hgpoller._parse_changes = full_parse
+            self.assertEquals(poll(**kwargs), expected)
+
+
+class Checkpoints(unittest.TestCase):
+    def setUp(self):
+        self.store = CheckpointStore(self.mktemp())
+        self.patcher = mock.patch.object(hgpoller, 'checkpoints', self.store)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.store.flush()
+        reactor.removeSystemEventTrigger(self.store.shutdownTrigger)
+
+    def makePoller(self):
+        class parent:
+            changes = []
+
+            def addChange(self, change):
+                self.changes.append(change)
+        poller = hgpoller.BaseHgPoller(hgURL='http://localhost',
+                                       branch='mozilla-central')
+        poller.parent = parent()
+        return poller
+
+    def testBatchedWrites(self):
+        self.store.set('a', 1)
+        self.store.set('b', 2)
+        self.failUnless(self.store.flushTimer.active())
+        self.assertEquals(self.store.load(), {})
+        self.store.flush()
+        self.assertEquals(self.store.load(), {'a': 1, 'b': 2})
+        self.assertEquals(self.store.flushTimer, None)
+
+        # Unchanged values don't need writing
+        self.store.set('a', 1)
+        self.assertEquals(self.store.flushTimer, None)
+
+    def testSharedFile(self):
+        other = CheckpointStore()
+        other.path = self.store.path
+        self.store.set('a', 1)
+        self.store.flush()
+        other.set('b', 2)
+        self.store.set('a', 3)
+        other.flush()
+        self.store.flush()
+        self.assertEquals(self.store.load(), {'a': 3, 'b': 2})
+
+    def testDisabled(self):
+        store = CheckpointStore()
+        store.set('a', 1)
+        self.assertEquals(store.get('a'), None)
+        self.assertEquals(store.flushTimer, None)
+
+    def testResume(self):
+        poller = self.makePoller()
+        self.assertEquals(poller.lastChangeset, None)
+        poller.processData(validPushlog)
+        self.assertEquals(poller.parent.changes, [])
+        self.store.flush()
+
+        # After a restart, we pick up from where we were
+        self.store.data = None
+        poller = self.makePoller()
+        self.assertEquals(poller.lastChangeset,
+                          '33be08836cb164f9e546231fc59e9e4cf98ed991')
+        self.failUnless('fromchange=33be08836cb1' in poller._make_url())
+
+        # Other repositories and branches are tracked separately
+        other = hgpoller.BaseHgPoller(hgURL='http://localhost',
+                                      branch='mozilla-central',
+                                      repo_branch='GECKO20_BRANCH')
+        self.assertEquals(other.lastChangeset, None)
+
+    def testUnknownRevision(self):
+        poller = self.makePoller()
+        poller.processData(validPushlog)
+        self.store.flush()
+        lastChangeset = poller.lastChangeset
+
+        # hg doesn't know our lastChangeset, perhaps because a mirror is
+        # lagging. We keep trying from where we were (bug 774862).
+        poller.attempts = 1
+        with mock.patch.object(hgpoller, 'log'):
+            poller.dataFailed(failure.Failure(error.Error(
+                '500', 'Internal Server Error',
+                "unknown revision '33be08836cb1'")))
+        self.assertEquals(poller.lastChangeset, lastChangeset)
+        self.failUnless('fromchange' in poller._make_url())
+
+        # And after a restart
+        self.store.flush()
+        self.store.data = None
+        self.assertEquals(self.makePoller().lastChangeset, lastChangeset)
+
+
 class RepoBranchHandling(unittest.TestCase):
     def setUp(self):
         self.changes = []
@@ -365,6 +771,184 @@ class RepoBranchHandling(unittest.TestCase):
                           '4c23e51a484f077ea27af3ea4a4ee13da5aeb5e6')
 
 
+class MultiHgPollerScheduling(unittest.TestCase):
+    def setUp(self):
+        self.poller = hgpoller.MultiHgPoller(
+            targets=[
+                dict(hgURL='http://localhost', branch='b1'),
+                dict(hgURL='http://localhost', branch='b2',
+                     repo_branch=None, storeRev='b2_rev'),
+                dict(hgURL='http://localhost', branch='b3'),
+            ],
+            pollInterval=30, minInterval=10, maxInterval=300)
+        self.polled = []
+        for p in self.poller.pollers:
+            p.poll = lambda p=p: self.polled.append(p.branch)
+
+    def testTargets(self):
+        p1, p2, p3 = self.poller.pollers
+        self.assertEquals(p1.baseURL, 'http://localhost/b1')
+        self.assertEquals(p1.repo_branch, 'default')
+        self.assertEquals(p2.repo_branch, None)
+        self.assertEquals(p2.storeRev, 'b2_rev')
+        self.assertEquals(p3.parent, self.poller)
+
+    def testSpreadAndTick(self):
+        self.poller.loop = mock.Mock()
+        with mock.patch.object(hgpoller, 'reactor'):
+            with mock.patch.object(hgpoller.base.ChangeSource, 'startService'):
+                self.poller.startService()
+        start = self.poller.pollers[0].nextPoll
+        self.assertEquals([p.nextPoll - start for p in self.poller.pollers],
+                          [0, 10, 20])
+
+        with mock.patch.object(hgpoller.time, 'time') as t:
+            t.return_value = start + 15
+            self.poller.tick()
+            self.assertEquals(self.polled, ['b1', 'b2'])
+            # Polls still in progress aren't started again
+            self.poller.tick()
+            self.assertEquals(self.polled, ['b1', 'b2'])
+
+    def testNoTargets(self):
+        poller = hgpoller.MultiHgPoller(targets=[], pollInterval=30)
+        poller.loop = mock.Mock()
+        with mock.patch.object(hgpoller, 'reactor'):
+            with mock.patch.object(hgpoller.base.ChangeSource, 'startService'):
+                poller.startService()
+        poller.tick()
+
+    def testStillPolling(self):
+        p = hgpoller.MultiHgPoller(
+            targets=[dict(hgURL='http://localhost', branch='b1')]).pollers[0]
+        p.getData = mock.Mock()
+        p.getData.return_value = defer.Deferred()
+        p.pollDone = mock.Mock()
+        p.poll()
+        with mock.patch.object(hgpoller, 'reactor') as r:
+            with mock.patch.object(hgpoller, 'log'):
+                p.poll()
+        # The first poll is left to finish, and say when it's done
+        self.assertEquals(p.getData.call_count, 1)
+        self.assertEquals(p.attempts, 2)
+        self.failIf(r.callLater.called)
+        self.failIf(p.pollDone.called)
+        self.failUnless(p.polling)
+
+    def testAdaptiveInterval(self):
+        p = self.poller.pollers[0]
+        self.poller.pollerDone(p, False)
+        self.assertEquals(p.interval, 45)
+        for i in range(10):
+            self.poller.pollerDone(p, False)
+        self.assertEquals(p.interval, 300)
+        self.poller.pollerDone(p, True)
+        self.assertEquals(p.interval, 10)
+        self.failUnless(p.nextPoll - time.time() <= 10 * 1.1 + 1)
+
+    def testChangedDetection(self):
+        p = self.poller.pollers[0]
+        self.poller.pollerDone = mock.Mock()
+        # The first poll just tells us where we are
+        p.polledFrom = None
+        p.lastChangeset = 'abc'
+        p.pollDone(None)
+        self.poller.pollerDone.assert_called_with(p, False)
+        p.polledFrom = 'abc'
+        p.lastChangeset = 'def'
+        p.pollDone(None)
+        self.poller.pollerDone.assert_called_with(p, True)
+
+
+class FakeQueueDir(object):
+    def __init__(self, items):
+        self.items = list(items)
+        self.removed = []
+        self.murdered = []
+
+    def pop(self):
+        if not self.items:
+            return None
+        item_id = len(self.removed) + len(self.murdered)
+        return item_id, StringIO(self.items.pop(0))
+
+    def remove(self, item_id):
+        self.removed.append(item_id)
+
+    def murder(self, item_id):
+        self.murdered.append(item_id)
+
+
+class PushNotifications(unittest.TestCase):
+    def setUp(self):
+        self.queuedir = FakeQueueDir([])
+        self.poller = hgpoller.HgPushNotificationPoller(
+            targets=[
+                dict(hgURL='http://localhost', branch='try'),
+                dict(hgURL='http://localhost/', branch='b2'),
+            ],
+            queuedir=self.queuedir, pollInterval=30, reconcileInterval=600)
+        self.polled = []
+        for p in self.poller.pollers:
+            def poll(p=p):
+                p.polling = True
+                self.polled.append(p.branch)
+            p.poll = poll
+            p.nextPoll = time.time() + 600
+
+    def notify(self, *urls):
+        self.queuedir.items.extend(json.dumps(dict(repo_url=u)) for u in urls)
+
+    def testNotification(self):
+        self.notify('http://localhost/try', 'http://localhost/b2/',
+                    'http://localhost/try')
+        self.poller.tick()
+        self.assertEquals(self.polled, ['try', 'b2'])
+        self.assertEquals(self.queuedir.removed, [0, 1, 2])
+
+    def testUnknownAndBadNotifications(self):
+        self.notify('http://localhost/other')
+        self.queuedir.items.append('not json')
+        self.queuedir.items.append('{"pushid": 1}')
+        self.poller.tick()
+        self.assertEquals(self.polled, [])
+        self.assertEquals(self.queuedir.removed, [0])
+        self.assertEquals(self.queuedir.murdered, [1, 2])
+        self.assertEquals(len(self.flushLoggedErrors()), 2)
+
+    def testReconfigWithNewQueueDir(self):
+        # Reconfigs make a new QueueDir; that mustn't replace the poller
+        other = hgpoller.HgPushNotificationPoller(
+            targets=[
+                dict(hgURL='http://localhost', branch='try'),
+                dict(hgURL='http://localhost/', branch='b2'),
+            ],
+            queuedir=FakeQueueDir([]), pollInterval=30,
+            reconcileInterval=600)
+        self.assertEquals(self.poller, other)
+
+    def testNotifiedWhilePolling(self):
+        self.notify('http://localhost/try')
+        self.poller.tick()
+        self.notify('http://localhost/try', 'http://localhost/try')
+        self.poller.tick()
+        self.assertEquals(self.polled, ['try'])
+
+        # Poll again as soon as the current one is done
+        p = self.poller.pollers[0]
+        p.polling = False
+        self.poller.pollerDone(p, True)
+        self.poller.tick()
+        self.assertEquals(self.polled, ['try', 'try'])
+
+        # Without notifications we're back to reconciling every 10 minutes
+        p.polling = False
+        self.poller.pollerDone(p, False)
+        self.assertEquals(p.interval, 600)
+        self.poller.tick()
+        self.assertEquals(self.polled, ['try', 'try'])
+
+
 class MaxChangesHandling(unittest.TestCase):
     def setUp(self):
         self.changes = []
@@ -1,5 +1,12 @@
+from __future__ import with_statement
+
+import threading
+import time
+
+import mock
 from twisted.trial import unittest
 
+import buildbotcustom.misc
 from buildbotcustom.misc import makeImportantFunc, \
     changeContainsScriptRepoRevision
 
@@ -11,10 +18,11 @@ class Change(object):
     revlink = None
     comments = ""
     revision = None
+    number = None
     properties = Properties()
 
     def __init__(self, files=None, revlink=None, comments=None, revision=None,
-                 properties=None):
+                 properties=None, number=None):
         if files:
             self.files = files
         if revlink:
@@ -25,6 +33,8 @@ class Change(object):
             self.revision = revision
         if properties:
             self.properties = properties
+        if number:
+            self.number = number
 
 
 class TestProductImportance(unittest.TestCase):
@@ -63,6 +73,103 @@ class TestProductImportance(unittest.TestCase):
         self.assertTrue(f(c))
 
 
+class TestProductImportanceBenchmark(unittest.TestCase):
+    def setUp(self):
+        buildbotcustom.misc.changeClassifier = \
+            buildbotcustom.misc.ChangeClassifier()
+        # A merge touching 30,000 files, none of which matter to firefox
+        self.files = ['mobile/android/dir%i/file%i.java' % (i % 100, i)
+                      for i in range(15000)] + \
+                     ['b2g/app/dir%i/file%i.js' % (i % 100, i)
+                      for i in range(15000)]
+        self.hgurl = 'https://hg.mozilla.org/mozilla-central'
+        self.revlink = self.hgurl + '/rev/1234'
+
+    def testMerge(self):
+        c = Change(revlink=self.revlink, files=self.files, number=1)
+        c2 = Change(revlink=self.revlink, files=self.files + ['CLOBBER'],
+                    number=2)
+        schedulers = [makeImportantFunc(self.hgurl, 'firefox')
+                      for i in range(100)] + \
+                     [makeImportantFunc(self.hgurl, 'b2g')
+                      for i in range(100)]
+
+        with mock.patch.object(buildbotcustom.misc, 'log') as log:
+            start = time.time()
+            results = [f(c) for f in schedulers]
+            results2 = [f(c2) for f in schedulers]
+            elapsed = time.time() - start
+
+        self.assertEquals(results, [False] * 100 + [True] * 100)
+        self.assertEquals(results2, [False] * 100 + [True] * 100)
+        # Each change was classified once per product
+        self.assertEquals(log.msg.call_count, 4)
+        stats = buildbotcustom.misc.changeClassifier.stats
+        self.assertEquals((stats['hits'], stats['misses']), (396, 8))
+        self.failUnless(elapsed < 5, "took %.2fs" % elapsed)
+
+    def testUnnumberedChange(self):
+        # Changes that haven't been stored yet can't be cached
+        c = Change(revlink=self.revlink, files=self.files)
+        f = makeImportantFunc(self.hgurl, 'firefox')
+        with mock.patch.object(buildbotcustom.misc, 'log') as log:
+            self.assertFalse(f(c))
+            self.assertFalse(f(c))
+        self.assertEquals(log.msg.call_count, 2)
+        self.assertEquals(len(buildbotcustom.misc.changeClassifier.results),
+                          0)
+
+
+class TestChangeClassifier(unittest.TestCase):
+    def setUp(self):
+        self.classifier = buildbotcustom.misc.ChangeClassifier(maxSize=3)
+        self.calls = []
+
+    def isOdd(self, change, modulus=2):
+        self.calls.append(change.number)
+        return change.number % modulus == 1
+
+    def testShared(self):
+        f1 = self.classifier.predicate(self.isOdd)
+        f2 = self.classifier.predicate(self.isOdd)
+        f3 = self.classifier.predicate(self.isOdd, 3)
+        c = Change(number=4)
+        self.assertEquals([f1(c), f2(c), f3(c), f3(c)],
+                          [False, False, True, True])
+        self.assertEquals(self.calls, [4, 4])
+        self.assertEquals(self.classifier.hitRate(), 0.5)
+
+    def testEviction(self):
+        f = self.classifier.predicate(self.isOdd)
+        for i in [1, 2, 3, 1, 4, 1, 2]:
+            f(Change(number=i))
+        # 2 was the least recently used when 4 came along
+        self.assertEquals(self.calls, [1, 2, 3, 4, 2])
+        self.assertEquals(self.classifier.stats['evictions'], 2)
+        self.assertEquals(len(self.classifier.results), 3)
+
+    def testThreads(self):
+        # Schedulers classify changes from database threads
+        f = self.classifier.predicate(self.isOdd)
+        errors = []
+
+        def run():
+            try:
+                for i in range(2000):
+                    f(Change(number=i % 5 + 1))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(errors, [])
+        self.assertEquals(len(self.classifier.results), 3)
+        stats = self.classifier.stats
+        self.assertEquals(stats['hits'] + stats['misses'], 8000)
+
+
 class TestChangeContainsScriptRepoRevision(unittest.TestCase):
 
     def test_exact_match(self):
@@ -74,3 +181,4 @@ class TestChangeContainsScriptRepoRevision(unittest.TestCase):
         c = Change(properties=Properties(
             script_repo_revision="F_34_0_5_RELEASE"))
         self.assertFalse(changeContainsScriptRepoRevision(c, "F_34_0_RELEASE"))
+
@@ -31,8 +31,7 @@ class TestMergeRequsets(unittest.TestCase):
         # This is basically copied from misc.py
         misc.nomergeBuilders = set()
         misc.builderMergeLimits = collections.defaultdict(lambda: 3)
-        misc._mergeCount = 0
-        misc._mergeId = None
+        misc._merger = misc.RequestMerger()
 
     def testNoMergeBuilders(self):
         "Tests that nomergeBuilders works"
@@ -77,16 +76,29 @@ class TestMergeRequsets(unittest.TestCase):
         r3 = makeRequest(b1)
 
         misc.mergeRequests(b1, r1, r2)
-        self.assertEquals(misc._mergeId, r1.id)
-        self.assertEquals(misc._mergeCount, 2)
+        self.assertEquals(misc._merger.state["b1"], [r1.id, 2])
 
         misc.mergeRequests(b1, r1, r3)
-        self.assertEquals(misc._mergeId, r1.id)
-        self.assertEquals(misc._mergeCount, 3)
+        self.assertEquals(misc._merger.state["b1"], [r1.id, 3])
 
         misc.mergeRequests(b1, r2, r3)
-        self.assertEquals(misc._mergeId, r2.id)
-        self.assertEquals(misc._mergeCount, 2)
+        self.assertEquals(misc._merger.state["b1"], [r2.id, 2])
+
+    def testPerBuilderState(self):
+        "Tests that merging on one builder doesn't affect another's counts"
+        b1 = makeBuilder("b1")
+        b2 = makeBuilder("b2")
+        r1 = makeRequest(b1)
+        r2 = makeRequest(b1)
+        r3 = makeRequest(b1)
+        r4 = makeRequest(b2)
+        r5 = makeRequest(b2)
+
+        self.assertTrue(misc.mergeRequests(b1, r1, r2))
+        self.assertTrue(misc.mergeRequests(b2, r4, r5))
+        self.assertTrue(misc.mergeRequests(b1, r1, r3))
+        self.assertEquals(misc._merger.state["b1"], [r1.id, 3])
+        self.assertEquals(misc._merger.state["b2"], [r4.id, 2])
 
     def testMergeSelfserve(self):
         "Test that having Self-serve in the request reason disables coalescing"
@@ -108,6 +120,47 @@ class TestMergeRequsets(unittest.TestCase):
         self.assertFalse(misc.mergeRequests(b1, r2, r1))
 
 
+class TestMergeRequestsBenchmark(unittest.TestCase):
+    def setUp(self):
+        misc.nomergeBuilders = set()
+        misc.builderMergeLimits = collections.defaultdict(lambda: 3)
+        misc._merger = misc.RequestMerger()
+
+    def testManyPendingRequests(self):
+        "Tests merging with thousands of pending requests"
+        builders = [makeBuilder("b%i" % i) for i in range(10)]
+        requests = {}
+        for b in builders:
+            requests[b.name] = [makeRequest(b) for _ in range(200)]
+            requests[b.name][-1].reason = "Retriggered via Self-serve"
+        misc.builderMergeLimits["b0"] = 1000
+
+        # Emulate how buildbot considers pending requests for each builder
+        merged = collections.defaultdict(int)
+        for b in builders:
+            pending = requests[b.name][:]
+            while pending:
+                req1 = pending.pop(0)
+                for req2 in pending[:]:
+                    if misc.mergeRequests(b, req1, req2):
+                        pending.remove(req2)
+                        merged[b.name] += 1
+
+        # b0 can merge all but the self-serve request into the first one
+        self.assertEquals(merged["b0"], 198)
+        # Other builders merge 2 requests into each build
+        self.assertEquals(merged["b1"], 2 * (199 // 3))
+        # Each request's mergeability is only worked out once
+        self.assertEquals(len(misc._merger.keys), 2000)
+        # ...and isn't looked at again
+        for b in builders:
+            for r in requests[b.name]:
+                r.properties = None
+        for b in builders:
+            self.assertFalse(misc.mergeRequests(b, requests[b.name][0],
+                                                requests[b.name][-1]))
+
+
 def main():
     unittest.main()
 
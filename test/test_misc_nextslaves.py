@@ -6,12 +6,16 @@ import shutil
 import mock
 
 from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.web.error import Error
 from buildbot.db import dbspec, connector
 from buildbot.db.schema.manager import DBSchemaManager
+from buildbot.util import json
 
 import buildbotcustom.misc
 from buildbotcustom.misc import _nextIdleSlave, _nextAWSSlave, \
-    _classifyAWSSlaves, _get_pending, J
+    _classifyAWSSlaves, _get_pending, J, JacuzziAllocator, _nextSlave, \
+    _getLastSuccessTimes
 
 
 class TestNextSlaveFuncs(unittest.TestCase):
@@ -24,6 +28,7 @@ class TestNextSlaveFuncs(unittest.TestCase):
 
         self.builder = builder = mock.Mock()
         builder.builder_status.buildCache.keys.return_value = []
+        builder.builder_status.watchers = []
         builder.slaves = self.slaves
 
         # Don't check jacuzzi allocations for tests
@@ -44,6 +49,92 @@ class TestNextSlaveFuncs(unittest.TestCase):
         self.assert_(slave is None)
 
 
+class TestLastSuccessIndex(unittest.TestCase):
+    def setUp(self):
+        self.slaves = slaves = []
+        for name in ('s1', 's2', 's3'):
+            slave = mock.Mock()
+            slave.slave.slavename = name
+            slaves.append(slave)
+
+        self.builds = {
+            1: self.makeBuild('s1', 0, 100),
+            2: self.makeBuild('s2', 0, 200),
+            3: self.makeBuild('s3', 2, 300),
+            4: self.makeBuild('s1', 0, 150),
+        }
+        self.builder = builder = mock.Mock()
+        builder.builder_status.buildCache = self.builds
+        builder.builder_status.watchers = []
+        self.callFromThread = mock.Mock(side_effect=lambda f, *args: f(*args))
+        self.patch(buildbotcustom.misc.reactor, 'callFromThread',
+                   self.callFromThread)
+
+    def makeBuild(self, slavename, results, finished):
+        build = mock.Mock()
+        build.slavename = slavename
+        build.getResults.return_value = results
+        build.finished = finished
+        return build
+
+    def test_seeded_from_cache(self):
+        self.assertEquals(_getLastSuccessTimes(self.builder),
+                          {'s1': 150, 's2': 200})
+        self.assertEquals(_nextSlave(self.builder, self.slaves).slave.slavename,
+                          's2')
+
+    def test_build_finished(self):
+        times = _getLastSuccessTimes(self.builder)
+        # Subscribed from the reactor thread
+        index = self.builder.builder_status.subscribe.call_args[0][0]
+        self.assertEquals(self.callFromThread.call_args[0], (index.subscribe,))
+
+        index.buildFinished('b', self.makeBuild('s3', 2, 400), 2)
+        self.assertEquals(_nextSlave(self.builder, self.slaves).slave.slavename,
+                          's2')
+
+        index.buildFinished('b', self.makeBuild('s3', 0, 400), 0)
+        self.assertEquals(times['s3'], 400)
+        self.assertEquals(_nextSlave(self.builder, self.slaves).slave.slavename,
+                          's3')
+
+    def test_subscribe_later(self):
+        calls = []
+        self.callFromThread.side_effect = lambda f, *args: calls.append(f)
+        _getLastSuccessTimes(self.builder)
+        # A build finishes before the reactor gets round to subscribing us
+        self.builds[5] = self.makeBuild('s3', 0, 500)
+        for f in calls:
+            f()
+        self.assertEquals(_getLastSuccessTimes(self.builder)['s3'], 500)
+
+    def test_reconfig(self):
+        self.builder.name = 'b'
+        old_status = self.builder.builder_status
+        _getLastSuccessTimes(self.builder)
+        old = old_status.subscribe.call_args[0][0]
+        old_status.watchers.append(old)
+
+        # The builder gets a new status object
+        self.builder.builder_status = new_status = mock.Mock()
+        new_status.buildCache = {}
+        new_status.watchers = []
+        self.assertEquals(_getLastSuccessTimes(self.builder), {})
+        index = new_status.subscribe.call_args[0][0]
+        self.assertNotEquals(index, old)
+        old_status.unsubscribe.assert_called_with(old)
+        # And it's kept from then on
+        self.assertEquals(_getLastSuccessTimes(self.builder), {})
+        self.assertEquals(new_status.subscribe.call_count, 1)
+
+    def test_ties(self):
+        self.builds.clear()
+        # Nothing has run here; like sorting, we pick the last one
+        self.assertEquals(_nextSlave(self.builder, self.slaves).slave.slavename,
+                          's3')
+        self.assertEquals(_nextSlave(self.builder, []), None)
+
+
 class TestNextAWSSlave(unittest.TestCase):
     def setUp(self):
         self.slaves = slaves = []
@@ -54,6 +145,7 @@ class TestNextAWSSlave(unittest.TestCase):
 
         self.builder = builder = mock.Mock()
         builder.builder_status.buildCache.keys.return_value = []
+        builder.builder_status.watchers = []
         builder.slaves = self.slaves
 
     def test_classify(self):
@@ -165,6 +257,204 @@ class TestNextAWSSlave(unittest.TestCase):
                               f(self.builder, spot + ondemand).slave.slavename)
 
 
+class TestJacuzziBackgroundRefresh(unittest.TestCase):
+    def setUp(self):
+        self.slaves = slaves = []
+        for name in ('s1', 's2', 's3'):
+            slave = mock.Mock()
+            slave.slave.slavename = name
+            slaves.append(slave)
+
+        self.responses = {
+            "/allocated/all": {"machines": ["s1", "s2"]},
+            "/builders/b1": {"machines": ["s1"]},
+        }
+
+        def getPage(url, timeout=None):
+            path = url[len(JacuzziAllocator.BASE_URL):]
+            if path in self.responses:
+                return defer.succeed(json.dumps(self.responses[path]))
+            return defer.fail(Error('404', 'Not Found'))
+
+        self.patches = [
+            mock.patch.object(buildbotcustom.misc, "getPage", getPage),
+            mock.patch.object(buildbotcustom.misc, "LoopingCall"),
+            mock.patch.object(buildbotcustom.misc, "reactor"),
+            mock.patch.object(buildbotcustom.misc.urllib2, "urlopen"),
+        ]
+        for p in self.patches:
+            p.start()
+        # Pretend we're always called on the reactor thread
+        reactor = buildbotcustom.misc.reactor
+        reactor.callFromThread.side_effect = lambda f, *args: f(*args)
+
+        self.j = JacuzziAllocator()
+        self.j.start_refresh(buildernames=['b1', 'b2'])
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def names(self, slaves):
+        return [s.slave.slavename for s in slaves]
+
+    def test_refresh(self):
+        self.j.refresh()
+        self.assertEquals(self.names(self.j.get_slaves('b1', self.slaves)),
+                          ['s1'])
+        # b2 404'ed, so gets unallocated slaves
+        self.assertEquals(self.names(self.j.get_slaves('b2', self.slaves)),
+                          ['s3'])
+        self.assertEquals(self.j.stats['hit'], 1)
+        self.assertEquals(self.j.stats['missing'], 1)
+        self.assertFalse(buildbotcustom.misc.urllib2.urlopen.called)
+
+    def test_stale(self):
+        self.j.refresh()
+        self.j.cache['b1'] = (0, set(['s2']))
+        self.assertEquals(self.names(self.j.get_slaves('b1', self.slaves)),
+                          ['s2'])
+        self.assertEquals(self.j.stats['stale'], 1)
+
+    def test_failed_refresh_keeps_snapshot(self):
+        self.j.refresh()
+        # Garbage response from the service
+        self.responses["/builders/b1"] = None
+        self.j.cache['b1'] = (0, set(['s2']))
+        self.j.refresh()
+        self.assertEquals(self.names(self.j.get_slaves('b1', self.slaves)),
+                          ['s2'])
+        self.assertEquals(self.j.stats['refresh_errors'], 1)
+
+    def test_miss(self):
+        # Nothing is known yet; use all slaves and schedule a refresh
+        self.assertEquals(self.j.get_slaves('b3', self.slaves), None)
+        reactor = buildbotcustom.misc.reactor
+        self.assertTrue(reactor.callFromThread.called)
+        self.assertEquals(reactor.callLater.call_args[0],
+                          (0, self.j._scheduled_refresh))
+        self.assertTrue('b3' in self.j.known_builders)
+        self.assertEquals(self.j.stats['miss'], 1)
+
+        # Once we know about allocated slaves, use only unallocated ones
+        self.j.refresh()
+        self.assertEquals(self.names(self.j.get_slaves('b4', self.slaves)),
+                          ['s3'])
+        self.assertFalse(buildbotcustom.misc.urllib2.urlopen.called)
+
+
+    def test_miss_while_refreshing(self):
+        reactor = buildbotcustom.misc.reactor
+        fetches = []
+
+        def fetch(url):
+            fetches.append(defer.Deferred())
+            return fetches[-1]
+        self.j.fetch = mock.Mock(side_effect=fetch)
+        self.j.refresh()
+        self.j.get_slaves('b3', self.slaves)
+        # b3 waits for the current refresh, not for the next interval
+        self.assertFalse(reactor.callLater.called)
+        self.assertTrue(self.j.refresh_pending)
+        for d in fetches:
+            d.callback({"machines": []})
+        self.assertEquals(reactor.callLater.call_args[0],
+                          (0, self.j._scheduled_refresh))
+        self.j._scheduled_refresh()
+        self.assertEquals(self.j.fetch.call_args[0][0],
+                          JacuzziAllocator.BASE_URL + "/builders/b3")
+
+
+class TestJacuzziBulkAllocations(unittest.TestCase):
+    basedir = "test_misc_nextslaves_bulk"
+
+    def setUp(self):
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+        self.allocations = os.path.abspath(
+            os.path.join(self.basedir, "allocations.json"))
+        self.writeAllocations({
+            "b1": ["s1"],
+            "b2": ["s1", "s2"],
+            "b3": [],
+        })
+
+        self.slaves = slaves = []
+        for name in ('s1', 's2', 's3'):
+            slave = mock.Mock()
+            slave.slave.slavename = name
+            slaves.append(slave)
+
+        self.j = JacuzziAllocator()
+        self.j.ALLOCATIONS_URL = "file://" + self.allocations
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def writeAllocations(self, builders):
+        json.dump({"builders": builders}, open(self.allocations, "w"))
+
+    def names(self, slaves):
+        return [s.slave.slavename for s in slaves]
+
+    def test_get_slaves(self):
+        self.assertEquals(self.names(self.j.get_slaves('b1', self.slaves)),
+                          ['s1'])
+        self.assertEquals(self.names(self.j.get_slaves('b2', self.slaves)),
+                          ['s1', 's2'])
+        # Builders without allocations get unallocated slaves
+        self.assertEquals(self.names(self.j.get_slaves('b3', self.slaves)),
+                          ['s3'])
+        self.assertEquals(self.names(self.j.get_slaves('b4', self.slaves)),
+                          ['s3'])
+        self.assertEquals(
+            self.names(self.j.get_unallocated_slaves(self.slaves)), ['s3'])
+        # Only one fetch for all of those
+        self.assertEquals(self.j.stats['miss'], 1)
+
+    def test_index(self):
+        self.j.get_allocations()
+        expiry, builders, slaves = self.j.allocations
+        self.assertEquals(builders, {'b1': set(['s1']),
+                                     'b2': set(['s1', 's2'])})
+        self.assertEquals(slaves, {'s1': set(['b1', 'b2']),
+                                   's2': set(['b2'])})
+
+    def test_fetch_failure(self):
+        os.unlink(self.allocations)
+        self.assertEquals(self.j.get_slaves('b1', self.slaves), None)
+        self.assertEquals(self.j.get_unallocated_slaves(self.slaves),
+                          self.slaves)
+        # Failures are cached
+        self.writeAllocations({"b1": ["s2"]})
+        self.assertEquals(self.j.get_slaves('b1', self.slaves), None)
+        self.flushLoggedErrors()
+
+    def test_expired_failure_uses_old_allocations(self):
+        self.j.get_allocations()
+        expiry, builders, slaves = self.j.allocations
+        self.j.allocations = (0, builders, slaves)
+        os.unlink(self.allocations)
+        self.assertEquals(self.names(self.j.get_slaves('b1', self.slaves)),
+                          ['s1'])
+        self.flushLoggedErrors()
+
+    def test_refresh(self):
+        with mock.patch.object(buildbotcustom.misc, "LoopingCall"):
+            self.j.start_refresh()
+            # Nothing loaded yet, and we don't fetch anything ourselves
+            self.assertEquals(self.j.get_slaves('b1', self.slaves), None)
+            self.j.refresh()
+            self.assertEquals(self.names(self.j.get_slaves('b1', self.slaves)),
+                              ['s1'])
+            self.writeAllocations({"b1": ["s2"]})
+            self.j.refresh()
+            self.assertEquals(self.names(self.j.get_slaves('b1', self.slaves)),
+                              ['s2'])
+            self.assertEquals(self.j.stats['refreshes'], 2)
+
+
 class TestGetPending(unittest.TestCase):
     basedir = "test_misc_nextslaves"
 
@@ -185,13 +475,48 @@ class TestGetPending(unittest.TestCase):
         self.dbc.stop()
         shutil.rmtree(self.basedir)
 
-    def test_get_pending(self):
-        # Get a db transaction object so that getRetries' stack walking can
-        # find it!
-        t = self.dbc.get_sync_connection().cursor()
-
+    def makeBuilder(self, name):
         builder = mock.Mock()
-        builder._getBuildable.return_value = []
+        builder.name = name
         builder.db = self.dbc
+        builder.run_count = 1
+        builder.RECLAIM_INTERVAL = 3600
+        builder.master_name = "master"
+        builder.master_incarnation = "incarnation"
+        return builder
 
+    def test_get_pending(self):
+        builder = self.makeBuilder("test_get_pending")
         self.assertEquals(_get_pending(builder), ([]))
+
+    def test_get_pending_snapshot(self):
+        t = self.dbc.get_sync_connection().cursor()
+        for bsid, submitted_at in ((1, 200), (2, 100)):
+            t.execute("INSERT INTO buildsets (id, sourcestampid, submitted_at) "
+                      "VALUES (?, 1, ?)", (bsid, submitted_at))
+            t.execute("INSERT INTO buildrequests (id, buildsetid, buildername, "
+                      "submitted_at) VALUES (?, ?, 'b1', ?)",
+                      (bsid, bsid, submitted_at))
+        t.connection.commit()
+
+        builder = self.makeBuilder("b1")
+        self.assertEquals(_get_pending(builder), [(2, 100), (1, 200)])
+        self.assertEquals(_get_pending(builder)[0].submittedAt, 100)
+
+        # The snapshot is reused within the same run
+        t.execute("DELETE FROM buildrequests WHERE id = 2")
+        t.connection.commit()
+        self.assertEquals(_get_pending(builder), [(2, 100), (1, 200)])
+
+        # And refreshed on the next one
+        builder.run_count = 2
+        self.assertEquals(_get_pending(builder), [(1, 200)])
+
+    def test_get_pending_closes_cursor(self):
+        builder = self.makeBuilder("b1")
+        cursor = mock.Mock()
+        cursor.execute.side_effect = ValueError("lost connection")
+        builder.db = mock.Mock(wraps=self.dbc)
+        builder.db._pool.connect.return_value.cursor.return_value = cursor
+        self.assertRaises(ValueError, _get_pending, builder)
+        self.assertTrue(cursor.close.called)
@@ -7,6 +7,7 @@ from buildbot.db import dbspec, connector
 from buildbot.db.schema.manager import DBSchemaManager
 from buildbot.changes.changes import Change
 
+import buildbotcustom.misc_scheduler as misc_scheduler
 from buildbotcustom.misc_scheduler import lastChange, lastGoodRev, \
     getLatestRev, getLastBuiltRevisions, lastGoodFunc, lastRevFunc
 from buildbotcustom.scheduler import SpecificNightly
@@ -100,6 +101,29 @@ class TestLastGoodFuncs(unittest.TestCase):
             lambda t: lastChange(self.dbc, t, 'b1'))
         self.assertEquals(c, None)
 
+    def test_lastChange_skips_dontbuild(self):
+        self.patch(misc_scheduler, 'lastChangePageSize', 3)
+        c1 = Change(who='me!', branch='b1', revision='1', files=['a'],
+                    comments='really important', revlink='from poller')
+        self.dbc.addChangeToDatabase(c1)
+        for i in range(2, 10):
+            c = Change(who='me!', branch='b1', revision=str(i), files=[],
+                       comments='DONTBUILD please', revlink='from poller')
+            self.dbc.addChangeToDatabase(c)
+        c = Change(who='me!', branch='b1', revision='10', files=[],
+                   comments='not from the poller')
+        self.dbc.addChangeToDatabase(c)
+
+        c = self.dbc.runInteractionNow(
+            lambda t: lastChange(self.dbc, t, 'b1'))
+        self.assertEquals(c.revision, '1')
+        self.assertEquals(c.files, ['a'])
+        self.assertEquals(c.number, 1)
+
+        c = self.dbc.runInteractionNow(
+            lambda t: lastChange(self.dbc, t, 'b2'))
+        self.assertEquals(c, None)
+
     def test_lastGoodRev(self):
         createTestData(self.dbc)
 
@@ -119,6 +143,49 @@ class TestLastGoodFuncs(unittest.TestCase):
             self.dbc, t, 'b2', ['builder1', 'builder2'], 0, 3))
         self.assertEquals(rev, None)
 
+    def test_lastGoodRev_interleaved(self):
+        # buildset id: (revision, [builders that passed])
+        buildsets = {
+            1: ('r1', ['builder1', 'builder2']),
+            2: ('r2', ['builder1']),
+            3: ('r3', ['builder2']),
+            4: ('r2', ['builder2']),
+            5: ('r4', ['builder1']),
+            6: ('r3', ['builder1']),
+            7: ('r4', []),
+        }
+        for i, (rev, builders) in buildsets.items():
+            self.dbc.runQueryNow("""INSERT INTO sourcestamps (`id`, `branch`, `revision`) VALUES (%i, 'b1', '%s')""" % (i, rev))
+            self.dbc.runQueryNow("""INSERT INTO buildsets (`id`, `sourcestampid`, `submitted_at`) VALUES (%(i)i, %(i)i, 1)""" % dict(i=i))
+            for b in ['builder1', 'builder2']:
+                result = 0 if b in builders else 2
+                self.dbc.runQueryNow("""INSERT INTO buildrequests (`buildsetid`, `complete`, `results`, `buildername`, `complete_at`, `submitted_at`) VALUES (%i, 1, %i, '%s', %i, 1)""" % (i, result, b, i))
+
+        # r4 is the newest, but only passed on builder1. r3 and r2 passed
+        # everywhere, and r3 did so more recently.
+        rev = self.dbc.runInteractionNow(lambda t: lastGoodRev(
+            self.dbc, t, 'b1', ['builder1', 'builder2'], 0, 10))
+        self.assertEquals(rev, 'r3')
+        rev = self.dbc.runInteractionNow(lambda t: lastGoodRev(
+            self.dbc, t, 'b1', ['builder1', 'builder2'], 0, 5))
+        self.assertEquals(rev, 'r2')
+        rev = self.dbc.runInteractionNow(lambda t: lastGoodRev(
+            self.dbc, t, 'b1', ['builder1'], 0, 10))
+        self.assertEquals(rev, 'r3')
+        rev = self.dbc.runInteractionNow(lambda t: lastGoodRev(
+            self.dbc, t, 'b1', [], 0, 10))
+        self.assertEquals(rev, None)
+
+    def test_addLastGoodRevIndex(self):
+        misc_scheduler._lastGoodRevIndexChecked = False
+        self.dbc.runInteractionNow(
+            lambda t: misc_scheduler.addLastGoodRevIndex(self.dbc, t))
+        indexes = self.dbc.runQueryNow(
+            "SELECT name FROM sqlite_master WHERE type='index' AND "
+            "tbl_name='buildrequests'")
+        self.assertTrue(('buildrequests_buildername_complete_at',) in
+                        [tuple(r) for r in indexes])
+
     def test_getLatestRev(self):
         # First, we need to add a few changes!
         c1 = Change(who='me!', branch='b1', revision='1', files=[], comments='really important', when=1, revlink='from poller')
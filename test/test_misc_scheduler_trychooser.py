@@ -0,0 +1,133 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from buildbot.changes.changes import Change
+from buildbot.util import json
+
+import mock
+
+import buildbotcustom.misc_scheduler
+from buildbotcustom.misc_scheduler import TrySyntaxLookup, tryChooser
+
+
+def makePush(pushid, nodes, try_node=None):
+    changesets = []
+    for node in nodes:
+        desc = "Bug 1 - change %s" % node
+        if node == try_node:
+            desc += "\ntry: -b o -p linux -u none -t none"
+        changesets.append({"node": node, "desc": desc})
+    return json.dumps({str(pushid): {"changesets": changesets}})
+
+
+class TestTrySyntaxLookup(unittest.TestCase):
+    def setUp(self):
+        self.lookup = TrySyntaxLookup()
+        self.lookup.semaphore = defer.DeferredSemaphore(2)
+        self.requests = []
+        self.requested = []
+        self.pushes = {}
+        for i, push in enumerate([['a1', 'a2', 'a3'], ['b1'], ['c1', 'c2'],
+                                  ['d1']]):
+            data = makePush(i, push, try_node=push[-1])
+            for node in push:
+                self.pushes[node] = data
+
+        def getPage(url):
+            d = defer.Deferred()
+            node = url.rsplit('=', 1)[1]
+            self.requests.append((node, d))
+            self.requested.append(node)
+            return d
+        self.patcher = mock.patch.object(buildbotcustom.misc_scheduler,
+                                         'getPage', getPage)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def respond(self):
+        node, d = self.requests.pop(0)
+        d.callback(self.pushes[node])
+
+    def testOneRequestPerPush(self):
+        results = {}
+        for node in ['a1', 'a2', 'b1', 'a3', 'c1', 'a1', 'c2']:
+            self.lookup.getComments(node).addCallback(
+                lambda comments, node=node: results.setdefault(node, comments))
+        # Limited to 2 at once
+        self.assertEquals([n for n, d in self.requests], ['a1', 'a2'])
+        while self.requests:
+            self.respond()
+
+        self.assertEquals(sorted(results),
+                          ['a1', 'a2', 'a3', 'b1', 'c1', 'c2'])
+        self.failUnless(results['a2'].endswith(
+            "try: -b o -p linux -u none -t none"))
+        self.assertEquals(results['a2'], results['a3'])
+        # a1 and a2 (and c1 and c2) went out together before we knew they
+        # were in the same push; a3 and the second a1 were answered by
+        # earlier requests
+        self.assertEquals(self.requested, ['a1', 'a2', 'b1', 'c1', 'c2'])
+
+    def testCached(self):
+        self.lookup.getComments('a1')
+        self.respond()
+        results = []
+        self.lookup.getComments('a3').addCallback(results.append)
+        self.assertEquals(self.requests, [])
+        self.assertEquals(len(results), 1)
+
+    def testFailure(self):
+        errors = []
+        for i in range(2):
+            self.lookup.getComments('a1').addErrback(errors.append)
+        node, d = self.requests.pop(0)
+        d.errback(Exception("boom"))
+        self.assertEquals(len(errors), 2)
+        for f in errors:
+            self.assertEquals(f.getErrorMessage(), "boom")
+        # Failures aren't remembered
+        self.lookup.getComments('a1')
+        self.assertEquals(len(self.requests), 1)
+
+
+class TestTryChooser(unittest.TestCase):
+    def setUp(self):
+        self.patcher = mock.patch.object(buildbotcustom.misc_scheduler,
+                                         '_trySyntax')
+        self.lookup = self.patcher.start()
+        self.scheduler = mock.Mock()
+        self.scheduler.builderNames = ['Linux try build',
+                                       'WINNT 5.2 try build']
+        self.scheduler.prettyNames = {'linux': 'Linux try build',
+                                      'win32': 'WINNT 5.2 try build'}
+        self.scheduler.unittestPrettyNames = None
+        self.scheduler.unittestSuites = None
+        self.scheduler.talosSuites = None
+        self.scheduler.buildbotBranch = 'try'
+        self.scheduler.buildersWithSetsMap = None
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def testChooser(self):
+        self.lookup.getComments.side_effect = lambda rev: defer.succeed(
+            {'r2': 'try: -b o -p win32'}.get(rev))
+        c1 = Change('me', [], 'try: -b o -p linux', branch='try',
+                    revision='r1')
+        c2 = Change('me', [], 'no syntax', branch='try', revision='r2')
+        c3 = Change('me', [], 'no syntax', branch='try', revision='r3')
+        d = tryChooser(self.scheduler, [c1, c2, c3])
+
+        def check(result):
+            self.assertEquals(result[c1], ['Linux try build'])
+            self.assertEquals(result[c2], ['WINNT 5.2 try build'])
+            self.assertEquals(sorted(result[c3]),
+                              ['Linux try build', 'WINNT 5.2 try build'])
+            # Only changes without try syntax are looked up
+            self.assertEquals(
+                [a[0][0] for a in self.lookup.getComments.call_args_list],
+                ['r2', 'r3'])
+        d.addCallback(check)
+        return d
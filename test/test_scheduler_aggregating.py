@@ -1,10 +1,12 @@
 # Tests for the aggregating scheduler
+from __future__ import with_statement
 import os
 import shutil
 import json
 
 from buildbot.db import dbspec, connector
 from buildbot.db.schema.manager import DBSchemaManager
+from buildbot.status.builder import SUCCESS, WARNINGS, FAILURE
 from twisted.trial import unittest
 
 import mock
@@ -314,3 +316,127 @@ class TestAggregatingScheduler(unittest.TestCase):
         d.addCallback(check)
 
         return d
+
+    def testEventDriven(self):
+        # In event driven mode, we find out about finished builds from the
+        # status, and only touch the db when remainingBuilders changes
+        s = AggregatingScheduler(name='s1', branch='b1', builderNames=['d1', 'd2'], upstreamBuilders=['u1', 'u2'], eventDriven=True)
+        s.parent = mock.Mock()
+        s.parent.db = self.dbc
+        status = s.parent.master.getStatus.return_value
+
+        def build(complete_at):
+            b = mock.Mock()
+            b.getTimes.return_value = (100, complete_at)
+            return b
+
+        def getState():
+            schedulers = self.dbc.runQueryNow("SELECT name, state FROM schedulers")
+            self.assertEquals(len(schedulers), 1)
+            return json.loads(schedulers[0][1])
+
+        d = self.dbc.addSchedulers([s])
+
+        def start(_):
+            s.startService()
+            self.assertEquals(status.subscribe.call_count, 1)
+            watcher = status.subscribe.call_args[0][0]
+            self.assertEquals(watcher.builderAdded('u1', mock.Mock()),
+                              watcher)
+            self.assertEquals(watcher.builderAdded('d1', mock.Mock()), None)
+
+            # Nothing has finished, so we don't need the db
+            with mock.patch.object(s, 'findNewBuilds') as findNewBuilds:
+                self.assertEquals(s.run(), None)
+                self.assertEquals(findNewBuilds.call_count, 0)
+
+            watcher.buildFinished('u1', build(124), SUCCESS)
+            watcher.buildFinished('u2', build(125), FAILURE)
+            return s.run()
+        d.addCallback(start)
+
+        def checkFirst(_):
+            self.assertEquals(getState(), {"remainingBuilders": ["u2"], "upstreamBuilders": ["u1", "u2"], "lastCheck": 124, "lastReset": 123})
+
+            # Another u1 build doesn't change what we're waiting for
+            watcher = status.subscribe.call_args[0][0]
+            watcher.buildFinished('u1', build(126), SUCCESS)
+            return s.run()
+        d.addCallback(checkFirst)
+
+        def checkUnchanged(_):
+            self.assertEquals(getState(), {"remainingBuilders": ["u2"], "upstreamBuilders": ["u1", "u2"], "lastCheck": 124, "lastReset": 123})
+            self.assertEquals(s.state['lastCheck'], 126)
+
+            watcher = status.subscribe.call_args[0][0]
+            watcher.buildFinished('u2', build(127), WARNINGS)
+            return s.run()
+        d.addCallback(checkUnchanged)
+
+        def checkRequests(_):
+            requests = self.dbc.runQueryNow("SELECT buildername FROM buildrequests WHERE complete=0")
+            self.assertEquals(sorted([r[0] for r in requests]), ['d1', 'd2'])
+            self.assertEquals(getState(), {"remainingBuilders": ["u1", "u2"], "upstreamBuilders": ["u1", "u2"], "lastCheck": 127, "lastReset": 123})
+
+            s.stopService()
+            self.assertEquals(status.unsubscribe.call_count, 1)
+        d.addCallback(checkRequests)
+
+        return d
+
+    def testEventDrivenStop(self):
+        # A stopped scheduler stops watching its upstream builders
+        s = AggregatingScheduler(name='s1', branch='b1', builderNames=['d1'], upstreamBuilders=['u1'], eventDriven=True)
+        s.parent = mock.Mock()
+        s.parent.db = self.dbc
+        status = s.parent.master.getStatus.return_value
+        u1 = mock.Mock()
+
+        d = self.dbc.addSchedulers([s])
+
+        def start(_):
+            s.startService()
+            watcher = status.subscribe.call_args[0][0]
+            watcher.builderAdded('u1', u1)
+            s.stopService()
+            self.assertEquals(status.unsubscribe.call_args[0], (watcher,))
+            self.assertEquals(u1.unsubscribe.call_args[0], (watcher,))
+
+            # Anything still delivered is ignored
+            build = mock.Mock()
+            build.getTimes.return_value = (100, 124)
+            watcher.buildFinished('u1', build, SUCCESS)
+            self.assertEquals(s.finishedBuilds, [])
+        d.addCallback(start)
+        return d
+
+    def testEventDrivenStartup(self):
+        # Builds which finished while we weren't running are picked up from
+        # the db when we start
+        old_state = {"remainingBuilders": ["u1", "u2"], "upstreamBuilders": ["u1", "u2"], "lastCheck": 100, "lastReset": 100}
+        self.dbc.runQueryNow("""
+                INSERT into schedulers
+                (name, class_name, state) VALUES
+                ('s1', 'buildbotcustom.scheduler.AggregatingScheduler', '%s')
+        """ % self.dbc.quoteq(json.dumps(old_state)))
+        self.dbc.runQueryNow("""
+                INSERT into buildrequests
+                (buildsetid, buildername, complete, complete_at, submitted_at, results) VALUES
+                (0, 'u1', 1, 124, 0, 0)
+        """)
+
+        s = AggregatingScheduler(name='s1', branch='b1', builderNames=['d1', 'd2'], upstreamBuilders=['u1', 'u2'], eventDriven=True)
+        s.parent = mock.Mock()
+        s.parent.db = self.dbc
+
+        d = self.dbc.addSchedulers([s])
+
+        def start(_):
+            s.startService()
+            schedulers = self.dbc.runQueryNow("SELECT name, state FROM schedulers")
+            state = json.loads(schedulers[0][1])
+            self.assertEquals(state, {"remainingBuilders": ["u2"], "upstreamBuilders": ["u1", "u2"], "lastCheck": 124, "lastReset": 100})
+            self.assertEquals(s.state, state)
+        d.addCallback(start)
+
+        return d
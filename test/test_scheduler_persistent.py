@@ -0,0 +1,106 @@
+# Tests for the PersistentScheduler
+import os
+import shutil
+
+from buildbot.db import dbspec, connector
+from buildbot.db.schema.manager import DBSchemaManager
+from buildbot.sourcestamp import SourceStamp
+from twisted.trial import unittest
+
+import mock
+
+from buildbotcustom.scheduler import PersistentScheduler
+
+
+class TestPersistentScheduler(unittest.TestCase):
+    basedir = "test_scheduler_persistent"
+
+    def setUp(self):
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+        spec = dbspec.DBSpec.from_url("sqlite:///state.sqlite", self.basedir)
+        manager = DBSchemaManager(spec, self.basedir)
+        manager.upgrade()
+
+        self.dbc = connector.DBConnector(spec)
+        self.dbc.start()
+
+        self._patcher = mock.patch("buildbotcustom.scheduler.now")
+        self._time = self._patcher.start()
+        self._time.return_value = 123
+
+    def tearDown(self):
+        self.dbc.stop()
+        shutil.rmtree(self.basedir)
+        self._patcher.stop()
+
+    def makeScheduler(self, **kwargs):
+        s = PersistentScheduler(name='s1', **kwargs)
+        s.parent = mock.Mock()
+        s.parent.db = self.dbc
+        return s
+
+    def pendingCounts(self):
+        return dict(self.dbc.runQueryNow(
+            "SELECT buildername, COUNT(*) FROM buildrequests"
+            " WHERE complete=0 AND claimed_at=0 GROUP BY buildername"))
+
+    def testTopUp(self):
+        s = self.makeScheduler(numPending=2, builderNames=['b1', 'b2', 'b3'],
+                               properties={'foo': 'bar'})
+        d = self.dbc.addSchedulers([s])
+
+        def addExisting(_):
+            # b2 already has one pending request, b3 has plenty
+            ssid = self.dbc.runInteractionNow(
+                lambda t: self.dbc.get_sourcestampid(SourceStamp(), t))
+            for builderName in ['b2', 'b3', 'b3', 'b3']:
+                self.dbc.runInteractionNow(
+                    lambda t: s.create_buildset(ssid, "test", t,
+                                                builderNames=[builderName]))
+            # Claimed requests don't count
+            self.dbc.runQueryNow("UPDATE buildrequests SET claimed_at=1"
+                                 " WHERE id=2")
+            return s.run()
+        d.addCallback(addExisting)
+
+        def check(next_run):
+            self.assertEquals(next_run, 123 + s.pollInterval)
+            self.assertEquals(self.pendingCounts(),
+                              {'b1': 2, 'b2': 2, 'b3': 2})
+            # Each new buildset has its properties and one request
+            rows = self.dbc.runQueryNow(
+                "SELECT buildsets.id, buildrequests.buildername,"
+                "  buildset_properties.property_value"
+                " FROM buildsets"
+                " JOIN buildrequests ON buildsets.id=buildrequests.buildsetid"
+                " JOIN buildset_properties"
+                "  ON buildsets.id=buildset_properties.buildsetid"
+                " WHERE buildsets.reason='scheduler'"
+                "  AND buildset_properties.property_name='foo'"
+                " ORDER BY buildsets.id")
+            self.assertEquals([(bsid, bn) for (bsid, bn, v) in rows],
+                              [(5, 'b1'), (6, 'b1'), (7, 'b2')])
+            self.assertEquals(set(v for (bsid, bn, v) in rows),
+                              set(['["bar", "Scheduler"]']))
+            self.assertEquals(
+                [c[0][1] for c in s.parent.publish_buildset.call_args_list],
+                [1, 2, 3, 4, 5, 6, 7])
+
+            # Nothing more to do until the pollInterval is up
+            self.assertEquals(s.run(), 123 + s.pollInterval + 1)
+        d.addCallback(check)
+        return d
+
+    def testManyBuilders(self):
+        builderNames = ['builder%i' % i for i in range(250)]
+        s = self.makeScheduler(numPending=3, builderNames=builderNames)
+        d = self.dbc.addSchedulers([s])
+        d.addCallback(lambda _: s.run())
+
+        def check(_):
+            self.assertEquals(self.pendingCounts(),
+                              dict((bn, 3) for bn in builderNames))
+        d.addCallback(check)
+        return d
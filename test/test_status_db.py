@@ -0,0 +1,781 @@
+import threading
+
+import mock
+import sqlalchemy
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from buildbot.process.properties import Properties
+
+import buildbotcustom.status.db.model as model
+import buildbotcustom.status.db.status as status_module
+from buildbotcustom.status.db.status import StatusWriter, DBBuildStatus, \
+    StatusExecutor, ReactorLatency, FingerprintBackfill, DBStatus
+
+
+class FakeStep(object):
+    def __init__(self, name, started=None, finished=None):
+        self.name = name
+        self.text = [name]
+        self.started = started
+        self.finished = finished
+        self.results = None
+
+
+class TestStatusWriter(unittest.TestCase):
+    def setUp(self):
+        self.Session = model.connect('sqlite:///%s' % self.mktemp())
+        session = self.Session()
+        master = model.Master(url=u'http://master')
+        b = model.Build(buildnumber=1, master=master,
+                        builder=model.Builder(name=u'b1', master=master),
+                        slave=model.Slave(name=u's1'))
+        b.steps.append(model.Step(name='compile'))
+        b.steps.append(model.Step(name='test'))
+        session.add(b)
+        session.commit()
+        self.build_id = b.id
+        session.close()
+
+        self.writer = StatusWriter(self.Session)
+        self.build = mock.Mock()
+        self.props = Properties(branch='mozilla-central')
+        self.build.getProperties.return_value = self.props
+
+    def tearDown(self):
+        return self.writer.stop()
+
+    def getSteps(self):
+        session = self.Session()
+        b = session.query(model.Build).get(self.build_id)
+        steps = [(s.name, s.starttime, s.endtime, s.status)
+                 for s in b.steps]
+        props = dict((p.name, p.value) for p in b.properties)
+        session.close()
+        return steps, props
+
+    def testCoalesce(self):
+        status = DBBuildStatus(self.build_id, writer=self.writer)
+        compile_step = FakeStep('compile', 10, 20)
+        test_step = FakeStep('test', 20, 30)
+        self.assertEquals(status.stepStarted(self.build, compile_step),
+                          status)
+        status.stepFinished(self.build, compile_step, (0, []))
+        self.props.setProperty('got_revision', 'abcdef', 'Build')
+        status.stepStarted(self.build, test_step)
+        status.stepFinished(self.build, test_step, (2, []))
+        # A step we didn't know about
+        status.stepStarted(self.build, FakeStep('upload', 30))
+        # Changes after the step finished aren't written
+        self.props.setProperty('got_revision', '123456', 'Build')
+
+        # Nothing has been written yet
+        self.assertEquals(self.getSteps()[0][0],
+                          ('compile', None, None, None))
+        # Three steps and the properties
+        self.assertEquals(self.writer.numPending, 4)
+
+        with mock.patch.object(self.writer, 'write',
+                               wraps=self.writer.write) as write:
+            d = self.writer.flush()
+
+        def check(_):
+            self.assertEquals(write.call_count, 1)
+            steps, props = self.getSteps()
+            utc = model.datetime.datetime.utcfromtimestamp
+            self.assertEquals(steps, [
+                ('compile', utc(10), utc(20), 0),
+                ('test', utc(20), utc(30), 2),
+                ('upload', utc(30), None, None),
+            ])
+            self.assertEquals(props, {'branch': 'mozilla-central',
+                                      'got_revision': 'abcdef'})
+            self.assertEquals(self.writer.numPending, 0)
+        d.addCallback(check)
+        return d
+
+    def testFlushWhenFull(self):
+        self.writer.maxPending = 3
+        release = threading.Event()
+        write = self.writer.write
+
+        def slowWrite(batch):
+            release.wait(5)
+            write(batch)
+        self.patch(self.writer, 'write', slowWrite)
+
+        for name in ('compile', 'test'):
+            self.writer.stepStarted(self.build_id, FakeStep(name, 10))
+        self.assertNotEquals(self.writer.flushTimer, None)
+        # Filling the queue starts writing it without waiting for the timer
+        self.writer.stepFinished(self.build_id, self.props,
+                                 FakeStep('compile', 10, 20), (0, []))
+        self.assertEquals(self.writer.flushTimer, None)
+        self.assertEquals(self.writer.numPending, 0)
+
+        # The reactor isn't held up while that's being written; further
+        # updates are queued and coalesced for the next batch
+        self.writer.stepFinished(self.build_id, self.props,
+                                 FakeStep('test', 10, 20), (2, []))
+        self.writer.stepStarted(self.build_id, FakeStep('upload', 20))
+        self.writer.stepFinished(self.build_id, self.props,
+                                 FakeStep('upload', 20, 30), (0, []))
+        self.assertEquals(self.writer.numPending, 3)
+        self.assertEquals(self.getSteps()[0][0][1], None)
+
+        release.set()
+        d = self.writer.flush()
+
+        def check(_):
+            steps, props = self.getSteps()
+            self.assertEquals([(s[0], s[3]) for s in steps],
+                              [('compile', 0), ('test', 2), ('upload', 0)])
+            self.assertEquals(props, {'branch': 'mozilla-central'})
+            self.assertEquals(self.writer.numPending, 0)
+        d.addCallback(check)
+        return d
+
+    def testBadBuild(self):
+        self.patch(status_module, 'log', mock.Mock())
+        # There's no build 999, so its update can't be written
+        self.writer.stepStarted(999, FakeStep('compile', 10))
+        self.writer.stepStarted(self.build_id, FakeStep('compile', 10))
+        writeBuilds = mock.Mock(wraps=self.writer.writeBuilds)
+        self.patch(self.writer, 'writeBuilds', writeBuilds)
+        d = self.writer.flush()
+
+        def check(_):
+            # The batch, and then each build on its own
+            self.assertEquals(writeBuilds.call_count, 3)
+            self.assertEquals(self.getSteps()[0][0][1],
+                              model.datetime.datetime.utcfromtimestamp(10))
+            # Bad builds aren't retried
+            self.assertEquals(self.writer.pending, {})
+            self.assertEquals(self.writer.flushTimer, None)
+        d.addCallback(check)
+        return d
+
+    def testLostConnection(self):
+        self.patch(status_module, 'log', mock.Mock())
+        self.writer.lostConnection = mock.Mock()
+        writeBuilds = self.writer.writeBuilds
+        calls = []
+
+        def failOnce(batch):
+            calls.append(batch)
+            if len(calls) == 1:
+                raise sqlalchemy.exc.OperationalError(
+                    'UPDATE', {}, Exception("server has gone away"))
+            writeBuilds(batch)
+        self.patch(self.writer, 'writeBuilds', failOnce)
+        compile_step = FakeStep('compile', 10)
+        self.writer.stepStarted(self.build_id, compile_step)
+        d = self.writer.flush()
+
+        def retry(_):
+            self.assertEquals(self.writer.lostConnection.call_count, 1)
+            self.assertNotEquals(self.writer.flushTimer, None)
+            self.assertEquals(self.writer.numPending, 1)
+            # Newer updates win over the ones being retried
+            compile_step.text = ['compiled']
+            self.writer.stepFinished(self.build_id, self.props,
+                                     FakeStep('compile', None, 20), (0, []))
+            return self.writer.flush()
+        d.addCallback(retry)
+
+        def check(_):
+            self.assertEquals(len(calls), 2)
+            steps, props = self.getSteps()
+            utc = model.datetime.datetime.utcfromtimestamp
+            self.assertEquals(steps[0], ('compile', utc(10), utc(20), 0))
+            self.assertEquals(props, {'branch': 'mozilla-central'})
+            self.assertEquals(self.writer.lostConnection.call_count, 1)
+        d.addCallback(check)
+        return d
+
+    def testStop(self):
+        self.writer.stepStarted(self.build_id, FakeStep('compile', 10))
+        d = self.writer.stop()
+
+        def check(_):
+            self.assertEquals(self.getSteps()[0][0][1],
+                              model.datetime.datetime.utcfromtimestamp(10))
+            self.assertEquals(self.writer.flushTimer, None)
+        d.addCallback(check)
+        return d
+
+    def testThreaded(self):
+        executor = StatusExecutor(threads=2)
+        key = ('build', 'b1', 1)
+        status = DBBuildStatus(None, executor=executor, key=key)
+        # Like DBStatus.buildStarted
+        executor.run([key], setattr, status, 'build_id', self.build_id)
+        compile_step = FakeStep('compile', 10, 20)
+        status.stepStarted(self.build, compile_step)
+        status.stepFinished(self.build, compile_step, (0, []))
+        # The worker threads only see things as they were when the step
+        # finished
+        compile_step.text = ['changed']
+        self.props.setProperty('got_revision', 'abcdef', 'Build')
+        d = executor.stop()
+
+        def check(_):
+            steps, props = self.getSteps()
+            utc = model.datetime.datetime.utcfromtimestamp
+            self.assertEquals(steps[0], ('compile', utc(10), utc(20), 0))
+            self.assertEquals(props, {'branch': 'mozilla-central'})
+            self.assertEquals(self.writer.numPending, 0)
+            session = self.Session()
+            self.assertEquals(session.query(model.Step).filter_by(
+                name='compile').one().description, ['compile'])
+            session.close()
+        d.addCallback(check)
+        return d
+
+
+class FakeSourceStamp(object):
+    branch = 'mozilla-central'
+    revision = 'abcdef'
+    patch = None
+    changes = []
+
+
+class FakeRequest(object):
+    builderName = 'b1'
+    source = FakeSourceStamp()
+
+    def getSubmitTime(self):
+        return 10
+
+
+class FakeBuild(object):
+    reason = 'because'
+    results = None
+    started = 20
+    finished = None
+
+    def __init__(self, number, requests):
+        self.number = number
+        self.requests = requests
+        self.steps = [FakeStep('compile', 20)]
+        self.properties = Properties(branch='mozilla-central')
+
+    def getSlavename(self):
+        return 's1'
+
+    def getSourceStamp(self):
+        return FakeSourceStamp()
+
+    def getRequests(self):
+        return self.requests
+
+    def getProperties(self):
+        return self.properties
+
+
+class TestDBStatusThreaded(unittest.TestCase):
+    def setUp(self):
+        self.Session = model.connect('sqlite:///%s' % self.mktemp())
+        session = self.Session()
+        master = model.Master(url=u'http://master')
+        session.add(master)
+        session.commit()
+        self.status = DBStatus('sqlite://', threads=2)
+        self.status.Session = self.Session
+        self.status.master_id = master.id
+        self.status.executor = StatusExecutor(threads=2)
+        session.close()
+
+    def tearDown(self):
+        return self.status.executor.stop()
+
+    def testBuildStarted(self):
+        requests = [FakeRequest(), FakeRequest()]
+        for r in requests:
+            self.status.requestSubmitted(r)
+        build = FakeBuild(1, requests)
+        status = self.status.buildStarted('b1', build)
+        # Changes made after the build started aren't seen by the workers
+        build.steps.append(FakeStep('test'))
+        build.properties.setProperty('got_revision', 'abcdef', 'Build')
+        d = self.status.executor.stop()
+
+        def check(_):
+            self.assertEquals(self.status.request_mapping, {})
+            session = self.Session()
+            b = session.query(model.Build).get(status.build_id)
+            self.assertEquals(set(s.name for s in b.steps), set(['compile']))
+            self.assertEquals([p.name for p in b.properties], ['branch'])
+            self.assertEquals(len(b.requests), 2)
+            self.assertEquals(session.query(model.Request).count(), 2)
+            self.assertEquals([r.startcount for r in b.requests], [1, 1])
+            session.close()
+        d.addCallback(check)
+        return d
+
+    def testRequestCancelled(self):
+        request = FakeRequest()
+        self.status.requestSubmitted(request)
+        self.status.requestCancelled(None, request)
+        d = self.status.executor.stop()
+
+        def check(_):
+            self.assertEquals(self.status.request_mapping, {})
+            session = self.Session()
+            self.assertEquals(session.query(model.Request).one().cancelled,
+                              True)
+            session.close()
+        d.addCallback(check)
+        return d
+
+
+class TestStatusExecutor(unittest.TestCase):
+    def setUp(self):
+        self.executor = StatusExecutor(threads=2)
+        self.events = []
+
+    def tearDown(self):
+        return self.executor.stop()
+
+    def record(self, name, wait=None):
+        if wait:
+            wait.wait(5)
+        self.events.append(name)
+        return name
+
+    def testOrdering(self):
+        unblock = threading.Event()
+        d1 = self.executor.run(['b1'], self.record, 'b1 start', unblock)
+        d2 = self.executor.run(['b1'], self.record, 'b1 finish')
+        # b2 doesn't wait for b1
+        d3 = self.executor.run(['b2'], self.record, 'b2 start')
+        d3.addCallback(lambda r: unblock.set() or r)
+        # but this waits for both
+        d4 = self.executor.run(['b1', 'b2'], self.record, 'both')
+        d = defer.gatherResults([d1, d2, d3, d4])
+
+        def check(results):
+            self.assertEquals(results,
+                              ['b1 start', 'b1 finish', 'b2 start', 'both'])
+            self.assertEquals(self.events,
+                              ['b2 start', 'b1 start', 'b1 finish', 'both'])
+            self.assertEquals(self.executor.tails, {})
+            self.assertEquals(self.executor.blocked, 0)
+        d.addCallback(check)
+        return d
+
+    def testStop(self):
+        self.executor.run(['b1'], self.record, 'b1')
+        d = self.executor.stop()
+
+        def check(_):
+            self.assertEquals(self.events, ['b1'])
+            self.assertEquals(self.executor.pool, None)
+            # Now everything runs in the reactor thread
+            self.executor.run(['b1'], self.record, 'b1 again')
+            self.assertEquals(self.events, ['b1', 'b1 again'])
+            self.assertTrue(self.executor.blocked > 0)
+        d.addCallback(check)
+        return d
+
+
+class TestReactorLatency(unittest.TestCase):
+    def testReport(self):
+        executor = StatusExecutor()
+        latency = ReactorLatency(executor)
+        with mock.patch('time.time') as time:
+            time.return_value = 1000
+            latency.start()
+            latency.stop()
+            executor.blocked = 2.5
+            latency.samples = [0.0, 0.5]
+            # The last tick was 0.1s late
+            latency.expected = 1299.9
+            with mock.patch('buildbotcustom.status.db.status.log') as log:
+                time.return_value = 1300
+                latency.tick()
+                latency.stop()
+        self.assertEquals(log.msg.call_args[0][0],
+                          "DBMSG: reactor latency over 300s: mean 0.200s, "
+                          "max 0.500s; 2.500s spent on statusdb work in the "
+                          "reactor thread")
+        self.assertEquals(latency.samples, [])
+
+
+class TestLRUCache(unittest.TestCase):
+    def testEviction(self):
+        cache = model.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)
+        # 'b' was the least recently used
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+        cache.discard('a')
+        self.assertEquals(cache.data.keys(), ['c'])
+
+    def testThreads(self):
+        # Property and file ids are cached by the reactor and the statusdb
+        # worker threads at once
+        cache = model.LRUCache(10)
+        errors = []
+
+        def run():
+            try:
+                for i in range(5000):
+                    key = i % 15
+                    cache.set(key, key)
+                    cache.get(key)
+                    cache.discard(key - 1)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(errors, [])
+        self.assertTrue(len(cache.data) <= 10)
+
+
+class TestProperty(unittest.TestCase):
+    def setUp(self):
+        self.Session = model.connect('sqlite:///%s' % self.mktemp())
+        self.patch(model, 'propertyIds', model.LRUCache(2))
+
+    def testGetAll(self):
+        session = self.Session()
+        props = Properties(branch='mozilla-central')
+        props.setProperty('platform', {'os': 'linux', 'bits': 64}, 'Builder')
+        first = model.Property.fromBBProperties(session, props)
+        session.commit()
+        self.assertEquals(sorted((p.name, p.value, p.source) for p in first),
+                          [('branch', 'mozilla-central', 'TEST'),
+                           ('platform', {'os': 'linux', 'bits': 64},
+                            'Builder')])
+
+        session = self.Session()
+        props = Properties(product='firefox')
+        props.setProperty('platform', {'bits': 64, 'os': 'linux'}, 'Builder')
+        props.setProperty('branch', 'mozilla-central', 'TEST')
+        with mock.patch.object(model, 'insertIgnore',
+                               wraps=model.insertIgnore) as insertIgnore:
+            second = model.Property.fromBBProperties(session, props)
+        session.commit()
+        # Only the new property is inserted
+        self.assertEquals(insertIgnore.call_count, 1)
+        self.assertEquals([r['name'] for r in insertIgnore.call_args[0][2]],
+                          ['product'])
+        self.assertEquals(sorted(p.id for p in second),
+                          sorted([p.id for p in first] + [3]))
+        self.assertEquals(session.query(model.Property).count(), 3)
+        # Only the most recently used ones are cached
+        self.assertEquals(len(model.propertyIds.data), 2)
+        product = [p for p in second if p.name == 'product'][0]
+        self.assertEquals(model.propertyIds.get(product.hash), 3)
+
+    def testStaleCache(self):
+        session = self.Session()
+        model.Property.get(session, 'branch', '', 'mozilla-central')
+        session.rollback()
+        # We remembered the id of a row that was rolled back
+        self.assertEquals(model.propertyIds.data.values(), [1])
+
+        session = self.Session()
+        p = model.Property.get(session, 'product', '', 'firefox')
+        session.commit()
+        self.assertEquals(p.id, 1)
+        p = model.Property.get(session, 'branch', '', 'mozilla-central')
+        session.commit()
+        self.assertEquals((p.id, p.name), (2, 'branch'))
+
+    def testInsertedElsewhere(self):
+        # Another master commits the property after our transaction's
+        # snapshot was taken, so insertIgnore skips it, and only a locking
+        # read can see it
+        h = model.Property.makeHash('branch', '', 'mozilla-central')
+        other = self.Session()
+        other.add(model.Property(name=u'branch', source=u'',
+                                 value='mozilla-central', hash=h))
+        other.commit()
+        other.close()
+
+        find = model.Property._find
+
+        def snapshotFind(cls, session, criterion, lock=False):
+            found = find(session, criterion, lock)
+            if not lock:
+                found.pop(h, None)
+            return found
+        self.patch(model.Property, '_find', classmethod(snapshotFind))
+        session = self.Session()
+        p = model.Property.get(session, 'branch', '', 'mozilla-central')
+        session.commit()
+        self.assertEquals((p.id, p.hash), (1, h))
+        self.assertEquals(session.query(model.Property).count(), 1)
+
+    def testUpgrade(self):
+        engine = model.metadata.bind
+        engine.execute("DROP TABLE properties")
+        engine.execute("CREATE TABLE properties (id INTEGER PRIMARY KEY, "
+                       "name VARCHAR(40), source VARCHAR(40), value TEXT)")
+        model.upgrade(engine)
+        session = self.Session()
+        p = model.Property.get(session, 'branch', '', 'mozilla-central')
+        session.commit()
+        self.assertEquals(p.hash, model.Property.makeHash(
+            'branch', '', 'mozilla-central'))
+        indexes = engine.execute("SELECT name FROM sqlite_master"
+                                 " WHERE tbl_name='properties'").fetchall()
+        self.assertEquals(indexes, [('properties',), ('ix_properties_hash',)])
+
+    def testInterruptedUpgrade(self):
+        # A master went away after adding the column, but before indexing it
+        engine = model.metadata.bind
+        engine.execute("DROP INDEX ix_properties_hash")
+        model.upgrade(engine)
+        indexes = engine.execute("SELECT name FROM sqlite_master"
+                                 " WHERE tbl_name='properties'").fetchall()
+        self.assertTrue(('ix_properties_hash',) in indexes)
+
+    def testConcurrentUpgrade(self):
+        # Another master adds the column after we've checked for it
+        engine = model.metadata.bind
+        engine.execute("DROP INDEX ix_properties_hash")
+        hasColumn = model.hasColumn
+        checked = []
+
+        def staleHasColumn(engine, table, column):
+            if table.name == 'properties' and not checked:
+                checked.append(column.name)
+                return False
+            return hasColumn(engine, table, column)
+        self.patch(model, 'hasColumn', staleHasColumn)
+        model.upgrade(engine)
+        self.assertEquals(checked, ['hash'])
+        indexes = engine.execute("SELECT name FROM sqlite_master"
+                                 " WHERE tbl_name='properties'").fetchall()
+        self.assertTrue(('ix_properties_hash',) in indexes)
+
+
+class TestFile(unittest.TestCase):
+    def setUp(self):
+        self.Session = model.connect('sqlite:///%s' % self.mktemp())
+        self.patch(model, 'fileIds', model.LRUCache(3))
+        self.patch(model.File, 'chunkSize', 2)
+
+    def testGetAll(self):
+        session = self.Session()
+        first = model.File.getall(session, ['a', 'b', 'c', 'a'])
+        session.commit()
+        self.assertEquals([(f.id, f.path) for f in first],
+                          [(1, 'a'), (2, 'b'), (3, 'c')])
+
+        session = self.Session()
+        with mock.patch.object(model, 'insertIgnore',
+                               wraps=model.insertIgnore) as insertIgnore:
+            second = model.File.getall(session, ['d', 'c', 'b', 'a'])
+        session.commit()
+        # Only the new path is inserted, in one go
+        self.assertEquals(insertIgnore.call_count, 1)
+        self.assertEquals([r['path'] for r in insertIgnore.call_args[0][2]],
+                          ['d'])
+        self.assertEquals([(f.id, f.path) for f in second],
+                          [(4, 'd'), (3, 'c'), (2, 'b'), (1, 'a')])
+        self.assertEquals(session.query(model.File).count(), 4)
+        self.assertEquals(len(model.fileIds.data), 3)
+        self.assertEquals(model.fileIds.get(u'd'), 4)
+        self.assertEquals(model.File.get(session, 'a').id, 1)
+
+    def testStaleCache(self):
+        session = self.Session()
+        model.File.get(session, 'a')
+        session.rollback()
+        self.assertEquals(model.fileIds.data.items(), [('a', 1)])
+
+        session = self.Session()
+        self.assertEquals(model.File.get(session, 'b').id, 1)
+        session.commit()
+        f = model.File.get(session, 'a')
+        self.assertEquals((f.id, f.path), (2, 'a'))
+
+    def testInsertedElsewhere(self):
+        # Like TestProperty.testInsertedElsewhere
+        other = self.Session()
+        other.add(model.File(path=u'b', hash=model.File.makeHash(u'b')))
+        other.commit()
+        other.close()
+
+        find = model.File._find
+
+        def snapshotFind(cls, session, column, values, lock=False):
+            found = find(session, column, values, lock)
+            if not lock:
+                found.pop(u'b', None)
+            return found
+        self.patch(model.File, '_find', classmethod(snapshotFind))
+        session = self.Session()
+        files = model.File.getall(session, ['a', 'b'])
+        session.commit()
+        self.assertEquals([(f.id, f.path) for f in files],
+                          [(2, 'a'), (1, 'b')])
+
+
+class TestChange(unittest.TestCase):
+    def setUp(self):
+        self.Session = model.connect('sqlite:///%s' % self.mktemp())
+
+    def makeChange(self, files):
+        change = mock.Mock()
+        change.number = 1
+        change.branch = 'mozilla-central'
+        change.revision = 'abcdef'
+        change.who = 'me'
+        change.comments = 'fix it'
+        change.when = 1000
+        change.files = files
+        return change
+
+    def testFromBBChange(self):
+        session = self.Session()
+        c1 = model.Change.fromBBChange(session, self.makeChange(['a', 'b']))
+        session.add(c1)
+        session.commit()
+        # Same change details, but different files
+        c2 = model.Change.fromBBChange(session, self.makeChange(['a', 'c']))
+        session.add(c2)
+        session.commit()
+        self.assertNotEquals(c1.id, c2.id)
+        self.assertEquals(session.query(model.File).count(), 3)
+
+        session = self.Session()
+        c = model.Change.fromBBChange(session, self.makeChange(['c', 'a']))
+        self.assertEquals(c.id, c2.id)
+        c = model.Change.fromBBChange(session, self.makeChange(['b', 'a']))
+        self.assertEquals(c.id, c1.id)
+
+    def makeSourceStamp(self, changes, patch=None):
+        ss = mock.Mock()
+        ss.branch = 'mozilla-central'
+        ss.revision = 'abcdef'
+        ss.patch = patch
+        ss.changes = changes
+        return ss
+
+    def testFromBBSourcestamp(self):
+        session = self.Session()
+        ss = self.makeSourceStamp([self.makeChange(['a'])])
+        s1 = model.SourceStamp.fromBBSourcestamp(session, ss)
+        session.add(s1)
+        session.commit()
+        self.assertEquals(model.SourceStamp.fromBBSourcestamp(session, ss).id,
+                          s1.id)
+        ss.patch = (1, 'diff')
+        s2 = model.SourceStamp.fromBBSourcestamp(session, ss)
+        session.add(s2)
+        session.commit()
+        self.assertNotEquals(s2.id, s1.id)
+        self.assertEquals(model.SourceStamp.fromBBSourcestamp(session, ss).id,
+                          s2.id)
+        # A new change means a new sourcestamp
+        ss.changes.append(self.makeChange(['b']))
+        s3 = model.SourceStamp.fromBBSourcestamp(session, ss)
+        self.assertEquals(s3.id, None)
+        self.assertEquals(len(s3.changes), 2)
+
+    def testBackfill(self):
+        session = self.Session()
+        sourcestamps = []
+        for files, patch in [(['a'], None), (['a', 'b'], (1, 'diff')),
+                             (['c'], None)]:
+            ss = self.makeSourceStamp([self.makeChange(files)], patch)
+            s = model.SourceStamp.fromBBSourcestamp(session, ss)
+            session.add(s)
+            sourcestamps.append(ss)
+        session.commit()
+        expected = [(c.id, c.fingerprint)
+                    for c in session.query(model.Change)] + \
+                   [(stamp.id, stamp.fingerprint)
+                    for stamp in session.query(model.SourceStamp)]
+        # As if they were written before there were fingerprints
+        engine = model.metadata.bind
+        engine.execute("UPDATE changes SET fingerprint=NULL")
+        engine.execute("UPDATE sourcestamps SET fingerprint=NULL WHERE id>1")
+
+        session = self.Session()
+        counts = []
+        while not counts or counts[-1]:
+            counts.append(model.backfillFingerprints(session, batchSize=2))
+        self.assertEquals(counts, [4, 1, 0])
+        self.assertEquals([(c.id, c.fingerprint)
+                           for c in session.query(model.Change)] +
+                          [(stamp.id, stamp.fingerprint)
+                           for stamp in session.query(model.SourceStamp)],
+                          expected)
+        for i, ss in enumerate(sourcestamps):
+            s = model.SourceStamp.fromBBSourcestamp(session, ss)
+            self.assertEquals(s.id, i + 1)
+
+
+class TestFingerprintBackfill(unittest.TestCase):
+    def setUp(self):
+        self.Session = model.connect('sqlite:///%s' % self.mktemp())
+        self.backfill = FingerprintBackfill(self.Session, StatusExecutor())
+        self.backfill.schedule = mock.Mock()
+        # Run batches straight away
+        self.patch(status_module.threads, 'deferToThread',
+                   defer.maybeDeferred)
+
+    def testRun(self):
+        with mock.patch.object(model, 'backfillFingerprints') as backfill:
+            backfill.side_effect = [500, 3, 0]
+            for i in range(3):
+                self.backfill.run()
+        self.assertEquals(self.backfill.total, 503)
+        self.assertEquals(backfill.call_args[0][1], 500)
+        # Nothing else to do after the last batch
+        self.assertEquals(self.backfill.schedule.call_args_list,
+                          [((1,), {}), ((1,), {})])
+
+    def testRetry(self):
+        with mock.patch.object(model, 'backfillFingerprints') as backfill:
+            backfill.side_effect = ValueError("database went away")
+            with mock.patch('buildbotcustom.status.db.status.log'):
+                self.backfill.run()
+                self.backfill.stop()
+                self.backfill.run()
+        self.assertEquals(self.backfill.schedule.call_args_list,
+                          [((300,), {})])
+
+    def testUnthreaded(self):
+        # Without worker threads, batches still run off the reactor thread
+        deferToThread = mock.Mock(return_value=defer.succeed(0))
+        self.patch(status_module.threads, 'deferToThread', deferToThread)
+        self.backfill.run()
+        self.assertEquals(deferToThread.call_args[0], (self.backfill.batch,))
+
+        # So DBStatus starts it either way
+        status = DBStatus('sqlite://')
+        status.Session = self.Session
+        status.executor = StatusExecutor()
+        status.startBackfill()
+        self.assertNotEquals(status.backfill, None)
+        status.backfill.stop()
+
+    def testThreaded(self):
+        executor = StatusExecutor(threads=1)
+        backfill = FingerprintBackfill(self.Session, executor)
+        backfill.schedule = mock.Mock()
+        deferToThread = mock.Mock()
+        self.patch(status_module.threads, 'deferToThread', deferToThread)
+        batch = mock.Mock(return_value=0)
+        self.patch(model, 'backfillFingerprints', batch)
+        backfill.run()
+        d = executor.stop()
+
+        def check(_):
+            self.assertEquals(batch.call_count, 1)
+            self.failIf(deferToThread.called)
+        d.addCallback(check)
+        return d
@@ -1,4 +1,6 @@
-from buildbotcustom.try_parser import TryParser, processMessage
+from buildbotcustom.try_parser import TryParser, CompiledTryParser, \
+    processMessage
+import hashlib
 import unittest
 
 
@@ -420,7 +422,7 @@ class TestTryParser(unittest.TestCase):
             t for t in testers if 'crashtest' in t or 'mochitest-other' in t]
 
         self.assertEqual(sorted(self.customBuilders), sorted(builders))
-        # test in the getTestBuilders (for local builder_master unittests)
+        # test in CompiledTryParser.getTestBuilders (for local builder_master unittests)
         self.customBuilders = TryParser(tm, VALID_TESTER_NAMES, TESTER_PRETTY_NAMES, None, UNITTEST_SUITES)
         builders = self.filterTesters(['win32'])
         builders = [
@@ -434,7 +436,7 @@ class TestTryParser(unittest.TestCase):
         builders = self.filterBuilders(
             ['linux', 'linux-debug', 'win32', 'win32-debug'])
         self.assertEqual(sorted(self.customBuilders), sorted(builders))
-        # test in getTestBuilders
+        # test in CompiledTryParser.getTestBuilders
         self.customBuilders = TryParser(tm, VALID_BUILDER_NAMES, TESTER_PRETTY_NAMES, None, UNITTEST_SUITES)
         builders = []
         self.assertEqual(sorted(self.customBuilders), sorted(builders))
@@ -668,5 +670,80 @@ try: -this -should -be -ignored""")
 try: -a -b -c""")
 
 
+class TestCompiledTryParser(unittest.TestCase):
+
+    def setUp(self):
+        # A try config with 3,000 test builders: 25 platforms, each with two
+        # slave platforms, running 30 suites in opt and debug
+        self.suites = ['mochitest-%i' % i for i in range(1, 11)] + \
+                      ['mochitest-browser-chrome-%i' % i for i in range(1, 6)] + \
+                      ['mochitest-devtools-chrome-%i' % i for i in range(1, 4)] + \
+                      ['reftest-%i' % i for i in range(1, 5)] + \
+                      ['crashtest', 'jsreftest', 'xpcshell', 'marionette',
+                       'web-platform-tests-1', 'web-platform-tests-2',
+                       'mochitest-gl', 'cppunit']
+        self.prettyNames = {}
+        self.builderNames = []
+        for i in range(25):
+            slaves = ['Platform%i slave A' % i, 'Platform%i slave B' % i]
+            if i % 5 == 0:
+                slaves[1] += ' try-nondefault'
+            self.prettyNames['platform%i' % i] = slaves
+            for slave in slaves:
+                for buildType in ('opt', 'debug'):
+                    for suite in self.suites:
+                        self.builderNames.append('%s try %s test %s' % (
+                            base_platform(slave), buildType, suite))
+        self.assertEquals(len(self.builderNames), 3000)
+
+    # (number of builders, sha1 of their sorted names joined by newlines),
+    # as returned by the TryParser implementation before CompiledTryParser
+    goldenResults = [
+        ("try: -b do -p all -u all -t none",
+         2700, '6cb00c14eb2ba6918efb74f87577c674d9b44814'),
+        ("try: -b o -p platform3,platform5 -u mochitests",
+         57, 'd1cc01b64481bdddb5e6d5b4a744dd2b30b719bf'),
+        ("try: -b d -p full -u reftest,crashtest[slave B]",
+         205, '8b8abc02a2f4f025a7d5718024ec6b44e9e5096a'),
+        ("try: -b do -p all -u all[-slave A] -t none",
+         1500, 'e76a0830a0c65bdafa920577a81fa9e08eaa689c'),
+        ("no try syntax here",
+         2700, '6cb00c14eb2ba6918efb74f87577c674d9b44814'),
+    ]
+
+    def testSameResults(self):
+        parser = CompiledTryParser(self.builderNames, self.prettyNames, None,
+                                   self.suites)
+        for message, count, digest in self.goldenResults:
+            builders = sorted(parser.parse(message))
+            self.assertEquals(
+                (len(builders), hashlib.sha1('\n'.join(builders)).hexdigest()),
+                (count, digest), message)
+
+    def testSelection(self):
+        parser = CompiledTryParser(self.builderNames, self.prettyNames, None,
+                                   self.suites)
+        self.assertEquals(
+            sorted(parser.parse("try: -b o -p platform3 -u mochitest-bc")),
+            sorted('Platform3 slave %s try opt test '
+                   'mochitest-browser-chrome-%i' % (s, i)
+                   for s in 'AB' for i in range(1, 6)))
+        # Non-default slave platforms aren't chosen by default
+        self.assertEquals(
+            len(parser.parse("try: -b do -p all -u all -t none")), 2700)
+
+    def testRepeatedParses(self):
+        # Expansions cached by earlier messages don't change later results
+        parser = CompiledTryParser(self.builderNames, self.prettyNames, None,
+                                   self.suites)
+        messages = ["try: -b do -p all -u all -t none",
+                    "try: -b o -p platform%i -u mochitest-%i" % (1, 2),
+                    "try: -b d -p platform4,platform7 -u reftests[slave B]"]
+        first = [sorted(parser.parse(message)) for message in messages]
+        for i in range(10):
+            self.assertEquals([sorted(parser.parse(message))
+                               for message in messages], first)
+
+
 if __name__ == '__main__':
     unittest.main()
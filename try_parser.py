@@ -86,22 +86,6 @@ def basePlatform(platform):
     return platform.replace(' try-nondefault', '').replace('try-nondefault ', '')
 
 
-def getPlatformBuilders(user_platforms, builderNames, buildTypes, prettyNames):
-    '''Return builder names that are found in both prettyNames[p] for some
-       (expanded) platform p, and in builderNames'''
-
-    # When prettyNames contains list values rather than simple strings, it
-    # means that we're processing the argument for selecting test suites, so do
-    # not return any build builders.
-    if prettyNames and isinstance(prettyNames.values()[0], list):
-        return []
-
-    platforms = expandPlatforms(user_platforms, buildTypes)
-    builders = [basePlatform(prettyNames[p])
-                for p in platforms.intersection(prettyNames)]
-    return list(set(builders).intersection(builderNames))
-
-
 def passesFilter(testFilters, test, pretty, isDefault):
     if test not in testFilters:
         # No filter requested for test, so accept all defaults
@@ -134,61 +118,7 @@ def passesFilter(testFilters, test, pretty, isDefault):
     return matchedInclusion or not sawInclusion
 
 
-def getTestBuilders(
-    platforms, testType, tests, testFilters, builderNames, buildTypes, buildbotBranch,
-        prettyNames, unittestPrettyNames):
-    if tests == 'none':
-        return []
-
-    testBuilders = set()
-    # for all possible suites, add in the builderNames for that platform
-    if testType == "test":
-        builder_test_platforms = set()
-        for buildType in buildTypes:
-            for platform in platforms:
-                # this is to catch debug unittests triggered on the build master
-                # if the user asks for win32 with -b d
-                if buildType == 'debug' and not platform.endswith('debug'):
-                    builder_test_platforms.add('%s-debug' % platform)
-                if platform in prettyNames:
-                    for test in tests:
-                        # check for list type to handle test_master builders
-                        # where slave_platforms are used
-                        pretties = prettyNames[platform]
-                        if not isinstance(pretties, list):
-                            pretties = [pretties]
-                        for pretty in pretties:
-                            base_pretty = basePlatform(pretty)
-                            custom_builder = "%s %s %s %s %s" % (base_pretty, buildbotBranch, buildType, testType, test)
-                            if passesFilter(testFilters, test, custom_builder, base_pretty == pretty):
-                                testBuilders.add(custom_builder)
-
-        # we do all but debug win32 over on test masters so have to check the
-        # unittestPrettyNames platforms for local builder master unittests
-        for platform in builder_test_platforms.intersection(unittestPrettyNames or {}):
-            assert platform.endswith('-debug')
-            for test in tests:
-                pretty = unittestPrettyNames[platform]
-                base_pretty = basePlatform(pretty)
-                debug_custom_builder = "%s %s" % (base_pretty, test)
-                if passesFilter(testFilters, test, debug_custom_builder, base_pretty == pretty):
-                    testBuilders.add(debug_custom_builder)
-
-    if testType == "talos":
-        for platform in set(platforms).intersection(prettyNames):
-            # check whether we do talos for this platform
-            for slave_platform in prettyNames[platform]:
-                base_slave_platform = basePlatform(slave_platform)
-                for test in tests:
-                    custom_builder = "%s %s talos %s" % (
-                        base_slave_platform, buildbotBranch, test)
-                    if passesFilter(testFilters, test, custom_builder, base_slave_platform == slave_platform):
-                        testBuilders.add(custom_builder)
-
-    return list(testBuilders.intersection(builderNames))
-
-
-def parseTestOptions(s, testSuites):
+def parseTestOptions(s, testSuites, expand=expandTestSuites):
     '''parse a comma-separated list of tests, each optionally followed by a
     comma-separated list of restrictions enclosed in square brackets
 
@@ -270,7 +200,7 @@ def parseTestOptions(s, testSuites):
         if not m:
             return []  # Bad syntax
 
-        tests = expandTestSuites([m.group(1)], testSuites)
+        tests = expand([m.group(1)], testSuites)
         if m.group(2):
             for test in tests:
                 restrictions_map[test] = restrictions[int(m.group(2))]
@@ -280,10 +210,7 @@ def parseTestOptions(s, testSuites):
     return list(all_tests), restrictions_map
 
 
-def TryParser(
-    message, builderNames, prettyNames, unittestPrettyNames=None, unittestSuites=None, talosSuites=None,
-        buildbotBranch='try', buildersWithSetsMap=None):
-
+def makeArgParser():
     parser = argparse.ArgumentParser(description='Pass in a commit message and a list \
                                      and tryParse populates the list with the builderNames\
                                      that need schedulers.')
@@ -304,113 +231,273 @@ def TryParser(
                         default='none',
                         dest='talos',
                         help='provide a list of talos tests, or specify all (default is None)')
+    return parser
+
+
+_argParser = makeArgParser()
+
+
+class CompiledTryParser(object):
+    """A TryParser for one scheduler's configuration.
+
+    Everything that only depends on the configuration is worked out up
+    front: the platforms selected by -p all and -p full for each set of
+    build types, the test suites each -u/-t spec expands to, and every
+    builder name that could be chosen, indexed by platform, build type and
+    test. Parsing a try message is then mostly dictionary lookups.
+    """
+
+    # Maximum number of test suite specs to remember expansions for
+    MAX_EXPANSIONS = 1000
+
+    def __init__(self, builderNames, prettyNames, unittestPrettyNames=None,
+                 unittestSuites=None, talosSuites=None, buildbotBranch='try',
+                 buildersWithSetsMap=None):
+        self.builderNames = set(builderNames)
+        self.prettyNames = prettyNames
+        self.unittestPrettyNames = unittestPrettyNames
+        self.unittestSuites = unittestSuites
+        self.talosSuites = talosSuites
+        self.buildbotBranch = buildbotBranch
+        self.buildersWithSetsMap = buildersWithSetsMap
+
+        # tuple of build types -> (all platforms, default platforms)
+        self.platforms = {}
+        for buildTypes in (('opt', 'debug'), ('debug',), ('opt',)):
+            self.platforms[buildTypes] = self.findPlatforms(buildTypes)
+
+        # (suites, spec) -> suites matching spec
+        self.expansions = {}
+
+        # The build builder for each platform.
+        # When prettyNames contains list values rather than simple strings, it
+        # means that we're processing the argument for selecting test suites,
+        # so there are no build builders.
+        self.platformBuilders = {}
+        if not prettyNames or not isinstance(prettyNames.values()[0], list):
+            for p, pretty in prettyNames.iteritems():
+                builder = basePlatform(pretty)
+                if builder in self.builderNames:
+                    self.platformBuilders[p] = builder
+
+        # The test builders that exist, as lists of
+        # (builder name, whether it's selected by default).
+        # (platform, build type, test) -> builders on the test master
+        self.testBuilders = {}
+        # (debug platform, test) -> builders on the build master
+        self.unittestBuilders = {}
+        # (platform, test) -> talos builders
+        self.talosBuilders = {}
+        if unittestSuites:
+            self.indexTestBuilders()
+        if talosSuites:
+            self.indexTalosBuilders()
+
+    def findPlatforms(self, buildTypes):
+        prettyNames = self.prettyNames
+        if self.unittestSuites:
+            all_platforms = prettyNames.keys()
+        else:
+            # for build builders (as opposed to test builders), check against the
+            # prettyNames for -debug
+            all_platforms = set()
+            if 'debug' in buildTypes:
+                all_platforms.update(
+                    [p for p in prettyNames.keys() if p.endswith('debug')])
+            if 'opt' in buildTypes:
+                all_platforms.update(
+                    [p for p in prettyNames.keys() if not p.endswith('debug')])
+
+            # Strip off -debug. It gets tacked on by expandPlatforms for
+            # buildType == debug
+            all_platforms = list(
+                set([p.replace('-debug', '') for p in all_platforms]))
+
+        # Platforms whose prettyNames all have 'try-nondefault' in them are not
+        # included in -p all
+        default_platforms = set()
+        if self.unittestSuites or self.talosSuites:
+            for p in all_platforms:
+                default_platforms.update(
+                    [p for n in prettyNames[p] if 'try-nondefault' not in n])
+        else:
+            defaultPrettyNames = dict([(k, v)
+                                       for k, v in prettyNames.items()
+                                       if 'try-nondefault' not in v])
+            for p in all_platforms:
+                if p in defaultPrettyNames:
+                    default_platforms.add(p)
+                elif p + '-debug' in defaultPrettyNames:
+                    default_platforms.add(p)
+        return all_platforms, default_platforms
+
+    def indexTestBuilders(self):
+        for platform, pretties in self.prettyNames.iteritems():
+            # check for list type to handle test_master builders
+            # where slave_platforms are used
+            if not isinstance(pretties, list):
+                pretties = [pretties]
+            for buildType in ('opt', 'debug'):
+                for test in self.unittestSuites:
+                    builders = []
+                    for pretty in pretties:
+                        base_pretty = basePlatform(pretty)
+                        custom_builder = "%s %s %s test %s" % (
+                            base_pretty, self.buildbotBranch, buildType, test)
+                        if custom_builder in self.builderNames:
+                            builders.append(
+                                (custom_builder, base_pretty == pretty))
+                    if builders:
+                        self.testBuilders[platform, buildType, test] = \
+                            builders
+
+        for platform, pretty in (self.unittestPrettyNames or {}).iteritems():
+            if not platform.endswith('-debug'):
+                continue
+            base_pretty = basePlatform(pretty)
+            for test in self.unittestSuites:
+                debug_custom_builder = "%s %s" % (base_pretty, test)
+                if debug_custom_builder in self.builderNames:
+                    self.unittestBuilders[platform, test] = \
+                        [(debug_custom_builder, base_pretty == pretty)]
+
+    def indexTalosBuilders(self):
+        for platform, slave_platforms in self.prettyNames.iteritems():
+            for test in self.talosSuites:
+                builders = []
+                for slave_platform in slave_platforms:
+                    base_slave_platform = basePlatform(slave_platform)
+                    custom_builder = "%s %s talos %s" % (
+                        base_slave_platform, self.buildbotBranch, test)
+                    if custom_builder in self.builderNames:
+                        builders.append((custom_builder,
+                                         base_slave_platform == slave_platform))
+                if builders:
+                    self.talosBuilders[platform, test] = builders
+
+    def expandTestSuites(self, user_suites, valid_suites):
+        """expandTestSuites, remembering the results"""
+        key = (valid_suites is self.talosSuites, tuple(user_suites))
+        try:
+            return self.expansions[key]
+        except KeyError:
+            pass
+        if len(self.expansions) >= self.MAX_EXPANSIONS:
+            self.expansions.clear()
+        tests = expandTestSuites(user_suites, valid_suites)
+        self.expansions[key] = tests
+        return tests
+
+    def getTestBuilders(self, platforms, tests, testFilters, buildTypes):
+        testBuilders = set()
+        for buildType in buildTypes:
+            for platform in platforms:
+                for test in tests:
+                    builders = []
+                    if self.unittestPrettyNames:
+                        # this is to catch debug unittests triggered on the
+                        # build master if the user asks for win32 with -b d
+                        if buildType == 'debug' and \
+                                not platform.endswith('debug'):
+                            builders = self.unittestBuilders.get(
+                                ('%s-debug' % platform, test), [])
+                    builders = builders + self.testBuilders.get(
+                        (platform, buildType, test), [])
+                    for builder, isDefault in builders:
+                        if passesFilter(testFilters, test, builder, isDefault):
+                            testBuilders.add(builder)
+        return list(testBuilders)
+
+    def getTalosBuilders(self, platforms, tests, testFilters):
+        testBuilders = set()
+        for platform in platforms:
+            for test in tests:
+                for builder, isDefault in self.talosBuilders.get(
+                        (platform, test), []):
+                    if passesFilter(testFilters, test, builder, isDefault):
+                        testBuilders.add(builder)
+        return list(testBuilders)
+
+    def parse(self, message):
+        """Returns the builder names requested by the try syntax in
+        message"""
+        (options, unknown_args) = _argParser.parse_known_args(
+            processMessage(message))
+
+        # Build options include a possible override of 'all' to get a buildset
+        # that matches m-c
+        if options.build == 'do' or options.build == 'od':
+            options.build = ['opt', 'debug']
+        elif options.build == 'd':
+            options.build = ['debug']
+        elif options.build == 'o':
+            options.build = ['opt']
+        else:
+            # for any input other than do/od, d, o, all set to default
+            options.build = ['opt', 'debug']
+
+        buildersWithSetsMap = self.buildersWithSetsMap
+        if buildersWithSetsMap and type(buildersWithSetsMap) is dict:
+            # The TryChooser user has set a comma separated list of test suites
+            # This platform has a dictionary that allows to match a test suite
+            # to an actual builder (e.g. {"mochitest-1": "androidx86-set-1"}
+            chosen_suites = options.test.split(',')
+            new_choice = []
+            for chosen_suite in chosen_suites:
+                if chosen_suite in buildersWithSetsMap:
+                    if chosen_suite not in new_choice:
+                        new_choice.append(buildersWithSetsMap[chosen_suite])
+            options.test = ','.join(new_choice)
+
+        all_platforms, default_platforms = \
+            self.platforms[tuple(options.build)]
+
+        user_platforms = set()
+        for platform in options.user_platforms.split(','):
+            if platform == 'all':
+                user_platforms.update(default_platforms)
+            elif platform == 'full':
+                user_platforms.update(all_platforms)
+            else:
+                user_platforms.add(platform)
+
+        options.user_platforms = user_platforms
+
+        testFilters = None
+        if self.unittestSuites:
+            options.test, testFilters = parseTestOptions(
+                options.test, self.unittestSuites, self.expandTestSuites)
+
+        talosTestFilters = None
+        if self.talosSuites:
+            options.talos, talosTestFilters = parseTestOptions(
+                options.talos, self.talosSuites, self.expandTestSuites)
+
+        # List for the custom builder names that match prettyNames passed in
+        # from misc.py
+        customBuilderNames = []
+        if options.user_platforms:
+            log.msg("TryChooser OPTIONS : MESSAGE %s : %s" % (options, message))
+            builders = set()
+            for p in expandPlatforms(options.user_platforms, options.build):
+                if p in self.platformBuilders:
+                    builders.add(self.platformBuilders[p])
+            customBuilderNames = list(builders)
+
+            if options.test and self.unittestSuites:
+                customBuilderNames.extend(self.getTestBuilders(
+                    options.user_platforms, options.test, testFilters,
+                    options.build))
+            if options.talos and self.talosSuites:
+                customBuilderNames.extend(self.getTalosBuilders(
+                    options.user_platforms, options.talos, talosTestFilters))
+
+        return customBuilderNames
 
-    (options, unknown_args) = parser.parse_known_args(processMessage(message))
 
-    # Build options include a possible override of 'all' to get a buildset
-    # that matches m-c
-    if options.build == 'do' or options.build == 'od':
-        options.build = ['opt', 'debug']
-    elif options.build == 'd':
-        options.build = ['debug']
-    elif options.build == 'o':
-        options.build = ['opt']
-    else:
-        # for any input other than do/od, d, o, all set to default
-        options.build = ['opt', 'debug']
-
-    if buildersWithSetsMap and type(buildersWithSetsMap) is dict:
-        # The TryChooser user has set a comma separated list of test suites
-        # This platform has a dictionary that allows to match a test suite
-        # to an actual builder (e.g. {"mochitest-1": "androidx86-set-1"}
-        chosen_suites = options.test.split(',')
-        new_choice = []
-        for chosen_suite in chosen_suites:
-            if buildersWithSetsMap.has_key(chosen_suite):
-                if chosen_suite not in new_choice:
-                    new_choice.append(buildersWithSetsMap[chosen_suite])
-        options.test = ','.join(new_choice)
-
-    if unittestSuites:
-        all_platforms = prettyNames.keys()
-    else:
-        # for build builders (as opposed to test builders), check against the
-        # prettyNames for -debug
-        all_platforms = set()
-        if 'debug' in options.build:
-            all_platforms.update(
-                [p for p in prettyNames.keys() if p.endswith('debug')])
-        if 'opt' in options.build:
-            all_platforms.update(
-                [p for p in prettyNames.keys() if not p.endswith('debug')])
-
-        # Strip off -debug. It gets tacked on in the getPlatformBuilders for
-        # buildType == debug
-        all_platforms = list(
-            set([p.replace('-debug', '') for p in all_platforms]))
-
-    # Platforms whose prettyNames all have 'try-nondefault' in them are not
-    # included in -p all
-    default_platforms = set()
-    if unittestSuites or talosSuites:
-        for p in all_platforms:
-            default_platforms.update(
-                [p for n in prettyNames[p] if 'try-nondefault' not in n])
-    else:
-        defaultPrettyNames = dict([(k, v)
-                                   for k, v in prettyNames.items()
-                                   if 'try-nondefault' not in v])
-        for p in all_platforms:
-            if p in defaultPrettyNames:
-                default_platforms.add(p)
-            elif p + '-debug' in defaultPrettyNames:
-                default_platforms.add(p)
-
-    user_platforms = set()
-    for platform in options.user_platforms.split(','):
-        if platform == 'all':
-            user_platforms.update(default_platforms)
-        elif platform == 'full':
-            user_platforms.update(all_platforms)
-        else:
-            user_platforms.add(platform)
-
-    options.user_platforms = user_platforms
-
-    testFilters = None
-    if unittestSuites:
-        options.test, testFilters = parseTestOptions(
-            options.test, unittestSuites)
-
-    talosTestFilters = None
-    if talosSuites:
-        options.talos, talosTestFilters = parseTestOptions(
-            options.talos, talosSuites)
-
-    # List for the custom builder names that match prettyNames passed in from
-    # misc.py
-    customBuilderNames = []
-    if options.user_platforms:
-        log.msg("TryChooser OPTIONS : MESSAGE %s : %s" % (options, message))
-        customBuilderNames = getPlatformBuilders(
-            options.user_platforms, builderNames, options.build, prettyNames)
-
-        if options.test and unittestSuites:
-            # get test builders for test_master first
-            customBuilderNames.extend(
-                getTestBuilders(
-                    options.user_platforms, "test", options.test, testFilters,
-                    builderNames, options.build, buildbotBranch, prettyNames, None))
-            # then add any builder_master test builders
-            if unittestPrettyNames:
-                customBuilderNames.extend(
-                    getTestBuilders(
-                        options.user_platforms, "test", options.test, testFilters,
-                        builderNames, options.build, buildbotBranch, {}, unittestPrettyNames))
-        if options.talos and talosSuites:
-            customBuilderNames.extend(
-                getTestBuilders(
-                    options.user_platforms, "talos", options.talos, talosTestFilters, builderNames,
-                    options.build, buildbotBranch, prettyNames, None))
-
-    return customBuilderNames
+def TryParser(
+    message, builderNames, prettyNames, unittestPrettyNames=None, unittestSuites=None, talosSuites=None,
+        buildbotBranch='try', buildersWithSetsMap=None):
+    return CompiledTryParser(
+        builderNames, prettyNames, unittestPrettyNames, unittestSuites,
+        talosSuites, buildbotBranch, buildersWithSetsMap).parse(message)